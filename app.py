@@ -11,4 +11,7 @@ app = create_app({
     'OAUTH2_REFRESH_TOKEN_GENERATOR': True,
     'SQLALCHEMY_TRACK_MODIFICATIONS': False,
     'SQLALCHEMY_DATABASE_URI': environ.get("DATABASE_URL", "sqlite:///db.sqlite"),
+    # set FAST_START=1 once deploys run `flask db-upgrade` before the workers
+    'FAST_START': environ.get('FAST_START') == '1',
+    'STARTUP_REPORT': environ.get('FAST_START') == '1',
 })
@@ -0,0 +1,16 @@
+# asgi.py
+from os import environ
+from website.asgi import create_asgi_app
+environ['AUTHLIB_INSECURE_TRANSPORT'] = '1'
+
+
+# the protected /api/ endpoints on an event loop, see website/asgi.py:
+#     uvicorn asgi:app --workers 4 --port 8001
+app = create_asgi_app({
+    'SECRET_KEY': 'secret',
+    'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+    'SQLALCHEMY_DATABASE_URI': environ.get("DATABASE_URL", "sqlite:///db.sqlite"),
+    'ASYNC_DATABASE_URI': environ.get('ASYNC_DATABASE_URL'),
+    # the Flask app owns the schema
+    'FAST_START': True,
+})
@@ -0,0 +1,32 @@
+# gunicorn.conf.py
+# Read by gunicorn from the working directory; flags on its command line
+# still win. WEB_WORKER_CLASS picks how a worker waits on Google and the
+# database:
+#
+#   sync     one request at a time per worker (gunicorn's default)
+#   gthread  WEB_THREADS requests per worker, on threads
+#   gevent   WEB_WORKER_CONNECTIONS requests per worker, on greenlets; needs
+#            gevent, and psycogreen with PostgreSQL. Password hashing then
+#            blocks the worker while it runs, and request profiles
+#            (website/profiling.py) get no stack samples.
+#
+# With gthread or gevent, size SQLALCHEMY_POOL_SIZE and
+# GOOGLE_HTTP_POOL_SIZE for the requests a worker serves at once.
+import os
+
+worker_class = os.environ.get('WEB_WORKER_CLASS', 'sync')
+if worker_class == 'gthread':
+    threads = int(os.environ.get('WEB_THREADS', 8))
+elif worker_class == 'gevent':
+    worker_connections = int(os.environ.get('WEB_WORKER_CONNECTIONS', 100))
+
+
+def post_fork(server, worker):
+    if worker_class != 'gevent':
+        return
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        return
+    # psycopg2 waits on the gevent hub instead of blocking the worker
+    patch_psycopg()
@@ -0,0 +1,351 @@
+# admin.py
+"""Bulk administration: revoking tokens and provisioning clients by the
+thousand instead of one HTTP call each.
+
+- ``revoke_tokens`` revokes every token of a user, a client, or a client
+  for one scope with a single ``UPDATE ... RETURNING``.
+- ``provision_clients`` creates many clients, and ``rotate_client_secrets``
+  gives many clients new secrets, each in one transaction.
+
+Each is a generator of progress dicts, the last one ``{'done': True, ...}``
+with the number of affected rows or ``{'error': ...}`` after a rollback.
+The ``/admin/...`` endpoints stream them as JSON lines and the ``flask``
+commands print them. The endpoints take HTTP Basic client authentication
+and answer only the clients listed in ``ADMIN_CLIENTS``.
+"""
+import functools
+import json
+import sys
+import time
+import click
+from authlib.oauth2 import OAuth2Error
+from flask import current_app, request, stream_with_context
+from flask.cli import with_appcontext
+from sqlalchemy import case, literal, or_, select, update
+from werkzeug.security import gen_salt
+from .models import db, User, OAuth2Client, OAuth2Token
+from .oauth2 import authorization
+from .token_cache import token_cache
+from .token_storage import token_storage
+from .revocations import revocation_feed
+from .db_routing import replica_router
+from .metrics import metrics
+
+CLIENT_FIELDS = (
+    'client_id', 'client_name', 'client_uri', 'grant_types', 'redirect_uris',
+    'response_types', 'scope', 'token_endpoint_auth_method', 'rate_limit',
+    'reuse_tokens',
+)
+
+
+class AdminAccessDenied(OAuth2Error):
+    error = 'access_denied'
+    description = 'The client is not allowed to use the admin API.'
+    status_code = 403
+
+
+def authenticate_admin():
+    """The client authenticating this request, if it's in ``ADMIN_CLIENTS``."""
+    client = authorization.authenticate_client(
+        authorization.create_oauth2_request(request), ['client_secret_basic'], 'admin')
+    if client.client_id not in (current_app.config.get('ADMIN_CLIENTS') or ()):
+        raise AdminAccessDenied()
+    return client
+
+
+def admin_required(fn):
+    """Decorate a view; other clients get the OAuth 2.0 error response."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            client = authenticate_admin()
+        except OAuth2Error as error:
+            return authorization.handle_error_response(request, error)
+        return fn(client, *args, **kwargs)
+    return wrapper
+
+
+def stream_progress(progress):
+    """A response streaming ``progress`` as JSON lines."""
+    lines = (json.dumps(event, sort_keys=True) + '\n' for event in progress)
+    response = current_app.response_class(
+        stream_with_context(lines), mimetype='application/x-ndjson')
+    # don't let a proxy hold the progress back
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def has_scope(scope):
+    # scope is a space separated list
+    padded = literal(' ') + OAuth2Token.scope + literal(' ')
+    return padded.contains(f' {scope} ', autoescape=True)
+
+
+def revoke_tokens(user_id=None, client_id=None, scope=None, batch_size=1000, now=None):
+    """Revoke the access and refresh tokens of ``user_id``, of ``client_id``,
+    or of ``client_id`` that carry ``scope``, and log the access tokens to
+    the revocation feed, in one transaction.
+
+    This process stops accepting the tokens when it commits; every worker
+    that cached them does at its next cache_sync poll, within about
+    ``CACHE_SYNC_INTERVAL`` seconds (``TOKEN_CACHE_TTL`` if that is 0).
+    """
+    if user_id is None and not client_id:
+        raise ValueError('revoke_tokens needs a user or a client')
+    if scope and not client_id:
+        raise ValueError('scope is only matched along with a client')
+    now = now or int(time.time())
+    table = OAuth2Token.__table__
+    criteria = [or_(table.c.access_token_revoked_at == 0, table.c.refresh_token_revoked_at == 0)]
+    if user_id is not None:
+        criteria.append(table.c.user_id == user_id)
+    if client_id:
+        criteria.append(table.c.client_id == client_id)
+    if scope:
+        criteria.append(has_scope(scope))
+    columns = (table.c.id, table.c.access_token, table.c.access_token_digest,
+               table.c.issued_at, table.c.expires_in, table.c.access_token_revoked_at)
+    statement = update(table).where(*criteria).values({
+        table.c.access_token_revoked_at: case(
+            (table.c.access_token_revoked_at == 0, now), else_=table.c.access_token_revoked_at),
+        table.c.refresh_token_revoked_at: case(
+            (table.c.refresh_token_revoked_at == 0, now), else_=table.c.refresh_token_revoked_at),
+    })
+    try:
+        if db.session.get_bind().dialect.update_returning:
+            batches = db.session.execute(statement.returning(*columns)).partitions(batch_size)
+        else:
+            selected = db.session.execute(
+                select(*columns).where(*criteria).with_for_update()).all()
+            db.session.execute(statement)
+            batches = (selected[i:i + batch_size] for i in range(0, len(selected), batch_size))
+        db.session.info['wrote'] = True
+        rows_seen = 0
+        keys = []
+        for batch in batches:
+            # RETURNING gives the revoked_at after the update, SELECT before;
+            # a row revoked earlier only loses its refresh token
+            revoked = [row for row in batch if row.access_token_revoked_at in (0, now)]
+            revocation_feed.record(revoked, now)
+            keys.extend(token_storage.row_key(row) for row in revoked)
+            rows_seen += len(batch)
+            yield {'revoked': rows_seen}
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        yield {'error': f'{type(e).__name__}: {e}'}
+        return
+    for key in keys:
+        token_cache.invalidate(key)
+        replica_router.wrote(key)
+    by = 'client_scope' if scope else 'client' if client_id else 'user'
+    metrics.tokens_bulk_revoked(by, rows_seen)
+    yield {'done': True, 'revoked': rows_seen, 'access_tokens': len(keys)}
+
+
+def parse_client_specs(specs, limit=None):
+    """Check client specs (dicts of ``CLIENT_FIELDS``, ``client_name``
+    required) before anything is written. Raises ``ValueError``."""
+    if not isinstance(specs, list):
+        raise ValueError('expected a list of clients')
+    if limit is not None and len(specs) > limit:
+        raise ValueError(f'at most {limit} clients per request')
+    for i, spec in enumerate(specs):
+        if not isinstance(spec, dict):
+            raise ValueError(f'client {i}: expected an object')
+        unknown = set(spec) - set(CLIENT_FIELDS)
+        if unknown:
+            raise ValueError(f'client {i}: unknown fields {", ".join(sorted(unknown))}')
+        if not spec.get('client_name'):
+            raise ValueError(f'client {i}: client_name is required')
+        for field in ('grant_types', 'redirect_uris', 'response_types'):
+            if not isinstance(spec.get(field, []), list):
+                raise ValueError(f'client {i}: {field} must be a list')
+    given = [spec['client_id'] for spec in specs if spec.get('client_id')]
+    if len(set(given)) != len(given):
+        raise ValueError('client_id given twice')
+    return specs
+
+
+def new_client(spec, user_id, now):
+    """An ``OAuth2Client`` for ``spec``, as the ``/create_client`` form makes
+    them; ``client_id`` is generated unless given."""
+    client = OAuth2Client(
+        client_id=spec.get('client_id') or gen_salt(24),
+        client_id_issued_at=now,
+        user_id=user_id,
+    )
+    metadata = {
+        'client_name': spec['client_name'],
+        'client_uri': spec.get('client_uri', ''),
+        'grant_types': spec.get('grant_types', []),
+        'redirect_uris': spec.get('redirect_uris', []),
+        'response_types': spec.get('response_types', []),
+        'scope': spec.get('scope', ''),
+        'token_endpoint_auth_method': spec.get('token_endpoint_auth_method', 'client_secret_basic'),
+    }
+    if spec.get('rate_limit'):
+        metadata['rate_limit'] = [int(spec['rate_limit']), 60]
+    if spec.get('reuse_tokens'):
+        metadata['reuse_tokens'] = True
+    client.set_client_metadata(metadata)
+    client.client_secret = '' if metadata['token_endpoint_auth_method'] == 'none' else gen_salt(48)
+    return client
+
+
+def provision_clients(specs, user_id=None, batch_size=500):
+    """Create the clients of ``specs`` (see ``parse_client_specs``) owned by
+    ``user_id`` in one transaction. Their credentials are only yielded once
+    it's committed."""
+    now = int(time.time())
+    created = []
+    try:
+        for start in range(0, len(specs), batch_size):
+            batch = specs[start:start + batch_size]
+            # client_id isn't unique in the table, only by convention
+            given = [spec['client_id'] for spec in batch if spec.get('client_id')]
+            taken = [c for (c,) in db.session.query(OAuth2Client.client_id)
+                     .filter(OAuth2Client.client_id.in_(given))] if given else []
+            if taken:
+                raise ValueError(f'client_id already exists: {", ".join(taken)}')
+            clients = [new_client(spec, user_id, now) for spec in batch]
+            db.session.add_all(clients)
+            db.session.flush()
+            created.extend((c.client_id, c.client_secret) for c in clients)
+            yield {'created': len(created)}
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        yield {'error': f'{type(e).__name__}: {e}'}
+        return
+    for client_id, client_secret in created:
+        yield {'client_id': client_id, 'client_secret': client_secret}
+    yield {'done': True, 'created': len(created)}
+
+
+def rotate_client_secrets(client_ids, batch_size=500):
+    """Give each confidential client of ``client_ids`` a new secret, in one
+    transaction.
+
+    The old secrets stop working in this process when it commits, and in
+    the workers that cached them at their next cache_sync poll, within
+    about ``CACHE_SYNC_INTERVAL`` seconds (``CLIENT_CACHE_TTL`` if that is 0).
+    """
+    rotated = []
+    skipped = []
+    found = set()
+    try:
+        for start in range(0, len(client_ids), batch_size):
+            chunk = client_ids[start:start + batch_size]
+            for client in OAuth2Client.query.filter(OAuth2Client.client_id.in_(chunk)):
+                found.add(client.client_id)
+                if client.token_endpoint_auth_method == 'none':
+                    skipped.append(client.client_id)
+                    continue
+                client.client_secret = gen_salt(48)
+                rotated.append((client.client_id, client.client_secret))
+            db.session.flush()
+            yield {'rotated': len(rotated)}
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        yield {'error': f'{type(e).__name__}: {e}'}
+        return
+    for client_id, client_secret in rotated:
+        yield {'client_id': client_id, 'client_secret': client_secret}
+    yield {
+        'done': True,
+        'rotated': len(rotated),
+        'skipped': skipped,
+        'missing': [c for c in client_ids if c not in found],
+    }
+
+
+def find_user_id(user):
+    """A user id from an id or a username, for the CLI commands."""
+    if user is None:
+        return None
+    row = User.query.filter_by(username=user).first()
+    if row is None and user.isdigit():
+        row = db.session.get(User, int(user))
+    if row is None:
+        raise click.BadParameter(f'no user {user}')
+    return row.id
+
+
+def echo_progress(progress):
+    """Print progress to stderr and credentials to stdout; returns the
+    summary."""
+    for event in progress:
+        if 'client_id' in event:
+            click.echo(json.dumps(event, sort_keys=True))
+        elif 'error' in event:
+            raise click.ClickException(event['error'])
+        elif event.get('done'):
+            click.echo(json.dumps(event, sort_keys=True), err=True)
+            return event
+        else:
+            click.echo(' '.join(f'{k} {v}' for k, v in event.items()), err=True)
+
+
+def read_json_input(stream):
+    # a JSON array, or one JSON value per line
+    data = stream.read().strip()
+    if data.startswith('['):
+        return json.loads(data)
+    return [json.loads(line) for line in data.splitlines() if line.strip()]
+
+
+@click.command('revoke-tokens')
+@click.option('--user', help='User id or username.')
+@click.option('--client', 'client_id', help='Client id.')
+@click.option('--scope', help='Only tokens of --client that carry this scope.')
+@click.option('--batch-size', type=int, default=1000, help='Revocations logged per step.')
+@with_appcontext
+def revoke_tokens_command(user, client_id, scope, batch_size):
+    """Revoke every token of a user, a client, or a client and scope.
+
+    Running workers stop accepting them within about CACHE_SYNC_INTERVAL
+    seconds.
+    """
+    if user is None and client_id is None:
+        raise click.UsageError('give --user, --client or both')
+    if scope and client_id is None:
+        raise click.UsageError('--scope needs --client')
+    echo_progress(revoke_tokens(find_user_id(user), client_id, scope, batch_size))
+
+
+@click.command('provision-clients')
+@click.argument('source', type=click.File('r'), default='-')
+@click.option('--owner', help='User id or username owning the clients.')
+@click.option('--batch-size', type=int, default=500, help='Clients inserted per step.')
+@with_appcontext
+def provision_clients_command(source, owner, batch_size):
+    """Create the clients described in SOURCE (a JSON array, or JSON lines;
+    - for stdin) and print their credentials as JSON lines."""
+    try:
+        specs = parse_client_specs(read_json_input(source))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    echo_progress(provision_clients(specs, find_user_id(owner), batch_size))
+
+
+@click.command('rotate-client-secrets')
+@click.argument('client_ids', nargs=-1)
+@click.option('--from-file', type=click.File('r'), help='One client id per line; - for stdin.')
+@click.option('--batch-size', type=int, default=500, help='Clients updated per step.')
+@with_appcontext
+def rotate_client_secrets_command(client_ids, from_file, batch_size):
+    """Give clients new secrets and print them as JSON lines.
+
+    Running workers stop accepting the old secrets within about
+    CACHE_SYNC_INTERVAL seconds.
+    """
+    client_ids = list(client_ids)
+    if from_file is not None:
+        client_ids.extend(line.strip() for line in from_file if line.strip())
+    if not client_ids:
+        raise click.UsageError('no client ids given')
+    summary = echo_progress(rotate_client_secrets(client_ids, batch_size))
+    if summary and summary['missing']:
+        sys.exit(1)
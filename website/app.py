@@ -1,13 +1,37 @@
 # website/app.py
+import time
+_import_started = time.perf_counter()
 import os
 from flask import Flask
 from .models import db
+from .db_routing import configure_database, replica_router
 from .oauth2 import config_oauth
 from .routes import bp
-from authlib.integrations.flask_client import OAuth
+from .request_log import request_logger
+from .jwt_tokens import rotate_key_command
+from .google_tokens import google_id_tokens
+from .upstream import upstream
+from .sweeper import sweep_command, init_sweeper
+from .passwords import benchmark_command
+from .metrics import metrics
+from .migrations import upgrade, upgrade_command, status_command
+from .token_storage import hash_tokens_command
+from .admin import revoke_tokens_command, provision_clients_command, rotate_client_secrets_command
+from .startup import StartupTimer, startup_report_command
+from .rate_limit import rate_limiter
+from .profiling import request_profiler, profile_header_command
+from .cache_sync import cache_sync
+_import_seconds = time.perf_counter() - _import_started
 
 
 def create_app(config=None):
+    global _import_seconds
+    timer = StartupTimer()
+    if _import_seconds is not None:
+        # only the first app of a process pays for the imports
+        timer.add('import', _import_seconds)
+        _import_seconds = None
+    started = time.perf_counter()
     app = Flask(__name__)
 
     # load default configuration
@@ -23,33 +47,63 @@ def create_app(config=None):
             app.config.update(config)
         elif config.endswith('.py'):
             app.config.from_pyfile(config)
+    timer.add('config', time.perf_counter() - started)
 
-    setup_app(app)
+    setup_app(app, timer)
+    app.extensions['startup'] = timer
+    if app.config.get('STARTUP_REPORT'):
+        print(timer.report())
     return app
 
 
-def setup_app(app):
-
-    db.init_app(app)
-    # Create tables if they do not exist already
-    with app.app_context():
-        db.create_all()
-    config_oauth(app)
-    # start: added for google oauth
-    # Initialize OAuth with Google configuration
-    oauth = OAuth(app)
-    app.config['GOOGLE_OAUTH_CLIENT'] = oauth.register(
-        name='google',
-        client_id=os.environ.get('GOOGLE_CLIENT_ID'),
-        client_secret=os.environ.get('GOOGLE_CLIENT_SECRET'),
-        access_token_url='https://accounts.google.com/o/oauth2/token',
-        authorize_url='https://accounts.google.com/o/oauth2/auth',
-        api_base_url='https://www.googleapis.com/oauth2/v1/',
-        client_kwargs={'scope': 'openid email profile'}
-    )
-    # end:added for google oauth
-    # When running locally, disable OAuthlib's HTTPs verification.
-    # ACTION ITEM for developers:
-    #     When running in production *do not* leave this option enabled.
-    os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
-    app.register_blueprint(bp, url_prefix='')
+def setup_app(app, timer=None):
+    timer = timer or StartupTimer()
+    # FAST_START: the schema is managed with `flask db-upgrade` and
+    # nothing at boot touches the database or the environment
+    fast_start = app.config.get('FAST_START')
+
+    with timer.phase('database'):
+        configure_database(app)
+        db.init_app(app)
+        replica_router.init_app(app)
+    if not fast_start:
+        # Create tables and columns that do not exist already; replicas
+        # get them through replication
+        with timer.phase('migrate'), app.app_context():
+            upgrade(db.engine)
+    with timer.phase('metrics'):
+        metrics.init_app(app)
+    with timer.phase('oauth2'):
+        config_oauth(app)
+    with timer.phase('cache_sync'):
+        cache_sync.init_app(app)
+    with timer.phase('request_log'):
+        request_logger.init_app(app)
+    with timer.phase('rate_limit'):
+        rate_limiter.init_app(app)
+    with timer.phase('profiling'):
+        request_profiler.init_app(app)
+    # the Google login client is registered on first use, see
+    # google_tokens.google_oauth_client
+    with timer.phase('google'):
+        upstream.init_app(app)
+        google_id_tokens.init_app(app)
+    if not fast_start:
+        # When running locally, disable OAuthlib's HTTPs verification.
+        # ACTION ITEM for developers:
+        #     When running in production *do not* leave this option enabled.
+        os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+    with timer.phase('routes'):
+        app.register_blueprint(bp, url_prefix='')
+        app.cli.add_command(rotate_key_command)
+        app.cli.add_command(sweep_command)
+        app.cli.add_command(benchmark_command)
+        app.cli.add_command(upgrade_command)
+        app.cli.add_command(status_command)
+        app.cli.add_command(startup_report_command)
+        app.cli.add_command(hash_tokens_command)
+        app.cli.add_command(revoke_tokens_command)
+        app.cli.add_command(provision_clients_command)
+        app.cli.add_command(rotate_client_secrets_command)
+        app.cli.add_command(profile_header_command)
+        init_sweeper(app)
@@ -0,0 +1,277 @@
+# asgi.py
+"""Async resource server for ``/api/me``, ``/api/data`` and ``/api/pets``.
+
+The protected endpoints only look up a token and its user, so on sync
+workers most of a worker's time is spent waiting on the database. This
+serves the same endpoints from an asyncio event loop, with the token and
+user lookups on an async driver (aiosqlite or asyncpg), so one process
+keeps thousands of keep-alive clients and in-flight lookups. It uses the
+same models, token cache, JWT verification, Google ID token fallback and
+validation rules as the Flask routes; everything else stays on the Flask
+app. Run it next to gunicorn and route ``/api/`` to it::
+
+    $ uvicorn asgi:app --workers 4 --port 8001
+"""
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+from authlib.oauth2 import OAuth2Error
+from sqlalchemy import select, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import Unauthorized
+from .app import create_app
+from .models import OAuth2Token, User
+from .oauth2 import require_oauth
+from .token_cache import token_cache, CachedToken, CachedUser
+from .token_storage import token_storage
+from .jwt_tokens import jwt_access_tokens
+from .google_tokens import google_id_tokens
+from .metrics import metrics
+from .db_routing import engine_options
+from .revocations import revocation_feed, key_hash, token_hash
+from .cache_sync import cache_sync
+from .routes import bearer_token_value, is_token_expired, pets
+
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'postgres': 'postgresql+asyncpg',
+}
+
+
+def async_database_uri(config):
+    """``ASYNC_DATABASE_URI``, or the primary database URL with the async
+    driver of its backend."""
+    if config.get('ASYNC_DATABASE_URI'):
+        return config['ASYNC_DATABASE_URI']
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    driver = ASYNC_DRIVERS.get(url.drivername.split('+')[0])
+    if driver is None:
+        raise ValueError(f'No async driver for {url.drivername}, set ASYNC_DATABASE_URI')
+    return url.set(drivername=driver).render_as_string(hide_password=False)
+
+
+def host_url(scope, headers):
+    """What ``request.host_url`` is in Flask, from an ASGI scope. JWT
+    access tokens name it as their issuer unless JWT_ISSUER is set."""
+    host = headers.get('host')
+    if not host and scope.get('server'):
+        host, port = scope['server']
+        host = f'{host}:{port}' if port else host
+    return f"{scope.get('scheme', 'http')}://{host or 'localhost'}/"
+
+
+def json_body(data):
+    # what flask.jsonify produces outside debug mode
+    return (json.dumps(data, sort_keys=True, separators=(',', ':')) + '\n').encode()
+
+
+class ResourceServer(object):
+    """ASGI application serving the protected API endpoints."""
+
+    def __init__(self, app):
+        self.app = app
+        uri = async_database_uri(app.config)
+        self.engine = create_async_engine(uri, **engine_options(app.config, uri))
+        self.session = async_sessionmaker(self.engine, expire_on_commit=False)
+        metrics.instrument(self.engine.sync_engine)
+        self.routes = {
+            ('GET', '/api/me'): self.api_me,
+            ('GET', '/api/data'): self.api_data,
+            ('GET', '/api/pets'): self.api_pets,
+            ('GET', '/healthz'): self.healthz,
+            ('GET', '/readyz'): self.readyz,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        cache_sync.ensure_started()
+        started = time.perf_counter()
+        handler = self.routes.get((scope['method'], scope['path']))
+        if handler is None:
+            status, body, headers = 404, {'error': 'not_found'}, []
+        else:
+            request_headers = {k.decode('latin-1').lower(): v.decode('latin-1')
+                               for k, v in scope['headers']}
+            query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+            status, body, headers = await handler(
+                request_headers, query, host_url(scope, request_headers))
+        payload = json_body(body)
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(payload)).encode()),
+            ] + [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+        })
+        await send({'type': 'http.response.body', 'body': payload})
+        if metrics.enabled:
+            endpoint = 'asgi.' + handler.__name__ if handler else 'unmatched'
+            labels = (('endpoint', endpoint),)
+            metrics.observe('http_request_duration_seconds', time.perf_counter() - started, labels)
+            metrics.inc('http_requests_total', labels + (
+                ('method', scope['method']), ('status', str(status))))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.ping()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def ping(self):
+        async with self.engine.connect() as conn:
+            await conn.execute(text('SELECT 1'))
+
+    # lookups, as resolve_bearer_token and GoogleIDTokenVerifier.find_user
+
+    async def resolve_bearer_token(self, token_string, host_url=None):
+        claims = jwt_access_tokens.verify(token_string, host_url)
+        if claims is not None:
+            token = CachedToken.from_claims(claims)
+            hex_digest = token_hash(claims['jti'])
+            if revocation_feed.suspects(hex_digest):
+                generation = revocation_feed.generation
+                token.revoked = await self.jwt_revoked(claims['jti'])
+                if not token.revoked:
+                    revocation_feed.clear(hex_digest, generation)
+            return token
+        key = token_storage.key(token_string)
+        token = token_cache.get(key)
+        if token is not None:
+            hex_digest = key_hash(key)
+            if token.revoked or not revocation_feed.suspects(hex_digest):
+                return token
+            generation = revocation_feed.generation
+            token = await self.load_bearer_token(key)
+            if token is not None and not token.revoked:
+                revocation_feed.clear(hex_digest, generation)
+            return token
+        return await self.load_bearer_token(key)
+
+    async def jwt_revoked(self, jti):
+        async with self.session() as session:
+            revoked_at = (await session.execute(
+                select(OAuth2Token.access_token_revoked_at)
+                .where(token_storage.access_token_column == token_storage.key(jti)))).first()
+        return bool(revoked_at and revoked_at[0])
+
+    async def load_bearer_token(self, key):
+        async with self.session() as session:
+            row = (await session.execute(
+                select(OAuth2Token).options(joinedload(OAuth2Token.user))
+                .where(token_storage.access_token_column == key))).scalars().first()
+        if row is None:
+            return None
+        return token_cache.set_token(key, row, row.user)
+
+    async def find_user(self, email):
+        user = google_id_tokens.users.get(email)
+        if user is not None:
+            return user
+        async with self.session() as session:
+            row = (await session.execute(
+                select(User).where(User.username == email))).scalars().first()
+        if row is None:
+            return None
+        user = CachedUser(row.id, row.username)
+        google_id_tokens.users.set(email, user)
+        return user
+
+    # validation, as validate_bearer_token_1 and require_oauth
+
+    async def validate_bearer_token_1(self, headers, host_url):
+        token_value = bearer_token_value(headers.get('authorization'))
+        # tokens that recently failed both checks are rejected without any work
+        if google_id_tokens.is_rejected(token_value):
+            metrics.token_validated('unknown')
+            raise Unauthorized(description="Invalid or expired token.")
+        token = await self.resolve_bearer_token(token_value, host_url)
+
+        if token:
+            if is_token_expired(token):
+                metrics.token_validated('expired')
+                raise Unauthorized(description="Invalid or expired token.")
+            if token.is_revoked():
+                metrics.token_validated('revoked')
+                raise Unauthorized(description="Invalid or expired token.")
+            metrics.token_validated('valid')
+            user = token.user
+        else:
+            # may have to fetch Google's JWKS, which is a blocking request
+            user_info = await asyncio.to_thread(google_id_tokens.verify, token_value)
+            if not user_info:
+                google_id_tokens.reject(token_value)
+                metrics.token_validated('unknown')
+                raise Unauthorized(description="Invalid or expired token.")
+            metrics.token_validated('google_fallback')
+            user = await self.find_user(user_info['email'])
+
+        if not user:
+            raise Unauthorized(description="User not found.")
+
+        return token, user
+
+    async def acquire_token(self, headers, scopes, host_url):
+        request = SimpleNamespace(headers={'Authorization': headers.get('authorization')})
+        validator, token_string = require_oauth.parse_request_authorization(request)
+        token = await self.resolve_bearer_token(token_string, host_url)
+        validator.validate_token(token, scopes, request)
+        return token
+
+    # endpoints
+
+    async def api_me(self, headers, query, host_url):
+        try:
+            token = await self.acquire_token(headers, ['profile'], host_url)
+        except OAuth2Error as error:
+            return error.status_code, dict(error.get_body()), error.get_headers()
+        user = token.user
+        return 200, {'id': user.id, 'username': user.username}, []
+
+    async def api_data(self, headers, query, host_url):
+        try:
+            token, user = await self.validate_bearer_token_1(headers, host_url)
+        except Unauthorized as e:
+            return 401, {'error': str(e)}, []
+        return 200, {"message": "This is protected data", "user_id": user.id,
+                     "username": user.username}, []
+
+    async def api_pets(self, headers, query, host_url):
+        try:
+            token, user = await self.validate_bearer_token_1(headers, host_url)
+        except Unauthorized as e:
+            return 401, {'error': str(e)}, []
+        try:
+            limit = int(query.get('limit', ['100'])[0])
+        except ValueError:
+            limit = 100
+        return 200, {"pets": pets[:limit], "user": {"id": user.id, "username": user.username}}, []
+
+    async def healthz(self, headers, query, host_url):
+        return 200, {'status': 'ok'}, []
+
+    async def readyz(self, headers, query, host_url):
+        try:
+            await self.ping()
+        except Exception as e:
+            return 503, {'status': 'unavailable', 'error': f'{type(e).__name__}: {e}'}, []
+        return 200, {'status': 'ready'}, []
+
+
+def create_asgi_app(config=None):
+    """``create_app(config)`` for the settings and shared caches, served
+    through a ``ResourceServer``."""
+    return ResourceServer(create_app(config))
@@ -0,0 +1,846 @@
+# benchmark.py
+"""Load benchmark for the OAuth 2.0 server.
+
+Runs ``create_app`` in-process against a throwaway SQLite database (or the
+database given with ``--database``), seeds a client, users and tokens, then
+drives each scenario from ``--concurrency`` threads through Flask test
+clients. For every scenario it reports throughput, p50/p95/p99 latency and
+the number of SQL statements per request, and writes everything to a JSON
+file so runs on different commits can be compared::
+
+    $ python -m website.benchmark --concurrency 8 --requests 200
+    $ python -m website.benchmark --compare benchmark-results/<earlier>.json
+    $ python -m website.benchmark --check-statements
+    $ python -m website.benchmark --check-asgi --set JWT_ACCESS_TOKENS=true
+    $ python -m website.benchmark --check-refresh-race
+    $ python -m website.benchmark --token-storage 1000000
+
+Requests don't go through a network stack or gunicorn, so the numbers are
+the cost of the application and its database, not of the deployment.
+"""
+import argparse
+import base64
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import random
+import secrets
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlparse, parse_qs
+
+from authlib.common.security import generate_token
+from sqlalchemy import bindparam, event, insert, select, text
+from werkzeug.security import generate_password_hash
+
+CLIENT_ID = 'benchmark-client'
+CLIENT_SECRET = 'benchmark-secret'
+REDIRECT_URI = 'http://localhost/callback'
+PASSWORD = 'benchmark-password'
+SCOPE = 'profile'
+# concurrent refreshes of each token in the refresh_race scenario
+RACE_WIDTH = 4
+# SQL statements one request of each scenario runs with a cold token cache;
+# --check-statements fails when an endpoint no longer matches
+STATEMENT_COUNTS = {
+    'authorization_code': 3,
+    'password': 3,
+    'client_credentials': 1,
+    'refresh_token': 5,
+    'authorize': 2,
+    'consent_page': 1,
+    'remembered_consent': 2,
+    'new_home': 2,
+    'revoke': 4,
+    'api_me': 1,
+    'api_data': 1,
+    'api_pets': 1,
+    'metrics': 0,
+}
+
+
+def basic_auth(client_id=CLIENT_ID, client_secret=CLIENT_SECRET):
+    raw = f'{client_id}:{client_secret}'.encode()
+    return {'Authorization': 'Basic ' + base64.b64encode(raw).decode()}
+
+
+def bearer(token):
+    return {'Authorization': f'Bearer {token}'}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[k]
+
+
+class QueryCounter(object):
+    """Count SQL statements executed by the current thread, on any engine."""
+
+    def __init__(self, engines):
+        self._local = threading.local()
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args, **kwargs):
+        self._local.count = getattr(self._local, 'count', 0) + 1
+
+    def reset(self):
+        self._local.count = 0
+
+    @property
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+    @contextlib.contextmanager
+    def expect(self, statements, label='block'):
+        """Raise ``AssertionError`` unless the block runs exactly
+        ``statements`` SQL statements."""
+        self.reset()
+        yield
+        if self.count != statements:
+            raise AssertionError(
+                f'{label} ran {self.count} SQL statements, expected {statements}')
+
+
+class Benchmark(object):
+
+    def __init__(self, app, users=100, tokens=1000):
+        self.app = app
+        self.n_users = users
+        self.n_tokens = tokens
+        self.user_ids = []
+        self.usernames = []
+        self.access_tokens = []
+
+    def seed(self):
+        from .models import db, User, OAuth2Client, OAuth2Token
+        from .passwords import password_hasher
+        from .migrations import upgrade
+
+        now = int(time.time())
+        with self.app.app_context():
+            upgrade(db.engine)
+            # one hash shared by every user; hashing each would dominate seeding
+            pwhash = generate_password_hash(
+                PASSWORD, password_hasher.method, password_hasher.salt_length)
+            run = generate_token(6)
+            users = [User(username=f'bench-{run}-{i}', password_hash=pwhash)
+                     for i in range(self.n_users)]
+            db.session.add_all(users)
+            db.session.flush()
+
+            client = OAuth2Client.query.filter_by(client_id=CLIENT_ID).first()
+            if client is None:
+                client = OAuth2Client(
+                    client_id=CLIENT_ID,
+                    client_secret=CLIENT_SECRET,
+                    client_id_issued_at=now,
+                    user_id=users[0].id,
+                )
+                client.set_client_metadata({
+                    'client_name': 'benchmark',
+                    'grant_types': ['authorization_code', 'password',
+                                    'client_credentials', 'refresh_token'],
+                    'redirect_uris': [REDIRECT_URI],
+                    'response_types': ['code'],
+                    'scope': SCOPE,
+                    'token_endpoint_auth_method': 'client_secret_basic',
+                })
+                db.session.add(client)
+
+            tokens = []
+            for i in range(self.n_tokens):
+                user = users[i % len(users)]
+                tokens.append(self._token(OAuth2Token, user.id, now))
+            db.session.add_all(row for _, _, row in tokens)
+            db.session.commit()
+            self.user_ids = [u.id for u in users]
+            self.usernames = [u.username for u in users]
+            self.access_tokens = [access_token for access_token, _, _ in tokens]
+
+    def _token(self, model, user_id, now):
+        """``(access_token, refresh_token, row)``; the row holds them as
+        ``TOKEN_STORAGE`` says."""
+        from .token_storage import token_storage
+        access_token, refresh_token = generate_token(42), generate_token(48)
+        row = model(
+            client_id=CLIENT_ID,
+            user_id=user_id,
+            token_type='Bearer',
+            scope=SCOPE,
+            issued_at=now,
+            expires_in=3600,
+            **token_storage.columns({'access_token': access_token, 'refresh_token': refresh_token}),
+        )
+        return access_token, refresh_token, row
+
+    def fresh_tokens(self, n):
+        """Tokens for scenarios that use each one up (refresh, revoke)."""
+        from .models import db, OAuth2Token
+        now = int(time.time())
+        with self.app.app_context():
+            tokens = [self._token(OAuth2Token, self.user_ids[i % len(self.user_ids)], now)
+                      for i in range(n)]
+            db.session.add_all(row for _, _, row in tokens)
+            db.session.commit()
+            return [(access_token, refresh_token) for access_token, refresh_token, _ in tokens]
+
+    def authorize_query(self, code_verifier, **extra):
+        challenge = base64.urlsafe_b64encode(
+            hashlib.sha256(code_verifier.encode()).digest()).rstrip(b'=').decode()
+        return urlencode(dict({
+            'response_type': 'code',
+            'client_id': CLIENT_ID,
+            'redirect_uri': REDIRECT_URI,
+            'scope': SCOPE,
+            'state': generate_token(16),
+            'code_challenge': challenge,
+            'code_challenge_method': 'S256',
+        }, **extra))
+
+    def login(self, client, user_id):
+        with client.session_transaction() as session:
+            session['id'] = user_id
+
+    def authorization_codes(self, n):
+        client = self.app.test_client()
+        self.login(client, self.user_ids[0])
+        codes = []
+        for _ in range(n):
+            verifier = generate_token(48)
+            resp = client.post('/oauth/authorize?' + self.authorize_query(verifier),
+                               data={'confirm': 'yes'})
+            location = urlparse(resp.headers['Location'])
+            codes.append((parse_qs(location.query)['code'][0], verifier))
+        return codes
+
+    # Each scenario returns the list of requests to time, prepared up front
+    # so that setup work (codes, single-use tokens) stays out of the numbers.
+
+    def scenario_authorization_code(self, n):
+        return [dict(method='POST', path='/oauth/token', headers=basic_auth(), data={
+            'grant_type': 'authorization_code',
+            'code': code,
+            'redirect_uri': REDIRECT_URI,
+            'code_verifier': verifier,
+        }) for code, verifier in self.authorization_codes(n)]
+
+    def scenario_password(self, n):
+        return [dict(method='POST', path='/oauth/token', headers=basic_auth(), data={
+            'grant_type': 'password',
+            'username': self.usernames[i % len(self.usernames)],
+            'password': PASSWORD,
+            'scope': SCOPE,
+        }) for i in range(n)]
+
+    def scenario_client_credentials(self, n):
+        return [dict(method='POST', path='/oauth/token', headers=basic_auth(), data={
+            'grant_type': 'client_credentials',
+            'scope': SCOPE,
+        }) for _ in range(n)]
+
+    def scenario_refresh_token(self, n):
+        return [dict(method='POST', path='/oauth/token', headers=basic_auth(), data={
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token,
+        }) for _, refresh_token in self.fresh_tokens(n)]
+
+    def scenario_refresh_race(self, n):
+        # RACE_WIDTH copies of each refresh, sent back to back so that they
+        # are in flight together when --concurrency is at least RACE_WIDTH
+        tokens = self.fresh_tokens(max(1, n // RACE_WIDTH))
+        return [dict(method='POST', path='/oauth/token', headers=basic_auth(), data={
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token,
+        }, expect=(200, 400)) for _, refresh_token in tokens for _ in range(RACE_WIDTH)]
+
+    def check_refresh_race(self, results):
+        """Exactly one refresh of each token may succeed, and the refresh
+        token it got must still be active after the others were rejected:
+        losing a race is not reuse. A race with any other outcome counts as
+        errors."""
+        from .models import OAuth2Token
+        from .token_storage import token_storage
+        checked = []
+        with self.app.app_context():
+            for i in range(0, len(results), RACE_WIDTH):
+                race = results[i:i + RACE_WIDTH]
+                winners = [r[4] for r in race if r[2] == 200]
+                won = len(winners) == 1
+                if won:
+                    token = OAuth2Token.query.filter(
+                        token_storage.refresh_token_is(winners[0]['refresh_token'])).first()
+                    won = token is not None and not token.refresh_token_revoked_at
+                checked.extend((elapsed, queries, status, ok and won)
+                               for elapsed, queries, status, ok, _ in race)
+        return checked
+
+    def scenario_authorize(self, n):
+        return [dict(method='POST', path='/oauth/authorize?' + self.authorize_query(generate_token(48)),
+                     data={'confirm': 'yes'}, expect=302) for _ in range(n)]
+
+    def scenario_consent_page(self, n):
+        return [dict(method='GET', path='/oauth/authorize?' + self.authorize_query(
+            generate_token(48), prompt='consent')) for _ in range(n)]
+
+    def scenario_remembered_consent(self, n):
+        # approve once, then every GET issues a code without the page
+        self.authorization_codes(1)
+        return [dict(method='GET', path='/oauth/authorize?' + self.authorize_query(generate_token(48)),
+                     expect=302) for _ in range(n)]
+
+    def scenario_new_home(self, n):
+        return [dict(method='GET', path='/new_home') for _ in range(n)]
+
+    def scenario_revoke(self, n):
+        return [dict(method='POST', path='/oauth/revoke', headers=basic_auth(), data={
+            'token': access_token,
+            'token_type_hint': 'access_token',
+        }) for access_token, _ in self.fresh_tokens(n)]
+
+    def _resource(self, path, n):
+        tokens = self.access_tokens
+        return [dict(method='GET', path=path, headers=bearer(tokens[i % len(tokens)]))
+                for i in range(n)]
+
+    def scenario_api_me(self, n):
+        return self._resource('/api/me', n)
+
+    def scenario_api_data(self, n):
+        return self._resource('/api/data', n)
+
+    def scenario_api_pets(self, n):
+        return self._resource('/api/pets', n)
+
+    def scenario_metrics(self, n):
+        return [dict(method='GET', path='/metrics') for _ in range(n)]
+
+    def check_statements(self, counter):
+        """Send one request of each scenario in ``STATEMENT_COUNTS`` and
+        return a message for each that ran a different number of SQL
+        statements."""
+        from .client_cache import client_registry
+        from .token_cache import token_cache
+        client = self.app.test_client()
+        self.login(client, self.user_ids[0])
+        failures = []
+        for name, statements in STATEMENT_COUNTS.items():
+            req = getattr(self, 'scenario_' + name)(1)[0]
+            req.pop('expect', None)
+            token_cache.clear()
+            with self.app.app_context():
+                # the client is cached in production, keep its load out
+                client_registry.query_client(CLIENT_ID)
+            try:
+                with counter.expect(statements, name):
+                    client.open(req.pop('path'), **req)
+            except AssertionError as e:
+                failures.append(str(e))
+        return failures
+
+    def check_asgi(self, server):
+        """Send the same requests to the Flask routes and to the async
+        resource server (website/asgi.py) and return ``(checked,
+        failures)``, a message for each response that differs. One of the
+        bearer tokens is issued by the token endpoint, so it is a JWT when
+        JWT_ACCESS_TOKENS is on, and it has to be accepted by both."""
+        import asyncio
+        from .token_cache import token_cache
+        client = self.app.test_client()
+        resp = client.post('/oauth/token', headers=basic_auth(), data={
+            'grant_type': 'password',
+            'username': self.usernames[0],
+            'password': PASSWORD,
+            'scope': SCOPE,
+        })
+        issued = resp.get_json()['access_token']
+        cases = [
+            ('issued', bearer(issued)),
+            ('stored', bearer(self.access_tokens[0])),
+            ('unknown', bearer(generate_token(42))),
+            ('three parts', bearer('a.b.c')),
+            ('basic', basic_auth()),
+            ('none', {}),
+        ]
+        paths = ['/api/me', '/api/data', '/api/pets?limit=2']
+
+        async def call(path, headers):
+            path, _, query = path.partition('?')
+            scope = {
+                'type': 'http',
+                'scheme': 'http',
+                'method': 'GET',
+                'path': path,
+                'query_string': query.encode(),
+                'headers': [(k.lower().encode(), v.encode())
+                            for k, v in dict(headers, Host='localhost').items()],
+            }
+            response = {}
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+            async def respond(message):
+                if message['type'] == 'http.response.start':
+                    response['status'] = message['status']
+                    response['headers'] = dict(message['headers'])
+                else:
+                    response['body'] = message['body']
+
+            await server(scope, receive, respond)
+            www = response['headers'].get(b'www-authenticate')
+            return response['status'], json.loads(response['body']), www.decode() if www else None
+
+        async def run():
+            failures = []
+            try:
+                for path in paths:
+                    for label, headers in cases:
+                        token_cache.clear()
+                        resp = client.get(path, headers=headers)
+                        flask = (resp.status_code, resp.get_json(),
+                                 resp.headers.get('WWW-Authenticate'))
+                        token_cache.clear()
+                        asgi = await call(path, headers)
+                        if asgi != flask:
+                            failures.append(f'{path} with {label} token: flask {flask}, asgi {asgi}')
+                        elif label == 'issued' and asgi[0] != 200:
+                            failures.append(f'{path} rejected the issued token: {asgi}')
+            finally:
+                await server.engine.dispose()
+            return failures
+
+        return len(paths) * len(cases), asyncio.run(run())
+
+    def run_scenario(self, name, n, concurrency, counter):
+        requests = getattr(self, 'scenario_' + name)(n)
+        local = threading.local()
+
+        def send(req):
+            client = getattr(local, 'client', None)
+            if client is None:
+                client = local.client = self.app.test_client()
+                self.login(client, self.user_ids[0])
+            expect = req.pop('expect', 200)
+            counter.reset()
+            started = time.perf_counter()
+            resp = client.open(req.pop('path'), **req)
+            elapsed = time.perf_counter() - started
+            if not isinstance(expect, tuple):
+                expect = (expect,)
+            return (elapsed, counter.count, resp.status_code, resp.status_code in expect,
+                    resp.get_json(silent=True))
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(send, requests))
+        wall = time.perf_counter() - started
+        check = getattr(self, 'check_' + name, None)
+        if check is not None:
+            results = check(results)
+        return summarize(name, results, wall, concurrency)
+
+    def run_asgi_scenario(self, name, n, concurrency, counter, server):
+        """Send the requests of ``run_scenario`` to the async resource server
+        (website/asgi.py), ``concurrency`` at a time on one event loop."""
+        import asyncio
+        requests = getattr(self, 'scenario_' + name)(n)
+
+        async def send(req):
+            path, _, query = req['path'].partition('?')
+            scope = {
+                'type': 'http',
+                'method': req['method'],
+                'path': path,
+                'query_string': query.encode(),
+                'headers': [(k.lower().encode(), v.encode())
+                            for k, v in req.get('headers', {}).items()],
+            }
+            statuses = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+            async def respond(message):
+                if message['type'] == 'http.response.start':
+                    statuses.append(message['status'])
+
+            started = time.perf_counter()
+            await server(scope, receive, respond)
+            return time.perf_counter() - started, statuses[0], req.get('expect', 200)
+
+        async def run():
+            slots = asyncio.Semaphore(concurrency)
+
+            async def limited(req):
+                async with slots:
+                    return await send(req)
+            try:
+                return await asyncio.gather(*(limited(req) for req in requests))
+            finally:
+                # pooled connections belong to this event loop
+                await server.engine.dispose()
+
+        counter.reset()
+        started = time.perf_counter()
+        timings = asyncio.run(run())
+        wall = time.perf_counter() - started
+        # statements of interleaved requests can't be told apart, so every
+        # request is given the mean
+        queries = counter.count / n if n else 0
+        results = [(elapsed, queries, status, status == expect)
+                   for elapsed, status, expect in timings]
+        return summarize(name + ' (asgi)', results, wall, concurrency)
+
+
+def summarize(name, results, wall, concurrency):
+    latencies = sorted(r[0] * 1000 for r in results)
+    queries = [r[1] for r in results]
+    statuses = {}
+    for r in results:
+        statuses[str(r[2])] = statuses.get(str(r[2]), 0) + 1
+    n = len(results)
+    return {
+        'scenario': name,
+        'requests': n,
+        'concurrency': concurrency,
+        'errors': sum(1 for r in results if not r[3]),
+        'statuses': statuses,
+        'wall_seconds': round(wall, 4),
+        'throughput_rps': round(n / wall, 2) if wall else 0.0,
+        'latency_ms': {
+            'mean': round(sum(latencies) / n, 3) if n else 0.0,
+            'p50': round(percentile(latencies, 50), 3),
+            'p95': round(percentile(latencies, 95), 3),
+            'p99': round(percentile(latencies, 99), 3),
+            'max': round(latencies[-1], 3) if n else 0.0,
+        },
+        'queries_per_request': {
+            'mean': round(sum(queries) / n, 2) if n else 0.0,
+            'max': max(queries) if n else 0,
+        },
+    }
+
+
+SCENARIOS = [
+    'authorization_code', 'password', 'client_credentials', 'refresh_token',
+    'refresh_race', 'authorize', 'consent_page', 'remembered_consent', 'new_home', 'revoke', 'api_me', 'api_data', 'api_pets', 'metrics',
+]
+# the endpoints website/asgi.py serves
+ASGI_SCENARIOS = ['api_me', 'api_data', 'api_pets']
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_overrides(values):
+    config = {}
+    for item in values or []:
+        key, _, raw = item.partition('=')
+        try:
+            config[key] = json.loads(raw)
+        except ValueError:
+            config[key] = raw
+    return config
+
+
+def print_report(report, baseline=None):
+    before = {}
+    if baseline:
+        before = {r['scenario']: r for r in baseline['results']}
+    print(f"commit {report['commit']}, concurrency {report['concurrency']}, "
+          f"{report['database']}")
+    print(f"{'scenario':<20}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}"
+          f"{'queries':>9}{'errors':>8}")
+    for r in report['results']:
+        lat = r['latency_ms']
+        line = (f"{r['scenario']:<20}{r['throughput_rps']:>9.1f}{lat['p50']:>9.2f}"
+                f"{lat['p95']:>9.2f}{lat['p99']:>9.2f}"
+                f"{r['queries_per_request']['mean']:>9.2f}{r['errors']:>8}")
+        old = before.get(r['scenario'])
+        if old and old['throughput_rps']:
+            change = r['throughput_rps'] / old['throughput_rps'] - 1
+            line += f"   {change:+.1%} req/s vs {baseline.get('commit')}"
+        print(line)
+
+
+STORAGE_MODES = ['plain', 'dual', 'hashed']
+
+
+def token_storage_benchmark(rows, workdir, config, lookups=5000):
+    """Size of the token table and its indexes, and the latency of token
+    lookups, with ``rows`` tokens stored by each ``TOKEN_STORAGE`` mode.
+
+    Lookups run the statements ``load_bearer_token`` and
+    ``authenticate_refresh_token`` filter with, digest included, on one
+    connection; sizes come from SQLite's ``dbstat`` table.
+    """
+    from .app import create_app
+    from .models import db, OAuth2Token
+    from .token_storage import token_storage
+
+    results = []
+    for mode in STORAGE_MODES:
+        path = os.path.join(workdir, f'storage-{mode}.db')
+        app = create_app(dict(config, SQLALCHEMY_DATABASE_URI='sqlite:///' + path,
+                              TOKEN_STORAGE=mode))
+        now = int(time.time())
+        sample = []
+        rng = random.Random(0)
+        with app.app_context():
+            started = time.perf_counter()
+            for offset in range(0, rows, 10000):
+                batch = []
+                for i in range(offset, min(rows, offset + 10000)):
+                    access_token, refresh_token = secrets.token_urlsafe(31), secrets.token_urlsafe(36)
+                    if rng.random() * rows < lookups:
+                        sample.append((access_token, refresh_token))
+                    batch.append(dict(
+                        client_id=CLIENT_ID, user_id=i % 1000 + 1, token_type='Bearer',
+                        scope=SCOPE, issued_at=now, expires_in=3600,
+                        refresh_token_expires_at=now + 7200, family_id=f'bench-{i}',
+                        **token_storage.columns({'access_token': access_token,
+                                                 'refresh_token': refresh_token})))
+                db.session.execute(insert(OAuth2Token.__table__), batch)
+                db.session.commit()
+            load_seconds = time.perf_counter() - started
+
+            with db.engine.connect() as conn:
+                conn.exec_driver_sql('ANALYZE')
+                sizes = dict(conn.execute(text(
+                    'SELECT d.name, SUM(d.pgsize) FROM dbstat d JOIN sqlite_master m '
+                    "ON m.name = d.name WHERE m.tbl_name = 'oauth2_token' "
+                    'GROUP BY d.name')).all())
+                by_access = select(OAuth2Token.id).where(
+                    token_storage.access_token_column == bindparam('key'))
+                by_refresh = select(OAuth2Token.id).where(
+                    token_storage.refresh_token_column == bindparam('key'),
+                    OAuth2Token.refresh_token_active(now))
+                lookups_ms = {}
+                for name, statement, values in (
+                        ('access_token', by_access, [a for a, _ in sample]),
+                        ('refresh_token', by_refresh, [r for _, r in sample]),
+                        ('unknown', by_access, [secrets.token_urlsafe(31) for _ in sample])):
+                    timings = []
+                    for secret in values:
+                        t0 = time.perf_counter()
+                        conn.execute(statement, {'key': token_storage.key(secret)}).first()
+                        timings.append((time.perf_counter() - t0) * 1000)
+                    timings.sort()
+                    lookups_ms[name] = {
+                        'p50': round(percentile(timings, 50), 4),
+                        'p99': round(percentile(timings, 99), 4),
+                    }
+        results.append({
+            'mode': mode,
+            'rows': rows,
+            'load_seconds': round(load_seconds, 2),
+            'file_bytes': os.path.getsize(path),
+            'sizes': sizes,
+            'lookups': len(sample),
+            'lookup_ms': lookups_ms,
+        })
+        os.remove(path)
+    return results
+
+
+def print_storage_report(results):
+    print(f"{results[0]['rows']} tokens per mode, {results[0]['lookups']} lookups each")
+    names = sorted({name for r in results for name in r['sizes']})
+    print(f"{'':<42}" + ''.join(f"{r['mode']:>12}" for r in results))
+    for name in names:
+        print(f'{name:<42}' + ''.join(
+            f"{r['sizes'].get(name, 0) / 2 ** 20:>10.1f}MB" for r in results))
+    print(f"{'database file':<42}" + ''.join(
+        f"{r['file_bytes'] / 2 ** 20:>10.1f}MB" for r in results))
+    for kind in ('access_token', 'refresh_token', 'unknown'):
+        for p in ('p50', 'p99'):
+            print(f'{kind + " lookup " + p:<42}' + ''.join(
+                f"{r['lookup_ms'][kind][p] * 1000:>10.1f}us" for r in results))
+    print(f"{'load':<42}" + ''.join(f"{r['load_seconds']:>11.1f}s" for r in results))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--database', help='SQLAlchemy URL; defaults to a temporary SQLite file.')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='Requests per scenario.')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='Comma separated, from: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--replica', action='store_true',
+                        help='Read through a copy of the SQLite database as a replica.')
+    parser.add_argument('--asgi', action='store_true',
+                        help='Also run the api_* scenarios on the async resource server.')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--tokens', type=int, default=1000)
+    parser.add_argument('--set', action='append', metavar='KEY=VALUE',
+                        help='Override an app setting, VALUE parsed as JSON when possible.')
+    parser.add_argument('--output', help='JSON file to write, defaults to benchmark-results/.')
+    parser.add_argument('--compare', help='Earlier JSON result to compare throughput against.')
+    parser.add_argument('--quiet', action='store_true', help="Silence the app's prints and warnings.")
+    parser.add_argument('--check-statements', action='store_true',
+                        help='Only check SQL statements per request against STATEMENT_COUNTS.')
+    parser.add_argument('--check-asgi', action='store_true',
+                        help='Only check that the async resource server answers as the Flask app.')
+    parser.add_argument('--check-refresh-race', action='store_true',
+                        help='Only run the refresh_race scenario and fail on any race '
+                             'without exactly one surviving winner.')
+    parser.add_argument('--token-storage', type=int, metavar='ROWS',
+                        help='Only compare index sizes and lookup latency of the '
+                             'TOKEN_STORAGE modes with ROWS tokens (SQLite).')
+    args = parser.parse_args(argv)
+    if args.quiet:
+        warnings.simplefilter('ignore')
+
+    workdir = tempfile.mkdtemp(prefix='oauth2-benchmark-')
+    os.environ.setdefault('AUTHLIB_INSECURE_TRANSPORT', '1')
+    # issue_token and the request log write into the volume directory
+    os.environ['RAILWAY_VOLUME_MOUNT_PATH'] = workdir
+    database = args.database or 'sqlite:///' + os.path.join(workdir, 'benchmark.db')
+    config = {
+        'SQLALCHEMY_DATABASE_URI': database,
+        'SECRET_KEY': 'benchmark',
+        # as app.py: refreshes rotate the refresh token
+        'OAUTH2_REFRESH_TOKEN_GENERATOR': True,
+    }
+    replica_path = os.path.join(workdir, 'replica.db')
+    if args.replica:
+        if args.database:
+            parser.error('--replica only works with the default SQLite database')
+        config['SQLALCHEMY_REPLICA_URIS'] = ['sqlite:///' + replica_path]
+    config.update(parse_overrides(args.set))
+
+    if args.token_storage:
+        if args.database:
+            parser.error('--token-storage measures SQLite databases of its own')
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull) if args.quiet else contextlib.nullcontext():
+                results = token_storage_benchmark(args.token_storage, workdir, config)
+        print_storage_report(results)
+        output = args.output
+        if not output:
+            os.makedirs('benchmark-results', exist_ok=True)
+            stamp = time.strftime('%Y%m%d-%H%M%S')
+            output = os.path.join('benchmark-results', f"{stamp}-storage-{git_commit() or 'nogit'}.json")
+        with open(output, 'w') as f:
+            json.dump({'commit': git_commit(), 'token_storage': results}, f, indent=2)
+        print(f'written to {output}')
+        return 0
+
+    from .app import create_app
+    from .models import db
+    app = create_app(config)
+
+    bench = Benchmark(app, users=args.users, tokens=args.tokens)
+    bench.seed()
+    if args.replica:
+        # the replica engine connects lazily, so the copy only needs to exist
+        # before the first request
+        shutil.copy(os.path.join(workdir, 'benchmark.db'), replica_path)
+    engines = []
+    with app.app_context():
+        engines.extend(db.engines.values())
+    server = None
+    if args.asgi or args.check_asgi:
+        from .asgi import ResourceServer
+        from .token_cache import token_cache
+        server = ResourceServer(app)
+        engines.append(server.engine.sync_engine)
+    counter = QueryCounter(engines)
+
+    if args.check_statements:
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull) if args.quiet else contextlib.nullcontext():
+                failures = bench.check_statements(counter)
+        for failure in failures:
+            print(failure)
+        print(f'{len(STATEMENT_COUNTS) - len(failures)}/{len(STATEMENT_COUNTS)} endpoints '
+              'match STATEMENT_COUNTS')
+        return 1 if failures else 0
+
+    if args.check_asgi:
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull) if args.quiet else contextlib.nullcontext():
+                checked, failures = bench.check_asgi(server)
+        for failure in failures:
+            print(failure)
+        print(f'{checked - len(failures)}/{checked} responses of the async resource server '
+              'match the Flask app')
+        return 1 if failures else 0
+
+    if args.check_refresh_race:
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull) if args.quiet else contextlib.nullcontext():
+                result = bench.run_scenario('refresh_race', args.requests,
+                                            max(args.concurrency, RACE_WIDTH), counter)
+        print(f"{result['errors']}/{result['requests']} refresh_race requests failed the check")
+        return 1 if result['errors'] else 0
+
+    stdout = sys.stdout
+    results = []
+    for name in [s.strip() for s in args.scenarios.split(',') if s.strip()]:
+        if name not in SCENARIOS:
+            parser.error(f'unknown scenario {name}')
+        if args.quiet:
+            sys.stdout = open(os.devnull, 'w')
+        try:
+            if server is not None and name in ASGI_SCENARIOS:
+                # both runs start with a cold token cache
+                token_cache.clear()
+            results.append(bench.run_scenario(name, args.requests, args.concurrency, counter))
+            if server is not None and name in ASGI_SCENARIOS:
+                token_cache.clear()
+                results.append(bench.run_asgi_scenario(
+                    name, args.requests, args.concurrency, counter, server))
+        finally:
+            if args.quiet:
+                sys.stdout.close()
+                sys.stdout = stdout
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'database': database.split('://')[0] + (' + replica' if args.replica else ''),
+        'concurrency': args.concurrency,
+        'requests': args.requests,
+        'overrides': parse_overrides(args.set),
+        'results': results,
+    }
+    output = args.output
+    if not output:
+        os.makedirs('benchmark-results', exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        output = os.path.join('benchmark-results', f"{stamp}-{report['commit'] or 'nogit'}.json")
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    print(f'written to {output}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+# cache_sync.py
+"""Keeps the per-process caches of every worker in step with the database.
+
+Clients, consents and bearer token validations are cached in each worker
+(and a ``flask`` command runs in a process of its own), so a change made
+in one process has to be announced to the others:
+
+- revoked access tokens through the revocation feed: every worker folds
+  ``oauth2_token_revocation`` into a Bloom filter of its own, and a cached
+  validation or a JWT the filter matches is checked against the primary
+  again (revocations.py);
+- everything else through ``oauth2_cache_invalidation``, ``(cache, key)``
+  rows written in the transaction that makes the change and handed to the
+  callback subscribed for ``cache``.
+
+A daemon thread per worker polls both every ``CACHE_SYNC_INTERVAL``
+seconds, so a change is seen everywhere within about that long instead of
+once the cache TTLs run out. ``0`` turns the thread off, leaving the TTLs.
+"""
+import os
+import threading
+import time
+from sqlalchemy import func, insert, or_
+from .models import db, CacheInvalidation
+
+
+class LogReader(object):
+    """Follows an append-only table by its ``id``.
+
+    Ids are handed out when rows are inserted but the rows only become
+    visible when their transaction commits, so a row may show up behind
+    ids already read. Ids skipped over are asked for again on later reads
+    for ``gap_timeout`` seconds; inserts that were rolled back leave gaps
+    for good.
+    """
+
+    def __init__(self, model, page_size=1000, gap_timeout=600, max_gaps=10000):
+        self.model = model
+        self.page_size = page_size
+        self.gap_timeout = gap_timeout
+        self.max_gaps = max_gaps
+        self.cursor = None
+        self.gaps = {}
+
+    def start(self, cursor=None, lookback=1000):
+        """Read on from ``cursor``, or from the latest id. The ``lookback``
+        ids before it are read again, for transactions still in flight."""
+        if cursor is None:
+            cursor = db.session.query(func.max(self.model.id)).scalar() or 0
+        self.cursor = max(0, cursor - lookback)
+        self.gaps = {}
+
+    def read(self, *columns):
+        """The rows committed since the last read, as ``(id, *columns)``."""
+        model = self.model
+        now = time.monotonic()
+        for id_, skipped_at in list(self.gaps.items()):
+            if now - skipped_at > self.gap_timeout:
+                del self.gaps[id_]
+        rows = []
+        while True:
+            criteria = model.id > self.cursor
+            if self.gaps:
+                criteria = or_(criteria, model.id.in_(list(self.gaps)))
+            page = db.session.query(model.id, *columns).filter(criteria) \
+                .order_by(model.id).limit(self.page_size).all()
+            for row in page:
+                if row[0] > self.cursor:
+                    for missing in range(self.cursor + 1, min(row[0], self.cursor + 1 + self.max_gaps)):
+                        self.gaps[missing] = now
+                    self.cursor = row[0]
+                self.gaps.pop(row[0], None)
+            rows.extend(page)
+            if len(page) < self.page_size:
+                break
+        while len(self.gaps) > self.max_gaps:
+            del self.gaps[min(self.gaps)]
+        return rows
+
+
+class CacheSync(object):
+
+    def __init__(self, app=None):
+        self.interval = 1
+        self.app = None
+        self.polls = 0
+        self.errors = 0
+        self.log = LogReader(CacheInvalidation)
+        self._subscribers = {}
+        self._pollers = []
+        self._started = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.interval = app.config.get('CACHE_SYNC_INTERVAL', self.interval)
+        self.app = app
+        self.log.cursor = None
+        app.before_request(self.ensure_started)
+
+    @property
+    def enabled(self):
+        return bool(self.interval)
+
+    def subscribe(self, cache, invalidate):
+        """Call ``invalidate(key)`` for each ``key`` of ``cache`` logged by
+        ``record``; keys come back as strings."""
+        self._subscribers[cache] = invalidate
+
+    def add_poller(self, poll):
+        """Call ``poll()`` in the app context of every round as well."""
+        if poll not in self._pollers:
+            self._pollers.append(poll)
+
+    def record(self, cache, keys, now=None, connection=None):
+        """Log ``keys`` of ``cache`` as changed in the current transaction,
+        of the session or of ``connection``; the caller commits."""
+        if not self.enabled:
+            return
+        now = now or int(time.time())
+        rows = [{'cache': cache, 'key': str(key), 'created_at': now} for key in keys]
+        if rows:
+            (connection or db.session).execute(insert(CacheInvalidation), rows)
+
+    def poll(self):
+        for poll in self._pollers:
+            poll()
+        if self.log.cursor is None:
+            self.log.start()
+        for _, cache, key in self.log.read(CacheInvalidation.cache, CacheInvalidation.key):
+            invalidate = self._subscribers.get(cache)
+            if invalidate is not None:
+                invalidate(key)
+        self.polls += 1
+
+    def ensure_started(self):
+        """Start this process's polling thread; called by every request,
+        so workers forked from a preloaded app get their own."""
+        pid = os.getpid()
+        if not self.enabled or self.app is None or pid in self._started:
+            return
+        with self._lock:
+            if pid not in self._started:
+                self._started[pid] = threading.Thread(
+                    target=self._run, name='cache-sync', daemon=True)
+                self._started[pid].start()
+
+    def _run(self):
+        # a forked worker must not carry on from its parent's cursors
+        self.log.cursor = None
+        while True:
+            with self.app.app_context():
+                try:
+                    self.poll()
+                except Exception as e:
+                    self.errors += 1
+                    db.session.rollback()
+                    print(f'Error polling cache invalidations: {e}')
+                finally:
+                    db.session.remove()
+            time.sleep(self.interval)
+
+
+cache_sync = CacheSync()
@@ -0,0 +1,178 @@
+# client_cache.py
+import secrets
+from types import MappingProxyType
+from authlib.common.encoding import json_loads
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+from authlib.oauth2.rfc6749 import ClientMixin
+from authlib.oauth2.rfc6749.util import scope_to_list, list_to_scope
+from .models import OAuth2Client
+from .token_cache import TokenCache
+from .db_routing import read_replica, replica_router, RoutingSession
+from .cache_sync import cache_sync
+
+
+class CachedClient(ClientMixin):
+    """Read-only, fully parsed copy of an ``OAuth2Client`` row.
+
+    ``client_metadata`` is decoded once when the client is loaded, and the
+    lists the grants check against are turned into tuples/frozensets, so the
+    redirect, grant, response type and scope checks are plain lookups.
+    """
+    __slots__ = (
+        'id', 'user_id', 'client_id', 'client_secret', 'client_id_issued_at',
+        'client_secret_expires_at', 'client_metadata', 'redirect_uris',
+        'grant_types', 'response_types', 'scope', 'token_endpoint_auth_method',
+        '_grant_types', '_response_types', '_scopes',
+    )
+
+    def __init__(self, client):
+        # parse the column itself; the mixin memoizes client_metadata on the
+        # instance, which can be stale within the session that changed it
+        metadata = json_loads(client._client_metadata) if client._client_metadata else {}
+        set_ = object.__setattr__
+        set_(self, 'id', client.id)
+        set_(self, 'user_id', client.user_id)
+        set_(self, 'client_id', client.client_id)
+        set_(self, 'client_secret', client.client_secret)
+        set_(self, 'client_id_issued_at', client.client_id_issued_at)
+        set_(self, 'client_secret_expires_at', client.client_secret_expires_at)
+        set_(self, 'client_metadata', MappingProxyType(metadata))
+        set_(self, 'redirect_uris', tuple(metadata.get('redirect_uris', [])))
+        set_(self, 'grant_types', tuple(metadata.get('grant_types', [])))
+        set_(self, 'response_types', tuple(metadata.get('response_types', [])))
+        set_(self, 'scope', metadata.get('scope', ''))
+        set_(self, 'token_endpoint_auth_method', metadata.get(
+            'token_endpoint_auth_method', 'client_secret_basic'))
+        set_(self, '_grant_types', frozenset(self.grant_types))
+        set_(self, '_response_types', frozenset(self.response_types))
+        set_(self, '_scopes', frozenset(self.scope.split()))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('CachedClient is read-only')
+
+    @property
+    def client_info(self):
+        return dict(
+            client_id=self.client_id,
+            client_secret=self.client_secret,
+            client_id_issued_at=self.client_id_issued_at,
+            client_secret_expires_at=self.client_secret_expires_at,
+        )
+
+    @property
+    def client_name(self):
+        return self.client_metadata.get('client_name')
+
+    @property
+    def client_uri(self):
+        return self.client_metadata.get('client_uri')
+
+    def get_client_id(self):
+        return self.client_id
+
+    def get_default_redirect_uri(self):
+        if self.redirect_uris:
+            return self.redirect_uris[0]
+
+    def get_allowed_scope(self, scope):
+        if not scope:
+            return ''
+        return list_to_scope([s for s in scope_to_list(scope) if s in self._scopes])
+
+    def check_redirect_uri(self, redirect_uri):
+        return redirect_uri in self.redirect_uris
+
+    def check_client_secret(self, client_secret):
+        return secrets.compare_digest(self.client_secret, client_secret)
+
+    def check_endpoint_auth_method(self, method, endpoint):
+        if endpoint == 'token':
+            return self.token_endpoint_auth_method == method
+        return True
+
+    def check_response_type(self, response_type):
+        return response_type in self._response_types
+
+    def check_grant_type(self, grant_type):
+        return grant_type in self._grant_types
+
+
+class ClientRegistry(object):
+    """``query_client`` backed by a TTL/LRU cache of ``CachedClient``.
+
+    Inserts, updates and deletes of ``OAuth2Client`` rows made through the
+    ORM drop the cached entry in this process when the session commits, and
+    are logged for cache_sync in the same transaction, so other workers drop
+    it within about ``CACHE_SYNC_INTERVAL`` seconds (``CLIENT_CACHE_TTL``
+    when that is off). A lookup that read the row before an invalidation
+    doesn't cache what it read. client_ids that matched no
+    row are remembered for ``CLIENT_NEGATIVE_CACHE_TTL`` seconds, so made-up
+    ones don't cost a query per request.
+    """
+
+    def __init__(self, app=None):
+        self.cache = TokenCache(maxsize=1000, ttl=300)
+        self.unknown = TokenCache(maxsize=10000, ttl=10)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.cache = TokenCache(
+            maxsize=app.config.get('CLIENT_CACHE_SIZE', 1000),
+            ttl=app.config.get('CLIENT_CACHE_TTL', 300),
+        )
+        self.unknown = TokenCache(
+            maxsize=app.config.get('CLIENT_NEGATIVE_CACHE_SIZE', 10000),
+            ttl=app.config.get('CLIENT_NEGATIVE_CACHE_TTL', 10),
+        )
+
+    def query_client(self, client_id):
+        client = self.cache.get(client_id)
+        if client is not None:
+            return client
+        if self.unknown.get(client_id) is not None:
+            return None
+        generations = self.cache.generation, self.unknown.generation
+        client = load_client(client_id)
+        if client is not None:
+            self.cache.set(client_id, client, generation=generations[0])
+        else:
+            self.unknown.set(client_id, True, generation=generations[1])
+        return client
+
+    def invalidate(self, client_id):
+        self.cache.invalidate(client_id)
+        self.unknown.invalidate(client_id)
+
+
+@read_replica(sticky=True)
+def load_client(client_id):
+    client = OAuth2Client.query.filter_by(client_id=client_id).first()
+    return CachedClient(client) if client is not None else None
+
+
+client_registry = ClientRegistry()
+cache_sync.subscribe('client', client_registry.invalidate)
+
+
+@event.listens_for(OAuth2Client, 'after_insert')
+@event.listens_for(OAuth2Client, 'after_update')
+@event.listens_for(OAuth2Client, 'after_delete')
+def _client_changed(mapper, connection, target):
+    # a lookup between the flush and the commit would still read the old
+    # row, so the cache is only dropped once the change is visible
+    object_session(target).info.setdefault('changed_clients', set()).add(target.client_id)
+    cache_sync.record('client', [target.client_id], connection=connection)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _invalidate_changed_clients(session):
+    for client_id in session.info.pop('changed_clients', ()):
+        client_registry.invalidate(client_id)
+        replica_router.wrote(client_id)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _forget_changed_clients(session):
+    session.info.pop('changed_clients', None)
@@ -0,0 +1,254 @@
+# code_store.py
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from authlib.oauth2.rfc6749 import AuthorizationCodeMixin
+from sqlalchemy import delete, select
+
+FIELDS = (
+    'code', 'client_id', 'redirect_uri', 'response_type', 'scope', 'nonce',
+    'auth_time', 'code_challenge', 'code_challenge_method', 'user_id',
+)
+
+
+class AuthorizationCode(AuthorizationCodeMixin):
+    """An authorization code as handed out by a code store.
+
+    Carries the same fields as ``OAuth2AuthorizationCode`` (PKCE challenge
+    included) plus ``expires_at``, and turns into a plain dict for the
+    stores that keep it outside the database.
+    """
+    __slots__ = FIELDS + ('expires_at',)
+
+    def __init__(self, expires_at=None, **kwargs):
+        for name in FIELDS:
+            setattr(self, name, kwargs.get(name))
+        if self.auth_time is None:
+            self.auth_time = int(time.time())
+        self.expires_at = expires_at
+
+    def to_dict(self):
+        data = {name: getattr(self, name) for name in FIELDS}
+        data['expires_at'] = self.expires_at
+        return data
+
+    def is_expired(self):
+        return self.expires_at is not None and self.expires_at < time.time()
+
+    def get_redirect_uri(self):
+        return self.redirect_uri
+
+    def get_scope(self):
+        return self.scope
+
+    def get_auth_time(self):
+        return self.auth_time
+
+    def get_nonce(self):
+        return self.nonce
+
+
+class SQLCodeStore(object):
+    """Codes in the ``oauth2_code`` table, the default.
+
+    Redeeming is one ``DELETE ... RETURNING`` where the database supports
+    it, so two requests racing with the same code can't both get it.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+
+    def save(self, auth_code):
+        from .models import db, OAuth2AuthorizationCode
+        db.session.add(OAuth2AuthorizationCode(
+            **{k: v for k, v in auth_code.to_dict().items() if k in FIELDS}))
+        db.session.commit()
+        return auth_code
+
+    def pop(self, code):
+        from .models import db, OAuth2AuthorizationCode
+        table = OAuth2AuthorizationCode.__table__
+        if db.session.get_bind().dialect.delete_returning:
+            row = db.session.execute(
+                delete(table).where(table.c.code == code).returning(*table.c)).first()
+        else:
+            row = db.session.execute(select(table).where(table.c.code == code)).first()
+            if row is not None and not db.session.execute(
+                    delete(table).where(table.c.id == row.id)).rowcount:
+                # redeemed by a concurrent request in between
+                row = None
+        db.session.commit()
+        if row is None:
+            return None
+        data = {k: v for k, v in row._mapping.items() if k in FIELDS}
+        return AuthorizationCode(expires_at=data['auth_time'] + self.ttl, **data)
+
+
+class MemoryCodeStore(object):
+    """Codes in a dict of this process.
+
+    Only for a single worker (or tests): a code saved by one gunicorn
+    worker can't be redeemed on another. Use ``shm`` for that.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._codes = {}
+        self._next_purge = 0
+        self._lock = threading.Lock()
+
+    def save(self, auth_code):
+        now = time.time()
+        auth_code.expires_at = now + self.ttl
+        with self._lock:
+            if now >= self._next_purge:
+                self._codes = {k: v for k, v in self._codes.items() if v.expires_at >= now}
+                self._next_purge = now + self.ttl
+            self._codes[auth_code.code] = auth_code
+        return auth_code
+
+    def pop(self, code):
+        with self._lock:
+            return self._codes.pop(code, None)
+
+    def __len__(self):
+        return len(self._codes)
+
+
+class SharedMemoryCodeStore(object):
+    """Codes in a SQLite file on tmpfs, shared by the workers of one node.
+
+    The file lives in ``/dev/shm`` when there is one (the temp dir
+    otherwise), named after the gunicorn master's pid like the metrics
+    snapshots, so nothing is fsynced and nothing outlives the server.
+    Redeeming is one ``DELETE ... RETURNING`` statement.
+    """
+
+    def __init__(self, path=None, ttl=300):
+        self.ttl = ttl
+        if path is None:
+            directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+            path = os.path.join(directory, f'oauth2-codes-{os.getppid()}.db')
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        # one connection per thread and process; sqlite connections don't
+        # survive a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('CREATE TABLE IF NOT EXISTS code ('
+                         'code TEXT PRIMARY KEY, expires_at REAL, data TEXT)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def save(self, auth_code):
+        now = time.time()
+        auth_code.expires_at = now + self.ttl
+        conn = self.connection
+        conn.execute('INSERT INTO code VALUES (?, ?, ?)',
+                     (auth_code.code, auth_code.expires_at, json.dumps(auth_code.to_dict())))
+        if now >= getattr(self._local, 'next_purge', 0):
+            conn.execute('DELETE FROM code WHERE expires_at < ?', (now,))
+            self._local.next_purge = now + self.ttl
+        return auth_code
+
+    def pop(self, code):
+        row = self.connection.execute(
+            'DELETE FROM code WHERE code = ? RETURNING data', (code,)).fetchone()
+        return AuthorizationCode(**json.loads(row[0])) if row else None
+
+
+class RedisCodeStore(object):
+    """Codes in Redis, shared by every node, expired by Redis itself.
+
+    Saving is one ``SET ... EX``, redeeming one ``GETDEL``. ``client`` may be
+    any object with redis-py's ``set``/``getdel`` (e.g. fakeredis), otherwise
+    one is made from ``url`` and the ``redis`` package must be installed.
+    """
+
+    def __init__(self, url=None, client=None, ttl=300, prefix='oauth2:code:'):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError('AUTHORIZATION_CODE_STORE = "redis" needs the redis package')
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def save(self, auth_code):
+        auth_code.expires_at = time.time() + self.ttl
+        self.client.set(self.prefix + auth_code.code, json.dumps(auth_code.to_dict()),
+                        ex=self.ttl, nx=True)
+        return auth_code
+
+    def pop(self, code):
+        data = self.client.getdel(self.prefix + code)
+        return AuthorizationCode(**json.loads(data)) if data else None
+
+
+class CodeStore(object):
+    """The store ``AuthorizationCodeGrant`` saves and redeems codes with.
+
+    ``AUTHORIZATION_CODE_STORE`` picks the backend: ``sql`` (default),
+    ``memory``, ``shm`` or ``redis``. ``pop`` removes and returns a code
+    in one step, so each code is redeemable once, and the grant needs no
+    separate read and delete.
+    """
+
+    def __init__(self, app=None):
+        self.backend = SQLCodeStore()
+        self.saved = 0
+        self.redeemed = 0
+        self.missed = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        name = config.get('AUTHORIZATION_CODE_STORE', 'sql')
+        ttl = config.get('AUTHORIZATION_CODE_TTL', 300)
+        if name == 'sql':
+            self.backend = SQLCodeStore(ttl)
+        elif name == 'memory':
+            self.backend = MemoryCodeStore(ttl)
+        elif name == 'shm':
+            self.backend = SharedMemoryCodeStore(config.get('AUTHORIZATION_CODE_SHM_PATH'), ttl)
+        elif name == 'redis':
+            self.backend = RedisCodeStore(
+                config.get('AUTHORIZATION_CODE_REDIS_URL') or os.environ.get('REDIS_URL'), ttl=ttl)
+        else:
+            raise ValueError(f'Unknown authorization code store: {name}')
+
+    def save(self, auth_code):
+        self.saved += 1
+        return self.backend.save(auth_code)
+
+    def pop(self, code):
+        auth_code = self.backend.pop(code)
+        if auth_code is None or auth_code.is_expired():
+            self.missed += 1
+            return None
+        self.redeemed += 1
+        return auth_code
+
+    def stats(self):
+        return {
+            'backend': type(self.backend).__name__,
+            'saved': self.saved,
+            'redeemed': self.redeemed,
+            'missed': self.missed,
+        }
+
+
+code_store = CodeStore()
@@ -0,0 +1,124 @@
+# consent.py
+import time
+from authlib.oauth2.rfc6749.util import list_to_scope, scope_to_list
+from sqlalchemy.exc import IntegrityError
+from .models import db, OAuth2Consent
+from .token_cache import TokenCache
+from .db_routing import read_replica, replica_router
+from .cache_sync import cache_sync
+
+
+class ConsentStore(object):
+    """Consents users gave clients on the authorization page, remembered
+    for ``CONSENT_TTL`` seconds so that a later authorization for the same
+    or fewer scopes skips the page.
+
+    Lookups are cached per process for ``CONSENT_CACHE_TTL`` seconds,
+    missing consents included. Remembering or revoking drops the entry in
+    this process. Revocations are also logged for cache_sync, so the other
+    workers stop skipping the page within about ``CACHE_SYNC_INTERVAL``
+    seconds; a new consent they only see once their entry expires.
+    """
+
+    def __init__(self, app=None):
+        self.ttl = 30 * 86400
+        self.cache = TokenCache(maxsize=10000, ttl=60)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('CONSENT_TTL', self.ttl)
+        self.cache = TokenCache(
+            maxsize=app.config.get('CONSENT_CACHE_SIZE', 10000),
+            ttl=app.config.get('CONSENT_CACHE_TTL', 60),
+        )
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def granted(self, user_id, client_id):
+        """``(scopes, expires_at)`` of ``user_id``'s consent to ``client_id``."""
+        key = (user_id, client_id)
+        entry = self.cache.get(key)
+        if entry is None:
+            generation = self.cache.generation
+            consent = load_consent(user_id, client_id)
+            if consent is None:
+                entry = (frozenset(), 0)
+            else:
+                entry = (frozenset(scope_to_list(consent.scope) or ()), consent.expires_at)
+            self.cache.set(key, entry, generation=generation)
+        return entry
+
+    def covers(self, user_id, client_id, scope):
+        """Whether ``user_id`` already consented to ``client_id`` for ``scope``."""
+        if not self.enabled:
+            return False
+        scopes, expires_at = self.granted(user_id, client_id)
+        return expires_at > time.time() and set(scope_to_list(scope) or ()) <= scopes
+
+    def remember(self, user_id, client_id, scope):
+        """Add ``scope`` to the user's consent to ``client_id`` and commit."""
+        if not self.enabled or self.covers(user_id, client_id, scope):
+            return
+        now = int(time.time())
+        consent = OAuth2Consent.query.filter_by(user_id=user_id, client_id=client_id).first()
+        if consent is None:
+            consent = OAuth2Consent(user_id=user_id, client_id=client_id, expires_at=0)
+            db.session.add(consent)
+        scopes = set(scope_to_list(scope) or ())
+        if consent.expires_at > now:
+            # an expired consent starts over
+            scopes.update(scope_to_list(consent.scope) or ())
+        consent.scope = list_to_scope(sorted(scopes))
+        consent.granted_at = now
+        consent.expires_at = now + self.ttl
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # a concurrent approval inserted it first
+            db.session.rollback()
+            self.forget(user_id, client_id)
+            return
+        replica_router.wrote(user_id)
+        self.cache.set((user_id, client_id), (frozenset(scopes), now + self.ttl))
+
+    def revoke(self, user_id, client_id=None):
+        """Forget ``user_id``'s consent to ``client_id``, or to every client.
+        Returns the number of consents removed."""
+        query = OAuth2Consent.query.filter_by(user_id=user_id)
+        if client_id is not None:
+            query = query.filter_by(client_id=client_id)
+        client_ids = [c for (c,) in query.with_entities(OAuth2Consent.client_id)]
+        query.delete(synchronize_session=False)
+        cache_sync.record('consent', [f'{user_id}:{c}' for c in client_ids])
+        db.session.commit()
+        for revoked in client_ids:
+            self.forget(user_id, revoked)
+        return len(client_ids)
+
+    def forget(self, user_id, client_id):
+        self.cache.invalidate((user_id, client_id))
+        replica_router.wrote(user_id)
+
+    def revoked_elsewhere(self, key):
+        # cache_sync keys are "<user_id>:<client_id>"
+        user_id, _, client_id = key.partition(':')
+        self.cache.invalidate((int(user_id), client_id))
+
+    def list(self, user_id):
+        """The user's unexpired consents, newest first."""
+        return OAuth2Consent.query.filter(
+            OAuth2Consent.user_id == user_id,
+            OAuth2Consent.expires_at > int(time.time()),
+        ).order_by(OAuth2Consent.granted_at.desc()).all()
+
+
+@read_replica(sticky=True)
+def load_consent(user_id, client_id):
+    return OAuth2Consent.query.filter_by(user_id=user_id, client_id=client_id).first()
+
+
+consent_store = ConsentStore()
+cache_sync.subscribe('consent', consent_store.revoked_elsewhere)
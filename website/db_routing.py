@@ -0,0 +1,213 @@
+# db_routing.py
+import contextvars
+import functools
+import itertools
+import os
+import threading
+import time
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
+from .token_cache import TokenCache
+
+_replica = contextvars.ContextVar('db_replica', default=None)
+
+POOL_SETTINGS = {
+    'SQLALCHEMY_POOL_SIZE': 'pool_size',
+    'SQLALCHEMY_MAX_OVERFLOW': 'max_overflow',
+    'SQLALCHEMY_POOL_TIMEOUT': 'pool_timeout',
+    'SQLALCHEMY_POOL_RECYCLE': 'pool_recycle',
+    'SQLALCHEMY_POOL_PRE_PING': 'pool_pre_ping',
+}
+
+
+def engine_options(config, uri):
+    """Engine options for ``uri`` from the ``SQLALCHEMY_POOL_*`` settings.
+
+    In-memory SQLite gets a single static connection from Flask-SQLAlchemy,
+    which takes none of the queue pool arguments.
+    """
+    options = {}
+    url = make_url(uri)
+    memory = url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+    for setting, option in POOL_SETTINGS.items():
+        value = config.get(setting)
+        if value is None:
+            continue
+        if memory and option != 'pool_pre_ping':
+            continue
+        options[option] = value
+    return options
+
+
+def replica_uris(config):
+    uris = config.get('SQLALCHEMY_REPLICA_URIS') or os.environ.get('DATABASE_REPLICA_URLS') or []
+    if isinstance(uris, str):
+        uris = [u.strip() for u in uris.split(',') if u.strip()]
+    return list(uris)
+
+
+def configure_database(app):
+    """Turn the pool and replica settings into Flask-SQLAlchemy config.
+
+    Must run before ``db.init_app``. Each replica becomes a bind named
+    ``replica_<n>`` with the same pool options as the primary.
+    """
+    config = app.config
+    options = dict(config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    options.update(engine_options(config, config['SQLALCHEMY_DATABASE_URI']))
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+    binds = dict(config.get('SQLALCHEMY_BINDS') or {})
+    for i, uri in enumerate(replica_uris(config)):
+        binds[f'replica_{i}'] = dict(engine_options(config, uri), url=uri)
+    config['SQLALCHEMY_BINDS'] = binds
+
+
+class ReplicaRouter(object):
+    """Choose a healthy read replica, round robin.
+
+    A replica that raises a database error is skipped for
+    ``SQLALCHEMY_REPLICA_RETRY_INTERVAL`` seconds and the read is retried
+    on the primary. Keys passed to ``wrote`` (tokens just revoked, clients
+    just changed) are read from the primary for
+    ``SQLALCHEMY_REPLICA_STICKY_SECONDS``, so this worker doesn't cache a
+    lagging replica's copy of something it has just written.
+    """
+
+    def __init__(self, app=None):
+        self.keys = []
+        self.retry_interval = 30
+        self.recent_writes = TokenCache(maxsize=10000, ttl=10)
+        self.reads = 0
+        self.fallbacks = 0
+        self.failures = 0
+        self._down_until = {}
+        self._cycle = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.keys = [k for k in app.config.get('SQLALCHEMY_BINDS') or {}
+                     if k.startswith('replica_')]
+        self.retry_interval = app.config.get(
+            'SQLALCHEMY_REPLICA_RETRY_INTERVAL', self.retry_interval)
+        self.recent_writes = TokenCache(
+            maxsize=10000, ttl=app.config.get('SQLALCHEMY_REPLICA_STICKY_SECONDS', 10))
+        self._down_until = {}
+        self._cycle = itertools.cycle(self.keys) if self.keys else None
+
+    @property
+    def enabled(self):
+        return bool(self.keys)
+
+    def pick(self):
+        if not self.keys:
+            return None
+        now = time.time()
+        with self._lock:
+            for _ in range(len(self.keys)):
+                key = next(self._cycle)
+                if self._down_until.get(key, 0) <= now:
+                    return key
+        return None
+
+    def wrote(self, key):
+        if self.keys and key:
+            self.recent_writes.set(key, True)
+
+    def recently_wrote(self, key):
+        return self.recent_writes.get(key) is not None
+
+    def mark_down(self, key):
+        self.failures += 1
+        self._down_until[key] = time.time() + self.retry_interval
+
+    def stats(self):
+        now = time.time()
+        return {
+            'replicas': {k: 'down' if self._down_until.get(k, 0) > now else 'up'
+                         for k in self.keys},
+            'reads': self.reads,
+            'fallbacks': self.fallbacks,
+            'failures': self.failures,
+        }
+
+
+replica_router = ReplicaRouter()
+
+
+class RoutingSession(Session):
+    """``db.session`` that sends reads inside ``read_replica`` to a replica.
+
+    Flushes always go to the primary, and once this session has flushed it
+    keeps reading from the primary until the request ends, so a request
+    sees its own writes.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        key = _replica.get()
+        if key is not None and bind is None and not self._flushing \
+                and not self.info.get('wrote'):
+            return self._db.engines[key]
+        return super(RoutingSession, self).get_bind(
+            mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def read_replica(fn=None, sticky=False):
+    """Run ``fn``'s queries on a read replica when one is configured.
+
+    Falls back to the primary when the replica fails, and when ``fn``
+    returns ``None``: a row that is missing on the replica may just not
+    have replicated yet (a token issued a moment ago), and the primary
+    gives the authoritative answer. With ``sticky``, the first argument is
+    checked against ``ReplicaRouter.wrote``.
+
+    ``fn`` runs on a session of its own while it reads from the replica, so
+    a failing replica is rolled back without the request's pending work on
+    the primary. What it returns must not need that session afterwards.
+    """
+    if fn is None:
+        return functools.partial(read_replica, sticky=sticky)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        from .models import db
+        if not replica_router.enabled or _replica.get() is not None \
+                or db.session.info.get('wrote'):
+            return fn(*args, **kwargs)
+        if sticky and args and replica_router.recently_wrote(args[0]):
+            return fn(*args, **kwargs)
+        key = replica_router.pick()
+        if key is None:
+            return fn(*args, **kwargs)
+        registry = db.session.registry
+        primary = registry() if registry.has() else None
+        session = registry.createfunc()
+        registry.set(session)
+        token = _replica.set(key)
+        try:
+            replica_router.reads += 1
+            result = fn(*args, **kwargs)
+        except DBAPIError:
+            replica_router.mark_down(key)
+            session.rollback()
+            result = None
+        finally:
+            _replica.reset(token)
+            session.close()
+            if primary is not None:
+                registry.set(primary)
+            else:
+                registry.clear()
+        if result is None:
+            replica_router.fallbacks += 1
+            result = fn(*args, **kwargs)
+        return result
+    return wrapper
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _mark_written(session, flush_context):
+    session.info['wrote'] = True
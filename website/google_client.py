@@ -0,0 +1,45 @@
+# google_client.py
+"""The registered "Sign in with Google" client, imported on first use by
+``google_tokens.google_oauth_client``."""
+import threading
+import time
+import requests
+from authlib.integrations.flask_client import FlaskOAuth2App
+from .upstream import PooledOAuth2Session
+
+
+class GoogleOAuthApp(FlaskOAuth2App):
+    """Sends through the shared pool (see upstream.py) and reloads the
+    discovery document, and with it the JWKS, every ``metadata_ttl``
+    seconds instead of never. If a reload fails the old copy is kept and
+    retried ``metadata_retry`` seconds later, so sign-ins don't depend on
+    the discovery endpoint being up."""
+
+    client_cls = PooledOAuth2Session
+    metadata_ttl = 3600
+    metadata_retry = 60
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metadata_lock = threading.Lock()
+
+    def load_server_metadata(self):
+        loaded_at = self.server_metadata.get('_loaded_at')
+        if loaded_at is None or time.time() - loaded_at < self.metadata_ttl:
+            return super().load_server_metadata()
+        if not self._metadata_lock.acquire(blocking=False):
+            # another request is reloading it
+            return self.server_metadata
+        try:
+            stale = dict(self.server_metadata)
+            self.server_metadata.pop('_loaded_at', None)
+            self.server_metadata.pop('jwks', None)
+            try:
+                return super().load_server_metadata()
+            except (requests.RequestException, ValueError) as e:
+                print(f'Error reloading {self._server_metadata_url}: {e}')
+                stale['_loaded_at'] = time.time() - self.metadata_ttl + self.metadata_retry
+                self.server_metadata.update(stale)
+                return self.server_metadata
+        finally:
+            self._metadata_lock.release()
@@ -0,0 +1,249 @@
+# google_tokens.py
+import os
+import re
+import threading
+import time
+import requests
+from flask import current_app
+from authlib.jose import JsonWebKey, JsonWebToken
+from authlib.jose.errors import JoseError
+from .models import User
+from .token_cache import TokenCache, CachedUser
+from .db_routing import read_replica
+from .upstream import upstream
+
+GOOGLE_JWKS_URI = 'https://www.googleapis.com/oauth2/v3/certs'
+GOOGLE_ISSUERS = ['https://accounts.google.com', 'accounts.google.com']
+
+_max_age_re = re.compile(r'max-age=(\d+)')
+_client_lock = threading.Lock()
+
+
+class JWKSCache(object):
+    """Remote JSON Web Key Set, cached for as long as its ``Cache-Control``
+    allows.
+
+    A request never waits for a refresh while cached keys are available:
+    once the keys are past ``refresh_ratio`` of their lifetime, a background
+    thread fetches a new set and the old one keeps being served until it
+    lands. Only an empty cache or an unknown ``kid`` fetches synchronously,
+    and unknown ``kid`` refreshes are limited to one per
+    ``min_refresh_interval`` so bad tokens can't hammer the upstream.
+    """
+
+    def __init__(self, uri=GOOGLE_JWKS_URI, keys=None, default_ttl=3600,
+                 min_refresh_interval=60, refresh_ratio=0.8, timeout=5):
+        self.uri = uri
+        self.default_ttl = default_ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.refresh_ratio = refresh_ratio
+        self.timeout = timeout
+        self.fetches = 0
+        self.fetch_errors = 0
+        self._keys = {}
+        self._fetched_at = 0
+        self._expires_at = 0
+        self._attempted_at = 0
+        self._static = keys is not None
+        self._lock = threading.Lock()
+        self._refreshing = False
+        if keys is not None:
+            self.set_keys(keys)
+
+    def set_keys(self, jwks, ttl=None):
+        keys = {}
+        for data in jwks.get('keys', []):
+            keys[data.get('kid')] = JsonWebKey.import_key(data)
+        now = time.time()
+        self._keys = keys
+        self._fetched_at = now
+        self._expires_at = now + (ttl if ttl is not None else self.default_ttl)
+
+    def fetch(self):
+        resp = upstream.get(self.uri, timeout=self.timeout)
+        resp.raise_for_status()
+        m = _max_age_re.search(resp.headers.get('Cache-Control', ''))
+        ttl = int(m.group(1)) if m else self.default_ttl
+        return resp.json(), ttl
+
+    def refresh(self):
+        self._attempted_at = time.time()
+        try:
+            jwks, ttl = self.fetch()
+            self.set_keys(jwks, ttl)
+            self.fetches += 1
+        except (requests.RequestException, ValueError) as e:
+            # keep serving what we have, the next attempt is throttled
+            self.fetch_errors += 1
+            print(f'Error fetching JWKS from {self.uri}: {e}')
+        finally:
+            self._refreshing = False
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, name='jwks-refresh', daemon=True).start()
+
+    def _refresh_now(self, needed):
+        with self._lock:
+            if needed() and time.time() - self._attempted_at >= self.min_refresh_interval:
+                self._refreshing = True
+                self.refresh()
+
+    def _usable(self):
+        # expired keys stay usable for one more default_ttl while a
+        # background refresh is under way
+        return bool(self._keys) and time.time() < self._expires_at + self.default_ttl
+
+    def get_key(self, kid):
+        if self._static:
+            return self._keys.get(kid)
+
+        if not self._usable():
+            self._refresh_now(lambda: not self._usable())
+        elif time.time() >= self._fetched_at + \
+                (self._expires_at - self._fetched_at) * self.refresh_ratio:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None:
+            # the upstream may have rotated keys since the last fetch
+            self._refresh_now(lambda: kid not in self._keys)
+            key = self._keys.get(kid)
+        return key
+
+
+class GoogleIDTokenVerifier(object):
+    """Verify Google ID tokens locally and map them to users.
+
+    Valid tokens cost a signature check against the cached JWKS; the
+    email-to-user mapping and the verdict for tokens that failed are both
+    kept in short-lived caches, so neither a burst of valid tokens nor a
+    stream of garbage ones turns into repeated DB or upstream work.
+    """
+
+    def __init__(self, app=None):
+        self.client_ids = []
+        self.jwks = JWKSCache()
+        self.users = TokenCache(maxsize=10000, ttl=60)
+        self.rejected = TokenCache(maxsize=10000, ttl=300)
+        self._jwt = JsonWebToken(['RS256'])
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        client_ids = config.get('GOOGLE_CLIENT_ID') or os.environ.get('GOOGLE_CLIENT_ID')
+        if isinstance(client_ids, str):
+            client_ids = [client_ids]
+        self.client_ids = list(client_ids or [])
+        self.jwks = JWKSCache(
+            uri=config.get('GOOGLE_JWKS_URI', GOOGLE_JWKS_URI),
+            keys=config.get('GOOGLE_JWKS'),
+            min_refresh_interval=config.get('GOOGLE_JWKS_MIN_REFRESH_INTERVAL', 60),
+            timeout=config.get('GOOGLE_JWKS_TIMEOUT', 5),
+        )
+        self.users = TokenCache(
+            maxsize=config.get('GOOGLE_USER_CACHE_SIZE', 10000),
+            ttl=config.get('GOOGLE_USER_CACHE_TTL', 60),
+        )
+        self.rejected = TokenCache(
+            maxsize=config.get('GOOGLE_NEGATIVE_CACHE_SIZE', 10000),
+            ttl=config.get('GOOGLE_NEGATIVE_CACHE_TTL', 300),
+        )
+
+    def is_rejected(self, token_string):
+        return self.rejected.get(token_string) is not None
+
+    def reject(self, token_string):
+        self.rejected.set(token_string, True)
+
+    def verify(self, token_string):
+        """Return the claims of a valid Google ID token, or ``None``."""
+        if not self.client_ids or token_string.count('.') != 2:
+            return None
+
+        def load_key(header, payload):
+            key = self.jwks.get_key(header.get('kid'))
+            if key is None:
+                raise JoseError('unknown kid')
+            return key
+
+        try:
+            claims = self._jwt.decode(token_string, load_key, claims_options={
+                'iss': {'essential': True, 'values': GOOGLE_ISSUERS},
+                'aud': {'essential': True, 'values': self.client_ids},
+                'exp': {'essential': True},
+                'email': {'essential': True},
+            })
+            claims.validate()
+        except (JoseError, ValueError):
+            return None
+        return claims
+
+    def find_user(self, email):
+        user = self.users.get(email)
+        if user is not None:
+            return user
+        user = load_user_by_name(email)
+        if user is not None:
+            self.users.set(email, user)
+        return user
+
+    def stats(self):
+        return {
+            'jwks_keys': len(self.jwks._keys),
+            'jwks_fetches': self.jwks.fetches,
+            'jwks_fetch_errors': self.jwks.fetch_errors,
+            'users': self.users.stats(),
+            'rejected': self.rejected.stats(),
+        }
+
+
+@read_replica
+def load_user_by_name(username):
+    user = User.query.filter_by(username=username).first()
+    return CachedUser(user.id, user.username) if user is not None else None
+
+
+google_id_tokens = GoogleIDTokenVerifier()
+
+
+def google_oauth_client(app=None):
+    """The Google client of the "Sign in with Google" flow.
+
+    Registered the first time a worker needs it rather than at boot, so
+    ``authlib.integrations.flask_client`` is only imported by workers that
+    serve that flow. Its requests go through the shared pool and circuit
+    breakers of upstream.py.
+    """
+    app = app or current_app._get_current_object()
+    client = app.extensions.get('google_oauth_client')
+    if client is None:
+        with _client_lock:
+            client = app.extensions.get('google_oauth_client')
+            if client is None:
+                from authlib.integrations.flask_client import OAuth
+                from .google_client import GoogleOAuthApp
+                config = app.config
+                client_id = config.get('GOOGLE_CLIENT_ID') or os.environ.get('GOOGLE_CLIENT_ID')
+                if isinstance(client_id, (list, tuple)):
+                    # the verifier accepts several, the login flow is the first
+                    client_id = client_id[0]
+                oauth = OAuth(app)
+                client = oauth.register(
+                    name='google',
+                    client_cls=GoogleOAuthApp,
+                    client_id=client_id,
+                    client_secret=config.get('GOOGLE_CLIENT_SECRET') or os.environ.get('GOOGLE_CLIENT_SECRET'),
+                    server_metadata_url=config.get('GOOGLE_DISCOVERY_URL'),
+                    access_token_url=config.get('GOOGLE_ACCESS_TOKEN_URL'),
+                    authorize_url=config.get('GOOGLE_AUTHORIZE_URL'),
+                    api_base_url=config.get('GOOGLE_API_BASE_URL'),
+                    client_kwargs={'scope': 'openid email profile'}
+                )
+                client.metadata_ttl = config.get('GOOGLE_METADATA_TTL', client.metadata_ttl)
+                app.extensions['google_oauth_client'] = client
+    return client
@@ -0,0 +1,296 @@
+# jwt_tokens.py
+import json
+import os
+import threading
+import time
+import uuid
+import click
+from authlib.common.encoding import json_dumps, to_bytes, urlsafe_b64decode
+from authlib.jose import JsonWebKey, JsonWebSignature, JWTClaims
+from authlib.jose.errors import JoseError
+from authlib.oauth2.rfc6750 import BearerTokenGenerator
+from flask import request
+from flask.cli import with_appcontext
+
+TOKEN_TYPE = 'at+jwt'
+
+
+class JWTKeyStore(object):
+    """Signing keys for JWT access tokens, kept in a JSON file.
+
+    The file holds a private JWK set; the first key signs new tokens and
+    the rest only verify tokens issued before the last rotation. Every
+    worker reads the same file and reloads it when it changes, so a
+    rotation done by ``flask jwt-rotate-key`` reaches all of them.
+    """
+
+    def __init__(self, path=None, alg='RS256', max_keys=3, reload_interval=30):
+        self.path = path
+        self.alg = alg
+        self.max_keys = max_keys
+        self.reload_interval = reload_interval
+        self.miss_reload_interval = 1
+        self._keys = []
+        self._mtime = None
+        self._checked_at = 0
+        self._missed_at = 0
+        self._lock = threading.Lock()
+
+    def generate_key(self):
+        if self.alg.startswith('ES'):
+            key = JsonWebKey.generate_key('EC', 'P-' + self.alg[2:], is_private=True)
+        else:
+            key = JsonWebKey.generate_key('RSA', 2048, is_private=True)
+        return key.as_dict(is_private=True, alg=self.alg, use='sig')
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                raw = json.load(f)
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            raw = self._create()
+            mtime = os.stat(self.path).st_mtime
+        self._keys = [JsonWebKey.import_key(k) for k in raw['keys']]
+        self._mtime = mtime
+        self._checked_at = time.time()
+
+    def _create(self):
+        # several workers can boot at once; only one of them gets to link
+        # its complete file into place and the others read that one
+        data = {'keys': [self.generate_key()]}
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(json_dumps(data))
+        try:
+            os.link(tmp, self.path)
+        except FileExistsError:
+            with open(self.path) as f:
+                return json.load(f)
+        finally:
+            os.remove(tmp)
+        return data
+
+    def _maybe_reload(self, interval=None):
+        interval = self.reload_interval if interval is None else interval
+        now = time.time()
+        if now - self._checked_at < interval:
+            return
+        with self._lock:
+            if now - self._checked_at < interval:
+                return
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                return
+            if mtime != self._mtime:
+                self.load()
+
+    def rotate(self):
+        """Add a new signing key and keep at most ``max_keys`` in total."""
+        with open(self.path) as f:
+            keys = json.load(f)['keys']
+        new_key = self.generate_key()
+        keys = [new_key] + keys[:max(self.max_keys - 1, 0)]
+        tmp = self.path + '.tmp'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(json_dumps({'keys': keys}))
+        os.replace(tmp, self.path)
+        self.load()
+        return new_key['kid']
+
+    @property
+    def signing_key(self):
+        self._maybe_reload()
+        return self._keys[0]
+
+    def find_key(self, kid):
+        self._maybe_reload()
+        key = self._find(kid)
+        now = time.time()
+        if key is None and now - self._missed_at >= self.miss_reload_interval:
+            # signed with a key another worker has rotated in; unknown kids
+            # cost at most one stat per second
+            self._missed_at = now
+            self._maybe_reload(0)
+            key = self._find(kid)
+        return key
+
+    def _find(self, kid):
+        for key in self._keys:
+            if key.kid == kid:
+                return key
+        return None
+
+    def public_jwks(self):
+        self._maybe_reload()
+        return {'keys': [
+            key.as_dict(alg=key.tokens.get('alg', self.alg), use='sig')
+            for key in self._keys
+        ]}
+
+
+class JWTAccessTokens(object):
+    """Issue and verify RFC 9068 JWT access tokens.
+
+    Tokens are still saved through ``save_token`` (for refresh, revocation
+    and auditing), but the row is keyed by the ``jti`` claim instead of
+    the full JWT. Resource endpoints verify the signature and claims
+    locally. They only query the database for a token whose ``jti`` the
+    worker's revocation filter matches (revocations.py), so a revoked JWT
+    is refused within about ``CACHE_SYNC_INTERVAL`` seconds; with that set
+    to 0 it is accepted until it expires.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.issuer = None
+        self.audience = None
+        self.max_expires_in = 3600
+        self.keys = JWTKeyStore()
+        self._jws = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.enabled = bool(config.get('JWT_ACCESS_TOKENS'))
+        self.issuer = config.get('JWT_ISSUER')
+        self.audience = config.get('JWT_AUDIENCE')
+        self.max_expires_in = config.get('JWT_ACCESS_TOKEN_EXPIRES_IN', self.max_expires_in)
+        keys_file = config.get('JWT_KEYS_FILE')
+        if not keys_file:
+            directory = os.environ.get('RAILWAY_VOLUME_MOUNT_PATH') or app.instance_path
+            keys_file = os.path.join(directory, 'jwt_keys.json')
+        self.keys = JWTKeyStore(
+            keys_file,
+            alg=config.get('JWT_ALG', 'RS256'),
+            max_keys=config.get('JWT_MAX_KEYS', 3),
+            reload_interval=config.get('JWT_KEYS_RELOAD_INTERVAL', 30),
+        )
+        self._jws = JsonWebSignature(algorithms=[self.keys.alg])
+        if self.enabled:
+            self.keys.load()
+
+    def get_issuer(self, host_url=None):
+        """``JWT_ISSUER``, or the root URL of the request: Flask's, or
+        ``host_url`` where there is no Flask request (see asgi.py)."""
+        return self.issuer or (host_url or request.host_url).rstrip('/')
+
+    def get_audience(self, host_url=None):
+        return self.audience or self.get_issuer(host_url)
+
+    def create_token(self, client, grant_type, user, scope, expires_in):
+        now = int(time.time())
+        payload = {
+            'iss': self.get_issuer(),
+            'aud': self.get_audience(),
+            'iat': now,
+            'exp': now + expires_in,
+            'jti': uuid.uuid4().hex,
+            'client_id': client.client_id,
+        }
+        if user is not None:
+            payload['sub'] = str(user.get_user_id())
+            payload['preferred_username'] = user.username
+        else:
+            payload['sub'] = client.client_id
+        if scope:
+            payload['scope'] = scope
+
+        key = self.keys.signing_key
+        header = {'alg': self.keys.alg, 'typ': TOKEN_TYPE, 'kid': key.kid}
+        data = self._jws.serialize_compact(header, to_bytes(json_dumps(payload)), key)
+        return data.decode('ascii')
+
+    def verify(self, token_string, host_url=None):
+        """Return the validated claims of ``token_string``, or ``None``.
+
+        ``None`` also covers tokens that are not ours at all (opaque tokens,
+        Google ID tokens), so callers can fall through to other checks.
+        """
+        if not self.enabled or token_string.count('.') != 2:
+            return None
+
+        def load_key(header, payload):
+            if header.get('typ', '').lower() != TOKEN_TYPE:
+                raise JoseError('unexpected typ')
+            key = self.keys.find_key(header.get('kid'))
+            if key is None:
+                raise JoseError('unknown kid')
+            return key
+
+        try:
+            data = self._jws.deserialize_compact(token_string, load_key)
+            claims = JWTClaims(json.loads(data['payload']), data['header'], options={
+                'iss': {'essential': True, 'value': self.get_issuer(host_url)},
+                'aud': {'essential': True, 'value': self.get_audience(host_url)},
+                'exp': {'essential': True},
+                'jti': {'essential': True},
+            })
+            claims.validate()
+        except (JoseError, ValueError):
+            return None
+        return claims
+
+
+def token_id(token_string):
+    """``jti`` of a JWT access token, or ``token_string`` when opaque.
+
+    The payload is read without verifying the signature; this is only used
+    to find the stored row for a token we issued.
+    """
+    if token_string.count('.') != 2:
+        return token_string
+    try:
+        payload = json.loads(urlsafe_b64decode(to_bytes(token_string.split('.')[1])))
+        return payload.get('jti') or token_string
+    except (ValueError, TypeError, AttributeError):
+        return token_string
+
+
+class JWTBearerToken(BearerTokenGenerator):
+    """Bearer token generator that signs the access token as a JWT.
+
+    The stock generator creates the access token before ``expires_in`` is
+    known, so the JWT is built here once the lifetime has been decided.
+    """
+
+    def __init__(self, tokens, refresh_token_generator=None, expires_generator=None):
+        super(JWTBearerToken, self).__init__(
+            None, refresh_token_generator, expires_generator)
+        self.tokens = tokens
+
+    def generate(self, grant_type, client, user=None, scope=None,
+                 expires_in=None, include_refresh_token=True):
+        scope = self.get_allowed_scope(client, scope)
+        if expires_in is None:
+            expires_in = self._get_expires_in(client, grant_type)
+        expires_in = min(expires_in, self.tokens.max_expires_in)
+        token = {
+            'token_type': 'Bearer',
+            'access_token': self.tokens.create_token(
+                client, grant_type, user, scope, expires_in),
+            'expires_in': expires_in,
+        }
+        if include_refresh_token and self.refresh_token_generator:
+            token['refresh_token'] = self.refresh_token_generator(
+                client=client, grant_type=grant_type, user=user, scope=scope)
+        if scope:
+            token['scope'] = scope
+        return token
+
+
+jwt_access_tokens = JWTAccessTokens()
+
+
+@click.command('jwt-rotate-key')
+@with_appcontext
+def rotate_key_command():
+    """Add a new JWT signing key, keeping older keys for verification."""
+    kid = jwt_access_tokens.keys.rotate()
+    click.echo(f'New signing key: {kid}')
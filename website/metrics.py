@@ -0,0 +1,383 @@
+# metrics.py
+import atexit
+import contextlib
+import fcntl
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from flask import request, g
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SQL_TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+SQL_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+# name: (type, help, buckets)
+METRICS = {
+    'http_request_duration_seconds': (
+        'histogram', 'Request latency by endpoint.', LATENCY_BUCKETS),
+    'http_requests_total': (
+        'counter', 'Requests by endpoint, method and status.', None),
+    'db_statements_per_request': (
+        'histogram', 'SQL statements executed per request.', SQL_COUNT_BUCKETS),
+    'db_time_per_request_seconds': (
+        'histogram', 'Time spent in SQL statements per request.', SQL_TIME_BUCKETS),
+    'db_statements_total': (
+        'counter', 'SQL statements executed, in and out of requests.', None),
+    'oauth2_tokens_issued_total': (
+        'counter', 'Tokens issued by grant type and client.', None),
+    'oauth2_tokens_reused_total': (
+        'counter', 'client_credentials requests answered with an existing token, by client.', None),
+    'oauth2_token_validations_total': (
+        'counter', 'Bearer token validations by outcome.', None),
+    'oauth2_rate_limited_total': (
+        'counter', 'Requests throttled, by the limit that was hit.', None),
+    'oauth2_revocation_snapshot_bytes': (
+        'gauge', 'Size of the revoked-token Bloom filter snapshot.', None),
+    'oauth2_revocation_snapshot_tokens': (
+        'gauge', 'Revoked, unexpired access tokens in the snapshot.', None),
+    'oauth2_revocation_snapshot_false_positive_rate': (
+        'gauge', 'Expected false positive rate of the snapshot.', None),
+    'oauth2_refresh_token_reuse_total': (
+        'counter', 'Rotated refresh tokens presented again; each revokes a token family.', None),
+    'oauth2_tokens_bulk_revoked_total': (
+        'counter', 'Tokens revoked by the admin API, by what they were selected by.', None),
+    'oauth2_upstream_requests_total': (
+        'counter', 'Outbound requests by host and outcome; rejected ones hit an open circuit.', None),
+    'oauth2_upstream_request_duration_seconds': (
+        'histogram', 'Outbound request latency by host.', LATENCY_BUCKETS),
+}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in items) + '}'
+
+
+def _merge(totals, name, labels, value):
+    """Add one snapshot entry to ``totals``: counters and histogram
+    buckets add up, a gauge takes the value seen last."""
+    if name not in METRICS:
+        return
+    key = (name, tuple(tuple(l) for l in labels))
+    if isinstance(value, list):
+        if len(value) != len(METRICS[name][2]) + 2:
+            # written with other buckets, e.g. by an older deploy
+            return
+        current = totals.setdefault(key, [0] * len(value))
+        for i, v in enumerate(value):
+            current[i] += v
+    elif METRICS[name][0] == 'gauge':
+        totals[key] = value
+    else:
+        totals[key] = totals.get(key, 0) + value
+
+
+def _load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return 0
+
+
+class Metrics(object):
+    """In-process counters and histograms exported at ``/metrics``.
+
+    Recording a value is a dict update under a lock. Every worker writes a
+    snapshot of its values to ``METRICS_DIR`` every ``METRICS_FLUSH_INTERVAL``
+    seconds, and ``/metrics`` adds up the snapshots of all workers, so the
+    scrape is correct whichever worker answers it (values from other workers
+    are at most one interval old). A live worker rewrites its snapshot every
+    interval; one that hasn't for ``retire_intervals`` intervals belongs to
+    an exited worker, and the next scrape folds it into ``retired.json``
+    and deletes it, so totals don't go backwards when gunicorn replaces a
+    worker and scrapes don't read one file per worker ever started.
+    """
+
+    retire_intervals = 12
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.directory = None
+        self.flush_interval = 5
+        self._values = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pid = None
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.enabled = config.get('METRICS_ENABLED', True)
+        self.directory = config.get('METRICS_DIR')
+        self.flush_interval = config.get('METRICS_FLUSH_INTERVAL', self.flush_interval)
+        if not self.enabled:
+            return
+
+        from .models import db
+        with app.app_context():
+            self.instrument(db.engine)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        atexit.register(self.flush)
+
+    # recording
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+        self._ensure_flusher()
+
+    def set(self, name, value, labels=()):
+        with self._lock:
+            self._values[(name, tuple(labels))] = value
+        self._ensure_flusher()
+
+    def observe(self, name, value, labels=()):
+        buckets = METRICS[name][2]
+        key = (name, tuple(labels))
+        with self._lock:
+            h = self._values.get(key)
+            if h is None:
+                # one count per bucket, then sum and count
+                h = self._values[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    h[i] += 1
+                    break
+            h[-2] += value
+            h[-1] += 1
+        self._ensure_flusher()
+
+    def token_issued(self, grant_type, client_id):
+        if self.enabled:
+            self.inc('oauth2_tokens_issued_total',
+                     (('grant_type', grant_type or ''), ('client_id', client_id or '')))
+
+    def token_reused(self, client_id):
+        if self.enabled:
+            self.inc('oauth2_tokens_reused_total', (('client_id', client_id or ''),))
+
+    def token_validated(self, outcome):
+        if self.enabled:
+            self.inc('oauth2_token_validations_total', (('outcome', outcome),))
+
+    def rate_limited(self, kind):
+        if self.enabled:
+            self.inc('oauth2_rate_limited_total', (('limit', kind),))
+
+    def revocation_snapshot(self, size, tokens, false_positive_rate):
+        if self.enabled:
+            self.set('oauth2_revocation_snapshot_bytes', size)
+            self.set('oauth2_revocation_snapshot_tokens', tokens)
+            self.set('oauth2_revocation_snapshot_false_positive_rate', false_positive_rate)
+
+    def refresh_token_reused(self):
+        if self.enabled:
+            self.inc('oauth2_refresh_token_reuse_total')
+
+    def tokens_bulk_revoked(self, by, count):
+        if self.enabled:
+            self.inc('oauth2_tokens_bulk_revoked_total', (('by', by),), count)
+
+    def upstream_request(self, host, outcome, seconds=None):
+        if self.enabled:
+            self.inc('oauth2_upstream_requests_total', (('host', host), ('outcome', outcome)))
+            if seconds is not None:
+                self.observe('oauth2_upstream_request_duration_seconds', seconds, (('host', host),))
+
+    def instrument(self, engine):
+        """Count the SQL statements of ``engine``; the sync engine of an
+        async one for the ASGI app."""
+        if self.enabled:
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self._local.started = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - getattr(self._local, 'started', time.perf_counter())
+        self._local.statements = getattr(self._local, 'statements', 0) + 1
+        self._local.seconds = getattr(self._local, 'seconds', 0.0) + elapsed
+        self.inc('db_statements_total')
+
+    def _before_request(self):
+        self._local.statements = 0
+        self._local.seconds = 0.0
+        g._metrics_started = time.perf_counter()
+
+    def _after_request(self, response):
+        started = g.pop('_metrics_started', None)
+        if started is None:
+            return response
+        endpoint = request.url_rule.endpoint if request.url_rule else 'unmatched'
+        labels = (('endpoint', endpoint),)
+        self.observe('http_request_duration_seconds', time.perf_counter() - started, labels)
+        self.inc('http_requests_total', labels + (
+            ('method', request.method), ('status', str(response.status_code))))
+        self.observe('db_statements_per_request', self._local.statements, labels)
+        self.observe('db_time_per_request_seconds', self._local.seconds, labels)
+        return response
+
+    # aggregation across workers
+
+    def get_directory(self):
+        # workers of one gunicorn master share its pid as their parent
+        return self.directory or os.path.join(
+            tempfile.gettempdir(), f'oauth2-metrics-{os.getppid()}')
+
+    def _path(self, pid):
+        return os.path.join(self.get_directory(), f'{pid}.json')
+
+    @contextlib.contextmanager
+    def _locked(self, operation=fcntl.LOCK_EX):
+        os.makedirs(self.get_directory(), exist_ok=True)
+        with open(os.path.join(self.get_directory(), '.lock'), 'a') as f:
+            fcntl.flock(f, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def retire(self, paths):
+        """Fold the snapshots at ``paths`` into ``retired.json`` and delete
+        them, under a lock so concurrent scrapes fold each one once."""
+        retired_path = os.path.join(self.get_directory(), 'retired.json')
+        stale_before = time.time() - self.retire_intervals * self.flush_interval
+        with self._locked():
+            totals = {}
+            if os.path.exists(retired_path):
+                for name, labels, value in _load(retired_path):
+                    _merge(totals, name, labels, value)
+            folded = []
+            for path in paths:
+                # another scrape may have folded it, or the worker came back
+                if not 0 < _mtime(path) < stale_before:
+                    continue
+                try:
+                    entries = _load(path)
+                except (OSError, ValueError):
+                    entries = []
+                for name, labels, value in entries:
+                    _merge(totals, name, labels, value)
+                folded.append(path)
+            if not folded:
+                return
+            tmp = retired_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump([[name, [list(l) for l in labels], value]
+                           for (name, labels), value in totals.items()], f)
+            os.replace(tmp, retired_path)
+            for path in folded:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(path)
+
+    def snapshot(self):
+        with self._lock:
+            return [[name, [list(l) for l in labels], value if not isinstance(value, list) else list(value)]
+                    for (name, labels), value in self._values.items()]
+
+    def flush(self):
+        if self._pid != os.getpid():
+            return
+        path = self._path(self._pid)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, path)
+
+    def _ensure_flusher(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            if self._pid is not None:
+                # forked from a process that had already recorded values;
+                # those belong to the parent's snapshot
+                self._values = {}
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                print(f'Error writing metrics snapshot: {e}')
+
+    def collect(self):
+        """Sum this worker's live values and the other workers' snapshots,
+        after retiring those of exited workers."""
+        directory = self.get_directory()
+        own = self._path(os.getpid())
+        retired = os.path.join(directory, 'retired.json')
+        stale_before = time.time() - self.retire_intervals * self.flush_interval
+        paths = [path for path in glob.glob(os.path.join(directory, '*.json'))
+                 if path not in (own, retired)]
+        stale = [path for path in paths if _mtime(path) < stale_before]
+        if stale:
+            try:
+                self.retire(stale)
+            except (OSError, ValueError) as e:
+                print(f'Error retiring metrics snapshots: {e}')
+        # oldest first, so the freshest value of a gauge is the one kept
+        paths.sort(key=_mtime)
+        totals = {}
+        # a snapshot is read either before or after it was retired, not both
+        with self._locked(fcntl.LOCK_SH):
+            for path in [retired] + paths:
+                try:
+                    entries = _load(path)
+                except (OSError, ValueError):
+                    continue
+                for name, labels, value in entries:
+                    _merge(totals, name, labels, value)
+        for name, labels, value in self.snapshot():
+            _merge(totals, name, labels, value)
+        return totals
+
+    def render(self):
+        totals = self.collect()
+        lines = []
+        for name, (kind, help_, buckets) in METRICS.items():
+            series = sorted((k[1], v) for k, v in totals.items() if k[0] == name)
+            lines.append(f'# HELP {name} {help_}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in series:
+                if kind != 'histogram':
+                    lines.append(f'{name}{_labels(labels)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, value):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_labels(labels, ("le", bound))} {cumulative}')
+                lines.append(f'{name}_bucket{_labels(labels, ("le", "+Inf"))} {value[-1]}')
+                lines.append(f'{name}_sum{_labels(labels)} {value[-2]}')
+                lines.append(f'{name}_count{_labels(labels)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
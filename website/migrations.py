@@ -0,0 +1,270 @@
+# migrations.py
+import contextlib
+import fcntl
+import hashlib
+import os
+import tempfile
+import time
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, inspect, select, text
+from sqlalchemy.pool import NullPool
+from .models import db, CacheInvalidation, OAuth2Consent, OAuth2Token, TokenRevocation
+
+MIGRATIONS = []
+# pg_advisory_lock key held while migrating
+MIGRATION_LOCK_ID = 0x6f617574
+
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('description', String(200)),
+    Column('applied_at', Integer),
+)
+
+
+def migration(version, description, transactional=True):
+    """Register ``fn(conn)`` as schema version ``version``.
+
+    Migration 1 creates every table of the current models on an empty
+    database, so later migrations must check before they change anything:
+    they run after it on fresh databases too. A migration that isn't
+    ``transactional`` gets a connection outside any transaction and begins
+    its own, so it can build indexes concurrently.
+    """
+    def decorator(fn):
+        fn.transactional = transactional
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return decorator
+
+
+def has_column(conn, table, column):
+    return column in {c['name'] for c in inspect(conn).get_columns(table)}
+
+
+def create_missing_indexes(conn, table, concurrently=False):
+    """Create the indexes the model declares on ``table`` that the
+    database doesn't have yet. Indexes on columns a later migration adds
+    are left to that migration.
+
+    With ``concurrently`` on PostgreSQL they are built without blocking
+    writes; ``conn`` must then be in autocommit mode.
+    """
+    existing = {i['name'] for i in inspect(conn).get_indexes(table.name)}
+    columns = {c['name'] for c in inspect(conn).get_columns(table.name)}
+    for index in table.indexes:
+        if index.name in existing or not {c.name for c in index.columns} <= columns:
+            continue
+        if concurrently and conn.dialect.name == 'postgresql':
+            unique = 'UNIQUE ' if index.unique else ''
+            columns = ', '.join(c.name for c in index.columns)
+            conn.execute(text(f'CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS '
+                              f'{index.name} ON {table.name} ({columns})'))
+        else:
+            index.create(conn)
+
+
+def rebuild_sqlite_table(conn, table):
+    """Recreate ``table`` as the model declares it, keeping its rows; the
+    way to change a column's constraints on SQLite."""
+    old = table.name + '_old'
+    columns = {c['name'] for c in inspect(conn).get_columns(table.name)}
+    for index in inspect(conn).get_indexes(table.name):
+        conn.execute(text(f'DROP INDEX {index["name"]}'))
+    conn.execute(text(f'ALTER TABLE {table.name} RENAME TO {old}'))
+    table.create(conn)
+    common = ', '.join(c.name for c in table.columns if c.name in columns)
+    conn.execute(text(f'INSERT INTO {table.name} ({common}) SELECT {common} FROM {old}'))
+    conn.execute(text(f'DROP TABLE {old}'))
+
+
+@migration(1, 'create tables')
+def create_tables(conn):
+    db.metadata.create_all(conn, checkfirst=True)
+
+
+@migration(2, 'add oauth_user.password_hash')
+def add_password_hash(conn):
+    # was db_schema_pwd_add.py
+    if not has_column(conn, 'oauth_user', 'password_hash'):
+        conn.execute(text('ALTER TABLE oauth_user ADD COLUMN password_hash VARCHAR(128)'))
+
+
+@migration(3, 'add refresh token families and expiry column')
+def add_refresh_token_family(conn):
+    if not has_column(conn, 'oauth2_token', 'family_id'):
+        conn.execute(text('ALTER TABLE oauth2_token ADD COLUMN family_id VARCHAR(48)'))
+    if not has_column(conn, 'oauth2_token', 'refresh_token_expires_at'):
+        conn.execute(text('ALTER TABLE oauth2_token ADD COLUMN refresh_token_expires_at INTEGER'))
+    conn.execute(text(
+        'UPDATE oauth2_token SET refresh_token_expires_at = issued_at + expires_in * 2 '
+        'WHERE refresh_token IS NOT NULL AND refresh_token_expires_at IS NULL'))
+    # existing tokens are each their own family
+    conn.execute(text(
+        "UPDATE oauth2_token SET family_id = 'token-' || CAST(id AS VARCHAR(20)) "
+        'WHERE refresh_token IS NOT NULL AND family_id IS NULL'))
+    create_missing_indexes(conn, OAuth2Token.__table__)
+
+
+@migration(4, 'index oauth2_token by client, scope and user')
+def add_client_scope_index(conn):
+    create_missing_indexes(conn, OAuth2Token.__table__)
+
+
+@migration(5, 'create oauth2_consent')
+def create_consent_table(conn):
+    OAuth2Consent.__table__.create(conn, checkfirst=True)
+
+
+@migration(6, 'create oauth2_token_revocation')
+def create_revocation_log(conn):
+    TokenRevocation.__table__.create(conn, checkfirst=True)
+
+
+@migration(7, 'store access and refresh token digests', transactional=False)
+def add_token_digests(conn):
+    # adds the columns and indexes only; `flask hash-tokens` fills in the
+    # digests of existing rows in batches while the server keeps running
+    table = OAuth2Token.__table__
+    with conn.begin():
+        access_token = {c['name']: c for c in inspect(conn).get_columns(table.name)}['access_token']
+        if conn.dialect.name == 'sqlite':
+            if not has_column(conn, table.name, 'access_token_digest') or not access_token['nullable']:
+                rebuild_sqlite_table(conn, table)
+        else:
+            binary = 'BYTEA' if conn.dialect.name == 'postgresql' else 'VARBINARY(32)'
+            for column in ('access_token_digest', 'refresh_token_digest'):
+                if not has_column(conn, table.name, column):
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column} {binary}'))
+            if not access_token['nullable']:
+                if conn.dialect.name == 'mysql':
+                    conn.execute(text(f'ALTER TABLE {table.name} MODIFY access_token VARCHAR(255) NULL'))
+                else:
+                    conn.execute(text(f'ALTER TABLE {table.name} ALTER COLUMN access_token DROP NOT NULL'))
+    if conn.dialect.name == 'postgresql':
+        create_missing_indexes(conn.execution_options(isolation_level='AUTOCOMMIT'),
+                               table, concurrently=True)
+    else:
+        with conn.begin():
+            create_missing_indexes(conn, table)
+
+
+@migration(8, 'index oauth2_token by refresh token expiry', transactional=False)
+def add_refresh_expiry_index(conn):
+    if conn.dialect.name == 'postgresql':
+        create_missing_indexes(conn.execution_options(isolation_level='AUTOCOMMIT'),
+                               OAuth2Token.__table__, concurrently=True)
+    else:
+        with conn.begin():
+            create_missing_indexes(conn, OAuth2Token.__table__)
+
+
+@migration(9, 'create oauth2_cache_invalidation')
+def create_cache_invalidation_log(conn):
+    CacheInvalidation.__table__.create(conn, checkfirst=True)
+
+
+def applied_versions(conn):
+    if not inspect(conn).has_table(schema_migrations.name):
+        return set()
+    return {row[0] for row in conn.execute(select(schema_migrations.c.version))}
+
+
+def pending_migrations(engine):
+    with engine.connect() as conn:
+        applied = applied_versions(conn)
+    return [m for m in MIGRATIONS if m[0] not in applied]
+
+
+@contextlib.contextmanager
+def migration_lock(engine):
+    """Let one process at a time migrate ``engine``'s database: a
+    PostgreSQL advisory lock, or a file lock next to the SQLite file (for
+    other databases, in the temp dir, so only on this node)."""
+    if engine.dialect.name == 'postgresql':
+        # on a connection of its own, outside the pool the migrations use
+        lock_engine = create_engine(engine.url, poolclass=NullPool)
+        try:
+            with lock_engine.connect() as conn:
+                conn.execute(text('SELECT pg_advisory_lock(:id)'), {'id': MIGRATION_LOCK_ID})
+                conn.commit()
+                try:
+                    yield
+                finally:
+                    conn.execute(text('SELECT pg_advisory_unlock(:id)'), {'id': MIGRATION_LOCK_ID})
+                    conn.commit()
+        finally:
+            lock_engine.dispose()
+        return
+    database = engine.url.database
+    if engine.dialect.name == 'sqlite':
+        if not database or database == ':memory:':
+            # private to this process
+            yield
+            return
+        path = os.path.abspath(database) + '.migrate-lock'
+    else:
+        url = engine.url.render_as_string(hide_password=True)
+        path = os.path.join(tempfile.gettempdir(),
+                            f'oauth2-migrate-{hashlib.sha256(url.encode()).hexdigest()[:16]}.lock')
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def upgrade(engine, target=None):
+    """Apply the pending migrations up to ``target``, each in its own
+    transaction. Returns the ``(version, description)`` pairs applied.
+
+    Workers that boot together take turns under ``migration_lock``: the
+    first applies the migrations and the others find none left. An
+    up-to-date schema costs one query and no lock.
+    """
+    if not pending_migrations(engine):
+        return []
+    done = []
+    with migration_lock(engine):
+        schema_migrations.create(engine, checkfirst=True)
+        for version, description, fn in pending_migrations(engine):
+            if target is not None and version > target:
+                break
+            if not fn.transactional:
+                with engine.connect() as conn:
+                    fn(conn)
+            with engine.begin() as conn:
+                if fn.transactional:
+                    fn(conn)
+                conn.execute(schema_migrations.insert().values(
+                    version=version, description=description, applied_at=int(time.time())))
+            done.append((version, description))
+    return done
+
+
+@click.command('db-upgrade')
+@click.option('--target', type=int, help='Stop after this schema version.')
+@with_appcontext
+def upgrade_command(target):
+    """Apply pending schema migrations to the primary database.
+
+    Run it once per deploy, before starting workers with FAST_START.
+    """
+    done = upgrade(db.engine, target)
+    for version, description in done:
+        click.echo(f'applied {version:>4}  {description}')
+    if not done:
+        click.echo('schema is up to date')
+
+
+@click.command('db-status')
+@with_appcontext
+def status_command():
+    """List schema migrations and whether they are applied."""
+    pending = {m[0] for m in pending_migrations(db.engine)}
+    for version, description, _ in MIGRATIONS:
+        state = 'pending' if version in pending else 'applied'
+        click.echo(f'{state:<8} {version:>4}  {description}')
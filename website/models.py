@@ -1,14 +1,16 @@
 # models.py
 import time
-from werkzeug.security import generate_password_hash, check_password_hash
+import uuid
 from flask_sqlalchemy import SQLAlchemy
 from authlib.integrations.sqla_oauth2 import (
     OAuth2ClientMixin,
     OAuth2AuthorizationCodeMixin,
     OAuth2TokenMixin,
 )
+from .passwords import password_hasher
+from .db_routing import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 
 class User(db.Model):
@@ -26,10 +28,15 @@ class User(db.Model):
     # def check_password(self, password):
     #     return password == 'valid'
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        # upgrades the stored hash when the hash parameters changed; the
+        # caller commits it along with the rest of the login
+        ok, new_hash = password_hasher.verify(self.password_hash, password)
+        if new_hash:
+            self.password_hash = new_hash
+        return ok
 
 
 class OAuth2Client(db.Model, OAuth2ClientMixin):
@@ -57,9 +64,105 @@ class OAuth2Token(db.Model, OAuth2TokenMixin):
     user_id = db.Column(
         db.Integer, db.ForeignKey('oauth_user.id', ondelete='CASCADE'))
     user = db.relationship('User')
+    # empty when TOKEN_STORAGE is 'hashed', see token_storage.py
+    access_token = db.Column(db.String(255), unique=True)
+    access_token_digest = db.Column(db.LargeBinary(32))
+    refresh_token_digest = db.Column(db.LargeBinary(32))
+    # tokens rotated from the same original grant share a family; a reused
+    # refresh token revokes all of them
+    family_id = db.Column(db.String(48), index=True)
+    refresh_token_expires_at = db.Column(db.Integer)
+
+    __table_args__ = (
+        # refresh lookups filter on the token and its active predicate
+        db.Index('ix_oauth2_token_refresh_active', 'refresh_token',
+                 'refresh_token_revoked_at', 'refresh_token_expires_at'),
+        db.Index('ix_oauth2_token_access_token_digest', 'access_token_digest', unique=True),
+        db.Index('ix_oauth2_token_refresh_digest_active', 'refresh_token_digest',
+                 'refresh_token_revoked_at', 'refresh_token_expires_at'),
+        # newest token of a client for a scope, for client_credentials reuse
+        db.Index('ix_oauth2_token_client_scope', 'client_id', 'scope',
+                 'user_id', 'issued_at'),
+        # expired refresh tokens, for the sweeper
+        db.Index('ix_oauth2_token_refresh_expires_at', 'refresh_token_expires_at'),
+    )
 
     def is_refresh_token_active(self):
-        if self.revoked:
+        if self.refresh_token_revoked_at:
             return False
-        expires_at = self.issued_at + self.expires_in * 2
+        expires_at = self.refresh_token_expires_at or self.issued_at + self.expires_in * 2
         return expires_at >= time.time()
+
+    @classmethod
+    def refresh_token_active(cls, now):
+        """SQL version of ``is_refresh_token_active`` at ``now``."""
+        return db.and_(cls.refresh_token_revoked_at == 0,
+                       cls.refresh_token_expires_at >= now)
+
+
+@db.event.listens_for(OAuth2Token, 'before_insert')
+def _refresh_token_defaults(mapper, connection, token):
+    if token.refresh_token or token.refresh_token_digest:
+        if token.issued_at is None:
+            token.issued_at = int(time.time())
+        if token.refresh_token_expires_at is None:
+            token.refresh_token_expires_at = token.issued_at + (token.expires_in or 0) * 2
+        if token.family_id is None:
+            token.family_id = uuid.uuid4().hex
+
+
+class OAuth2Consent(db.Model):
+    """A user's remembered approval of a client for ``scope``."""
+    __tablename__ = 'oauth2_consent'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey('oauth_user.id', ondelete='CASCADE'), nullable=False)
+    user = db.relationship('User')
+    client_id = db.Column(db.String(48), nullable=False)
+    scope = db.Column(db.Text, default='')
+    granted_at = db.Column(db.Integer, nullable=False)
+    expires_at = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'client_id', name='uq_oauth2_consent_user_client'),
+    )
+
+
+class TokenRevocation(db.Model):
+    """Append-only log of revoked access tokens; ``id`` is the cursor of
+    the revocation feed."""
+    __tablename__ = 'oauth2_token_revocation'
+
+    id = db.Column(db.Integer, primary_key=True)
+    # sha256 hex of the stored access token (the jti for JWT access tokens)
+    token_hash = db.Column(db.String(64), nullable=False)
+    revoked_at = db.Column(db.Integer, nullable=False)
+    expires_at = db.Column(db.Integer, nullable=False, index=True)
+
+
+class CacheInvalidation(db.Model):
+    """Append-only log of changes the other workers drop from their caches
+    (cache_sync.py); ``id`` is the cursor they poll from."""
+    __tablename__ = 'oauth2_cache_invalidation'
+
+    id = db.Column(db.Integer, primary_key=True)
+    cache = db.Column(db.String(16), nullable=False)
+    key = db.Column(db.String(255), nullable=False)
+    created_at = db.Column(db.Integer, nullable=False, index=True)
+
+
+class TokenEvent(db.Model):
+    """Audit row written by the ``sql`` token event sink."""
+    __tablename__ = 'oauth2_token_event'
+
+    id = db.Column(db.Integer, primary_key=True)
+    event = db.Column(db.String(40), nullable=False)
+    created_at = db.Column(db.Integer, nullable=False, index=True)
+    client_id = db.Column(db.String(48), index=True)
+    user_id = db.Column(db.Integer, index=True)
+    grant_type = db.Column(db.String(40))
+    scope = db.Column(db.Text, default='')
+    expires_in = db.Column(db.Integer)
+    expires_at = db.Column(db.Integer)
+    refresh_token_issued = db.Column(db.Boolean, default=False)
@@ -1,18 +1,36 @@
 # oauth2.py
+import time
+from flask import current_app
+from sqlalchemy import case, or_
+from sqlalchemy.orm import joinedload
+from authlib.consts import default_json_headers
 from authlib.integrations.flask_oauth2 import (
     AuthorizationServer,
     ResourceProtector,
 )
 from authlib.integrations.sqla_oauth2 import (
-    create_query_client_func,
     create_save_token_func,
     create_revocation_endpoint,
     create_bearer_token_validator,
 )
 from authlib.oauth2.rfc6749 import grants
+from authlib.oauth2.rfc6749 import InvalidRequestError
+from authlib.oauth2.rfc6750 import InvalidTokenError
 from authlib.oauth2.rfc7636 import CodeChallenge
+from authlib.oauth2.rfc7662 import IntrospectionEndpoint as _IntrospectionEndpoint
 from .models import db, User
-from .models import OAuth2Client, OAuth2AuthorizationCode, OAuth2Token
+from .models import OAuth2Client, OAuth2Token
+from .token_cache import token_cache, CachedToken
+from .jwt_tokens import jwt_access_tokens, JWTBearerToken, token_id
+from .client_cache import client_registry
+from .passwords import password_hasher, PasswordHasherBusy, TemporarilyUnavailableError
+from .metrics import metrics
+from .token_events import token_events
+from .db_routing import read_replica, replica_router
+from .code_store import code_store, AuthorizationCode
+from .consent import consent_store
+from .revocations import revocation_feed, key_hash, token_hash
+from .token_storage import token_storage
 
 
 class AuthorizationCodeGrant(grants.AuthorizationCodeGrant):
@@ -25,28 +43,27 @@ class AuthorizationCodeGrant(grants.AuthorizationCodeGrant):
     def save_authorization_code(self, code, request):
         code_challenge = request.data.get('code_challenge')
         code_challenge_method = request.data.get('code_challenge_method')
-        auth_code = OAuth2AuthorizationCode(
-            code=code,
+        return code_store.save(AuthorizationCode(
+            code=token_storage.code_key(code),
             client_id=request.client.client_id,
             redirect_uri=request.redirect_uri,
             scope=request.scope,
             user_id=request.user.id,
             code_challenge=code_challenge,
             code_challenge_method=code_challenge_method,
-        )
-        db.session.add(auth_code)
-        db.session.commit()
-        return auth_code
+        ))
 
     def query_authorization_code(self, code, client):
-        auth_code = OAuth2AuthorizationCode.query.filter_by(
-            code=code, client_id=client.client_id).first()
-        if auth_code and not auth_code.is_expired():
+        # redeemed right here, in one step: a code can't be used twice, even
+        # by concurrent requests, and one that then fails the redirect_uri
+        # or PKCE check is gone as well
+        auth_code = code_store.pop(token_storage.code_key(code))
+        if auth_code and auth_code.client_id == client.client_id:
             return auth_code
 
     def delete_authorization_code(self, authorization_code):
-        db.session.delete(authorization_code)
-        db.session.commit()
+        # already removed by query_authorization_code
+        pass
 
     def authenticate_user(self, authorization_code):
         return User.query.get(authorization_code.user_id)
@@ -54,28 +71,384 @@ class AuthorizationCodeGrant(grants.AuthorizationCodeGrant):
 
 class PasswordGrant(grants.ResourceOwnerPasswordCredentialsGrant):
     def authenticate_user(self, username, password):
+        # imported here, rate_limit imports this module
+        from .rate_limit import rate_limiter
+        rate_limiter.check_password_failures(username)
         user = User.query.filter_by(username=username).first()
-        if user is not None and user.check_password(password):
-            return user
+        if user is None:
+            rate_limiter.password_failed(username)
+            return None
+        try:
+            ok = user.check_password(password)
+        except PasswordHasherBusy as e:
+            raise TemporarilyUnavailableError(retry_after=e.retry_after)
+        if not ok:
+            rate_limiter.password_failed(username)
+            return None
+        rate_limiter.user_signed_in(user.id)
+        db.session.commit()
+        return user
 
 
 class RefreshTokenGrant(grants.RefreshTokenGrant):
+    INCLUDE_NEW_REFRESH_TOKEN = True
+
     def authenticate_refresh_token(self, refresh_token):
-        token = OAuth2Token.query.filter_by(refresh_token=refresh_token).first()
-        if token and token.is_refresh_token_active():
+        """Claim ``refresh_token`` for one rotation.
+
+        The row is locked (``FOR UPDATE`` where the database has it) and
+        revoked by an UPDATE that only matches while it is still active, in
+        the transaction ``save_token`` commits along with the new token: of
+        concurrent refreshes of one token exactly one succeeds. Presenting a
+        refresh token that was already rotated revokes its whole family,
+        unless it was rotated less than ``REFRESH_TOKEN_REUSE_GRACE``
+        seconds ago: that is a client sending the same refresh twice, and
+        the token the other request got must keep working. A refresh token
+        that was revoked rather than rotated is only rejected.
+        """
+        now = int(time.time())
+        token = OAuth2Token.query.filter(
+            token_storage.refresh_token_is(refresh_token)).with_for_update().first()
+        if token is None:
+            return None
+        claimed = OAuth2Token.query.filter(
+            OAuth2Token.id == token.id,
+            OAuth2Token.refresh_token_active(now),
+        ).update({
+            OAuth2Token.access_token_revoked_at: now,
+            OAuth2Token.refresh_token_revoked_at: now,
+        }, synchronize_session=False)
+        if claimed:
+            db.session.info['wrote'] = True
+            revocation_feed.record([token], now)
+            self.rotated_access_token = token_storage.row_key(token)
             return token
+        db.session.refresh(token)
+        if token.refresh_token_revoked_at:
+            rotated_at = successor_issued_at(token)
+            grace = current_app.config.get('REFRESH_TOKEN_REUSE_GRACE', 10)
+            if rotated_at is not None and now - rotated_at >= grace:
+                revoke_token_family(token.family_id, now)
+        return None
 
     def authenticate_user(self, credential):
         return User.query.get(credential.user_id)
 
     def revoke_old_credential(self, credential):
-        credential.revoked = True
-        db.session.add(credential)
-        db.session.commit()
+        # revoked by authenticate_refresh_token, committed with the new token
+        token_cache.invalidate(self.rotated_access_token)
+        replica_router.wrote(self.rotated_access_token)
+
+
+def successor_issued_at(token):
+    """When the token that replaced ``token`` was issued, or ``None`` if
+    ``token`` was never rotated. Rotation commits the successor with the
+    revocation, so whoever sees one sees the other."""
+    return db.session.query(OAuth2Token.issued_at).filter(
+        OAuth2Token.family_id == token.family_id,
+        OAuth2Token.id > token.id,
+    ).order_by(OAuth2Token.id).limit(1).scalar()
+
+
+def revoke_token_family(family_id, now=None):
+    """Revoke every token rotated from the same grant, after a refresh token
+    was presented twice: one of the two parties holds a stolen token, and
+    there's no telling which."""
+    now = now or int(time.time())
+    match = OAuth2Token.family_id == family_id
+    active = OAuth2Token.query.filter(match, OAuth2Token.access_token_revoked_at == 0).all()
+    keys = [token_storage.row_key(t) for t in active]
+    revocation_feed.record(active, now)
+    OAuth2Token.query.filter(match).update({
+        OAuth2Token.access_token_revoked_at: case(
+            (OAuth2Token.access_token_revoked_at == 0, now),
+            else_=OAuth2Token.access_token_revoked_at),
+        OAuth2Token.refresh_token_revoked_at: case(
+            (OAuth2Token.refresh_token_revoked_at == 0, now),
+            else_=OAuth2Token.refresh_token_revoked_at),
+    }, synchronize_session=False)
+    db.session.commit()
+    for key in keys:
+        token_cache.invalidate(key)
+        replica_router.wrote(key)
+    metrics.refresh_token_reused()
+    return len(keys)
+
+
+class ClientCredentialsGrant(grants.ClientCredentialsGrant):
+    def create_token_response(self):
+        client = self.request.client
+        # a hashed token can't be handed out again
+        if client.client_metadata.get('reuse_tokens') and not jwt_access_tokens.enabled \
+                and not token_storage.hashed:
+            scope = client.get_allowed_scope(self.request.payload.scope)
+            token = reusable_client_token(client.client_id, scope)
+            if token is not None:
+                metrics.token_reused(client.client_id)
+                return 200, token, self.TOKEN_RESPONSE_HEADER
+        return super(ClientCredentialsGrant, self).create_token_response()
+
+
+# (client_id, scope) -> the access token last found for them; its state is
+# read from token_cache, which revocation invalidates
+_client_tokens = {}
+
+
+def reusable_client_token(client_id, scope):
+    """A token response for the newest active client_credentials token of
+    ``client_id`` for ``scope``, if it has more than
+    ``CLIENT_CREDENTIALS_REUSE_MIN_REMAINING`` of its lifetime left."""
+    key = (client_id, scope)
+    access_token = _client_tokens.get(key)
+    token = token_cache.get(access_token) if access_token else None
+    if token is None:
+        row = OAuth2Token.query.filter_by(
+            client_id=client_id, scope=scope, user_id=None, access_token_revoked_at=0,
+        ).order_by(OAuth2Token.issued_at.desc()).first()
+        if row is None:
+            return None
+        access_token = row.access_token
+        token = token_cache.set_token(access_token, row)
+        _client_tokens[key] = access_token
+    remaining = int(token.get_expires_at() - time.time())
+    min_remaining = current_app.config.get('CLIENT_CREDENTIALS_REUSE_MIN_REMAINING', 0.5)
+    if token.revoked or remaining <= token.expires_in * min_remaining:
+        return None
+    return {
+        'token_type': 'Bearer',
+        'access_token': access_token,
+        'expires_in': remaining,
+        'scope': token.scope,
+    }
+
+
+def resolve_bearer_token(token_string):
+    """Resolve an access token string to a cached token with its user.
+
+    Returns ``None`` for unknown tokens. Expiry and revocation are left to
+    the caller, the cache only saves the database round trips. JWT access
+    tokens are verified locally. A cached token or a JWT the revocation
+    feed suspects was revoked is checked on the primary.
+    """
+    claims = jwt_access_tokens.verify(token_string)
+    if claims is not None:
+        token = CachedToken.from_claims(claims)
+        hex_digest = token_hash(claims['jti'])
+        if revocation_feed.suspects(hex_digest):
+            generation = revocation_feed.generation
+            token.revoked = jwt_revoked(claims['jti'])
+            if not token.revoked:
+                revocation_feed.clear(hex_digest, generation)
+        return token
+    key = token_storage.key(token_string)
+    token = token_cache.get(key)
+    if token is None:
+        return load_bearer_token(key)
+    hex_digest = key_hash(key)
+    if token.revoked or not revocation_feed.suspects(hex_digest):
+        return token
+    generation = revocation_feed.generation
+    token = _load_bearer_token(key)
+    if token is not None and not token.revoked:
+        revocation_feed.clear(hex_digest, generation)
+    return token
+
+
+def _load_bearer_token(key):
+    # the token and its user in one round trip
+    token = OAuth2Token.query.options(joinedload(OAuth2Token.user)).filter(
+        token_storage.access_token_column == key).first()
+    if token is None:
+        return None
+    return token_cache.set_token(key, token, token.user)
+
+
+load_bearer_token = read_replica(sticky=True)(_load_bearer_token)
+
+
+def jwt_revoked(jti):
+    # JWT access tokens are stored under their jti
+    revoked_at = db.session.query(OAuth2Token.access_token_revoked_at).filter(
+        token_storage.access_token_column == token_storage.key(jti)).first()
+    return bool(revoked_at and revoked_at[0])
+
+
+_BearerTokenValidator = create_bearer_token_validator(db.session, OAuth2Token)
+
+
+class BearerTokenValidator(_BearerTokenValidator):
+    def authenticate_token(self, token_string):
+        return resolve_bearer_token(token_string)
+
+    def validate_token(self, token, scopes, request):
+        try:
+            super(BearerTokenValidator, self).validate_token(token, scopes, request)
+        except InvalidTokenError:
+            if not token:
+                metrics.token_validated('unknown')
+            elif token.is_expired():
+                metrics.token_validated('expired')
+            else:
+                metrics.token_validated('revoked')
+            raise
+        metrics.token_validated('valid')
+
+
+_RevocationEndpoint = create_revocation_endpoint(db.session, OAuth2Token)
+
+
+class RevocationEndpoint(_RevocationEndpoint):
+    def query_token(self, token_string, token_type_hint):
+        # JWT access tokens are stored under their jti
+        key = token_storage.key(token_id(token_string))
+        query = OAuth2Token.query
+        if token_type_hint != 'refresh_token':
+            token = query.filter(token_storage.access_token_column == key).first()
+            if token is not None or token_type_hint == 'access_token':
+                return token
+        return query.filter(token_storage.refresh_token_column == key).first()
+
+    def revoke_token(self, token, request):
+        if not token.access_token_revoked_at:
+            # committed by the revocation itself
+            revocation_feed.record([token])
+        super(RevocationEndpoint, self).revoke_token(token, request)
+        token_cache.invalidate(token_storage.row_key(token))
+        replica_router.wrote(token_storage.row_key(token))
+
+
+def query_tokens(token_strings):
+    """Look up many access/refresh token strings with one query.
+
+    Returns ``{token_string: (token, token_type)}`` for the strings that
+    matched, ``token_type`` being ``'access_token'`` or ``'refresh_token'``.
+    """
+    # JWT access tokens are stored under their jti
+    keys = {token_storage.key(token_id(s)): s for s in token_strings}
+    if not keys:
+        return {}
+    rows = OAuth2Token.query.options(joinedload(OAuth2Token.user)).filter(or_(
+        token_storage.access_token_column.in_(keys),
+        token_storage.refresh_token_column.in_(keys),
+    )).all()
+    found = {}
+    for row in rows:
+        for key, token_string in keys.items():
+            token_type = token_storage.match(row, key)
+            if token_type:
+                found[token_string] = (row, token_type)
+    return found
+
+
+class IntrospectionEndpoint(_IntrospectionEndpoint):
+    """RFC 7662 token introspection at ``/oauth/introspect``.
+
+    A client may introspect the tokens issued to it; the clients listed in
+    ``INTROSPECTION_CLIENTS`` (resource servers) may introspect any token.
+    Responses carry ``Cache-Control: max-age`` no longer than the token's
+    remaining lifetime nor ``INTROSPECTION_CACHE_MAX_AGE``, which bounds how
+    long a cached answer can miss a revocation.
+    """
+    CLIENT_AUTH_METHODS = ['client_secret_basic', 'client_secret_post']
+
+    def check_permission(self, token, client, request):
+        allowed = current_app.config.get('INTROSPECTION_CLIENTS') or ()
+        return client.client_id in allowed or token.client_id == client.client_id
+
+    def introspect(self, client, token_strings, request):
+        found = query_tokens(token_strings)
+        now = int(time.time())
+        results = []
+        for token_string in token_strings:
+            token, token_type = found.get(token_string, (None, None))
+            if token is None or not self.check_permission(token, client, request):
+                results.append({'active': False})
+            else:
+                results.append(self.introspect_token(token, token_type, now))
+        return results
+
+    def introspect_token(self, token, token_type='access_token', now=None):
+        now = now or int(time.time())
+        if token_type == 'refresh_token':
+            active = token.is_refresh_token_active()
+            exp = token.refresh_token_expires_at or token.issued_at + token.expires_in * 2
+        else:
+            active = not token.is_revoked() and not token.is_expired()
+            exp = token.issued_at + token.expires_in
+        if not active:
+            return {'active': False}
+        payload = {
+            'active': True,
+            'client_id': token.client_id,
+            'scope': token.get_scope(),
+            'iat': token.issued_at,
+            'iss': jwt_access_tokens.get_issuer(),
+        }
+        if token.expires_in:
+            payload['exp'] = exp
+        if token_type == 'access_token':
+            payload['token_type'] = token.token_type
+        if token.user is not None:
+            payload['sub'] = str(token.user.get_user_id())
+            payload['username'] = token.user.username
+        return payload
+
+    def cache_headers(self, payloads):
+        max_age = current_app.config.get('INTROSPECTION_CACHE_MAX_AGE', 60)
+        now = int(time.time())
+        for payload in payloads:
+            if 'exp' in payload:
+                max_age = min(max_age, payload['exp'] - now)
+        headers = [h for h in default_json_headers if h[0] not in ('Cache-Control', 'Pragma')]
+        headers.append(('Cache-Control', f'private, max-age={max(max_age, 0)}'))
+        return headers
+
+    def create_endpoint_response(self, request):
+        client = self.authenticate_endpoint_client(request)
+        self.check_params(request, client)
+        payload = self.introspect(client, [request.form['token']], request)[0]
+        return 200, payload, self.cache_headers([payload])
+
+
+class BatchIntrospectionEndpoint(IntrospectionEndpoint):
+    """Introspect several tokens in one request at ``/oauth/introspect/batch``.
+
+    Takes the ``token`` parameter repeated (at most ``INTROSPECTION_BATCH_SIZE``
+    times) and answers ``{"results": [...]}`` with one RFC 7662 response per
+    token, in request order, resolved with a single query.
+    """
+    ENDPOINT_NAME = 'introspection_batch'
+
+    def create_endpoint_response(self, request):
+        client = self.authenticate_endpoint_client(request)
+        token_strings = request.form.getlist('token')
+        if not token_strings:
+            raise InvalidRequestError('Missing token in request.')
+        limit = current_app.config.get('INTROSPECTION_BATCH_SIZE', 100)
+        if len(token_strings) > limit:
+            raise InvalidRequestError(f'At most {limit} tokens per request.')
+        payloads = self.introspect(client, token_strings, request)
+        return 200, {'results': payloads}, self.cache_headers(payloads)
+
+
+# clients are served from a parsed, read-only cache (see client_cache.py)
+query_client = client_registry.query_client
+_save_token = create_save_token_func(db.session, OAuth2Token)
+
+
+def save_token(token, request):
+    stored = token
+    if jwt_access_tokens.enabled:
+        stored = dict(token, access_token=token_id(token['access_token']))
+    if request.refresh_token is not None and 'refresh_token' in token:
+        # the new refresh token stays in the family of the one it replaces
+        stored = dict(stored, family_id=request.refresh_token.family_id)
+    event = token_events.token_issued(token, request)
+    _save_token(token_storage.columns(stored), request)
+    metrics.token_issued(request.payload.grant_type or 'implicit', request.client.client_id)
+    token_events.publish(event)
 
 
-query_client = create_query_client_func(db.session, OAuth2Client)
-save_token = create_save_token_func(db.session, OAuth2Token)
 authorization = AuthorizationServer(
     query_client=query_client,
     save_token=save_token,
@@ -85,19 +458,38 @@ require_oauth = ResourceProtector()
 
 def config_oauth(app):
     authorization.init_app(app)
+    token_cache.init_app(app)
+    client_registry.init_app(app)
+    password_hasher.init_app(app)
+    token_events.init_app(app)
+    code_store.init_app(app)
+    consent_store.init_app(app)
+    revocation_feed.init_app(app)
+    token_storage.init_app(app)
+
+    # sign access tokens as JWTs when JWT_ACCESS_TOKENS is on
+    jwt_access_tokens.init_app(app)
+    if jwt_access_tokens.enabled:
+        bearer = authorization.create_bearer_token_generator(app.config)
+        authorization.register_token_generator('default', JWTBearerToken(
+            jwt_access_tokens,
+            bearer.refresh_token_generator,
+            bearer.expires_generator,
+        ))
 
     # support all grants
     authorization.register_grant(grants.ImplicitGrant)
-    authorization.register_grant(grants.ClientCredentialsGrant)
+    authorization.register_grant(ClientCredentialsGrant)
     authorization.register_grant(AuthorizationCodeGrant, [CodeChallenge(required=True)])
     authorization.register_grant(PasswordGrant)
     authorization.register_grant(RefreshTokenGrant)
 
     # support revocation
-    revocation_cls = create_revocation_endpoint(db.session, OAuth2Token)
-    authorization.register_endpoint(revocation_cls)
+    authorization.register_endpoint(RevocationEndpoint)
+    # support introspection
+    authorization.register_endpoint(IntrospectionEndpoint)
+    authorization.register_endpoint(BatchIntrospectionEndpoint)
 
     # protect resource
-    bearer_cls = create_bearer_token_validator(db.session, OAuth2Token)
-    require_oauth.register_token_validator(bearer_cls())
+    require_oauth.register_token_validator(BearerTokenValidator())
 
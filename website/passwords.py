@@ -0,0 +1,187 @@
+# passwords.py
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import click
+from authlib.oauth2 import OAuth2Error
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when no hashing slot frees up within the queue timeout."""
+
+    def __init__(self, retry_after=1):
+        super(PasswordHasherBusy, self).__init__('password hashing is saturated')
+        self.retry_after = retry_after
+
+
+class TemporarilyUnavailableError(OAuth2Error):
+    error = 'temporarily_unavailable'
+    status_code = 503
+
+    def __init__(self, retry_after=1, **kwargs):
+        super(TemporarilyUnavailableError, self).__init__(**kwargs)
+        self.retry_after = retry_after
+
+    def get_headers(self):
+        headers = super(TemporarilyUnavailableError, self).get_headers()
+        headers.append(('Retry-After', str(self.retry_after)))
+        return headers
+
+
+class PasswordHasher(object):
+    """Hash and verify passwords in a small bounded thread pool.
+
+    Password hashes are slow on purpose, and hashlib releases the GIL while
+    computing them, so running them on a pool keeps the request thread's
+    worker responsive and lets ``PASSWORD_HASH_WORKERS`` cap how many cores
+    one process spends on them. At most ``PASSWORD_HASH_MAX_PENDING`` hashes
+    may be running or queued; a request that can't get a slot within
+    ``PASSWORD_HASH_QUEUE_TIMEOUT`` seconds gets ``PasswordHasherBusy``
+    instead of piling up behind the others.
+    """
+
+    def __init__(self, app=None):
+        self.method = 'pbkdf2:sha256:600000'
+        self.salt_length = 16
+        self.workers = 2
+        self.max_pending = 8
+        self.queue_timeout = 1.0
+        self.hashed = 0
+        self.verified = 0
+        self.rehashed = 0
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._pid = None
+        self._prefix = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.method = config.get('PASSWORD_HASH_METHOD', self.method)
+        self.salt_length = config.get('PASSWORD_SALT_LENGTH', self.salt_length)
+        self.workers = config.get('PASSWORD_HASH_WORKERS', self.workers)
+        self.max_pending = config.get('PASSWORD_HASH_MAX_PENDING', self.workers * 4)
+        self.queue_timeout = config.get('PASSWORD_HASH_QUEUE_TIMEOUT', self.queue_timeout)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._pid = None
+        self._prefix = None
+
+    @property
+    def executor(self):
+        # a pool created before gunicorn forks has no threads in the child
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix='password-hash')
+                    self._pid = pid
+        return self._executor
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self.rejected += 1
+            raise PasswordHasherBusy(retry_after=max(1, int(self.queue_timeout + 0.5)))
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future.result()
+
+    def _hash(self, password):
+        self.hashed += 1
+        return generate_password_hash(password, self.method, self.salt_length)
+
+    def _verify(self, pwhash, password):
+        self.verified += 1
+        if not check_password_hash(pwhash, password):
+            return False, None
+        if self.needs_rehash(pwhash):
+            self.rehashed += 1
+            return True, self._hash(password)
+        return True, None
+
+    @property
+    def prefix(self):
+        """Method part of a hash made with the current parameters, e.g.
+        ``pbkdf2:sha256:600000``, with werkzeug's defaults filled in."""
+        if self._prefix is None:
+            self._prefix = generate_password_hash('', self.method, 1).split('$', 1)[0]
+        return self._prefix
+
+    def needs_rehash(self, pwhash):
+        method, _, rest = pwhash.partition('$')
+        salt = rest.partition('$')[0]
+        return method != self.prefix or len(salt) != self.salt_length
+
+    def hash(self, password):
+        return self._run(self._hash, password)
+
+    def verify(self, pwhash, password):
+        """Return ``(ok, new_hash)``.
+
+        ``new_hash`` is set when the password matched but ``pwhash`` was made
+        with other parameters; it is computed in the same pool slot.
+        """
+        if not pwhash:
+            return False, None
+        return self._run(self._verify, pwhash, password)
+
+    def stats(self):
+        return {
+            'method': self.method,
+            'workers': self.workers,
+            'max_pending': self.max_pending,
+            'queue_timeout': self.queue_timeout,
+            'hashed': self.hashed,
+            'verified': self.verified,
+            'rehashed': self.rehashed,
+            'rejected': self.rejected,
+        }
+
+
+password_hasher = PasswordHasher()
+
+
+@click.command('password-benchmark')
+@click.option('--seconds', default=2.0, help='How long to run each round.')
+@click.option('--threads', type=int, help='Highest thread count to try.')
+@click.option('--method', help='Hash method, defaults to PASSWORD_HASH_METHOD.')
+@with_appcontext
+def benchmark_command(seconds, threads, method):
+    """Measure password hashes/sec, in total and per core."""
+    method = method or current_app.config.get('PASSWORD_HASH_METHOD', password_hasher.method)
+    salt_length = password_hasher.salt_length
+    cores = os.cpu_count() or 1
+    threads = threads or cores
+
+    def work(deadline):
+        count = 0
+        while time.perf_counter() < deadline:
+            generate_password_hash('benchmark password', method, salt_length)
+            count += 1
+        return count
+
+    click.echo(f'{method}, {cores} cores')
+    n = 1
+    while n <= threads:
+        with ThreadPoolExecutor(max_workers=n) as pool:
+            started = time.perf_counter()
+            futures = [pool.submit(work, started + seconds) for _ in range(n)]
+            count = sum(f.result() for f in futures)
+            elapsed = time.perf_counter() - started
+        rate = count / elapsed
+        click.echo(f'{n:>3} threads: {rate:8.1f} hashes/sec, '
+                   f'{rate / min(n, cores):8.1f} per core, '
+                   f'{elapsed / count * n * 1000:7.1f} ms per hash')
+        n = n * 2 if n * 2 <= threads or n == threads else threads
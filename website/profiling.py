@@ -0,0 +1,339 @@
+# profiling.py
+"""Opt-in profiles of single requests.
+
+A request is profiled when it is sampled (``PROFILE_SAMPLE_RATE`` of the
+requests to ``PROFILE_PATHS``) or when it carries a valid ``X-Profile``
+header, signed with ``PROFILE_SECRET`` for one path until an expiry::
+
+    $ flask profile-header /oauth/token
+    X-Profile: 1792234567.5f0c...
+
+A profiled request gets a sampling profiler call tree, as folded stacks
+("outer;inner;leaf" -> samples, as flamegraph.pl and speedscope read
+them), and a timeline of its SQL statements with their offsets and
+durations; parameters are reduced to their types, so no secret ends up in
+a profile. The profile is kept on the request as ``g.profile`` and, after
+the response, written by a background thread as
+``<PROFILE_DIR>/<id>.json.gz``; the response names it in
+``X-Profile-Id``. ADMIN_CLIENTS download profiles from /profiles.
+
+With neither a sample rate nor a secret nothing is hooked into the app or
+the engine, and the sampler thread only runs while a request is profiled.
+"""
+import atexit
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import queue
+import random
+import secrets
+import sys
+import threading
+import time
+import click
+from flask import current_app, g, request
+from flask.cli import with_appcontext
+from sqlalchemy import event
+
+HEADER = 'X-Profile'
+
+
+class Profile(object):
+
+    def __init__(self, thread_id, max_statements):
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        # ids sort by age, which is what pruning keeps by
+        self.id = '%s%03d-%s' % (time.strftime('%Y%m%dT%H%M%S', time.gmtime(self.started_at)),
+                                 self.started_at * 1000 % 1000, secrets.token_hex(4))
+        self.thread_id = thread_id
+        self.max_statements = max_statements
+        self.stacks = {}
+        self.samples = 0
+        self.statements = []
+        self.dropped_statements = 0
+        self._statement_started = None
+
+    def add_sample(self, frame):
+        names = []
+        while frame is not None and len(names) < 128:
+            code = frame.f_code
+            names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        stack = ';'.join(reversed(names))
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def before_statement(self):
+        self._statement_started = time.perf_counter()
+
+    def after_statement(self, statement, parameters, executemany):
+        started = self._statement_started or time.perf_counter()
+        self._statement_started = None
+        if len(self.statements) >= self.max_statements:
+            self.dropped_statements += 1
+            return
+        self.statements.append({
+            'at_ms': round((started - self.started) * 1000, 3),
+            'ms': round((time.perf_counter() - started) * 1000, 3),
+            'sql': statement,
+            'params': redact(parameters, executemany),
+        })
+
+    def record(self, status, interval):
+        return {
+            'id': self.id,
+            'pid': os.getpid(),
+            'started_at': self.started_at,
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.url_rule.endpoint if request.url_rule else None,
+            'status': status,
+            'ms': round((time.perf_counter() - self.started) * 1000, 3),
+            'sample_interval_ms': interval * 1000,
+            'samples': self.samples,
+            'stacks': self.stacks,
+            'sql_ms': round(sum(s['ms'] for s in self.statements), 3),
+            'sql': self.statements,
+            'sql_dropped': self.dropped_statements,
+        }
+
+
+def redact(parameters, executemany=False):
+    """The shape of DBAPI ``parameters`` without their values."""
+    if executemany:
+        return {'rows': len(parameters), 'first': redact(parameters[0]) if parameters else None}
+    if isinstance(parameters, dict):
+        return {k: type(v).__name__ for k, v in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(v).__name__ for v in parameters]
+    return type(parameters).__name__
+
+
+def sign(secret, path, expires):
+    message = f'{expires}:{path}'.encode()
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+class RequestProfiler(object):
+    """Samples the stacks of profiled requests and queues their profiles
+    for a writer thread, which keeps the newest ``PROFILE_MAX_FILES``."""
+
+    def __init__(self, app=None):
+        self.sample_rate = 0
+        self.paths = ()
+        self.secret = None
+        self.directory = None
+        self.interval = 0.002
+        self.max_files = 500
+        self.max_statements = 1000
+        self.queue_size = 100
+
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+
+        self._active = {}
+        self._wake = threading.Event()
+        self._local = threading.local()
+        self._queue = None
+        self._writer = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.sample_rate = config.get('PROFILE_SAMPLE_RATE', self.sample_rate)
+        self.paths = tuple(config.get('PROFILE_PATHS') or ())
+        self.secret = config.get('PROFILE_SECRET')
+        self.directory = config.get('PROFILE_DIR')
+        if self.directory is None and os.environ.get('RAILWAY_VOLUME_MOUNT_PATH'):
+            self.directory = os.path.join(os.environ['RAILWAY_VOLUME_MOUNT_PATH'], 'profiles')
+        self.interval = config.get('PROFILE_INTERVAL', self.interval)
+        self.max_files = config.get('PROFILE_MAX_FILES', self.max_files)
+        self.max_statements = config.get('PROFILE_MAX_STATEMENTS', self.max_statements)
+        if not self.enabled:
+            return
+
+        from .models import db
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(db.engine, 'after_cursor_execute', self._after_cursor_execute)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    @property
+    def enabled(self):
+        return bool(self.directory) and (self.sample_rate > 0 or bool(self.secret))
+
+    # triggering
+
+    def should_profile(self):
+        signature = request.headers.get(HEADER)
+        if signature:
+            return self.verify(signature, request.path)
+        return self.sample_rate > 0 and request.path.startswith(self.paths) \
+            and random.random() < self.sample_rate
+
+    def verify(self, signature, path):
+        if not self.secret:
+            return False
+        expires, _, mac = signature.partition('.')
+        try:
+            if int(expires) < time.time():
+                return False
+        except ValueError:
+            return False
+        return hmac.compare_digest(mac, sign(self.secret, path, expires))
+
+    def header(self, path, ttl=300):
+        expires = int(time.time() + ttl)
+        return f'{expires}.{sign(self.secret, path, expires)}'
+
+    # request hooks
+
+    def _before_request(self):
+        if not self.should_profile():
+            return
+        self._ensure_started()
+        profile = Profile(threading.get_ident(), self.max_statements)
+        g.profile = self._local.profile = profile
+        self._active[profile.thread_id] = profile
+        self._wake.set()
+
+    def _after_request(self, response):
+        profile = g.get('profile')
+        if profile is not None:
+            response.headers['X-Profile-Id'] = profile.id
+            g._profile_status = response.status_code
+        return response
+
+    def _teardown_request(self, exc=None):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return
+        self._active.pop(profile.thread_id, None)
+        self._local.profile = None
+        record = profile.record(g.pop('_profile_status', None), self.interval)
+        if exc is not None:
+            record['error'] = repr(exc)
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        profile = getattr(self._local, 'profile', None)
+        if profile is not None:
+            profile.before_statement()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        profile = getattr(self._local, 'profile', None)
+        if profile is not None:
+            profile.after_statement(statement, parameters, executemany)
+
+    # background threads
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._active = {}
+            self._wake = threading.Event()
+            threading.Thread(target=self._sample, name='profile-sampler', daemon=True).start()
+            self._writer = threading.Thread(target=self._write, name='profile-writer', daemon=True)
+            self._writer.start()
+            self._pid = os.getpid()
+            atexit.register(self.close)
+
+    def _sample(self):
+        # idle (blocked on the event) unless a request is being profiled
+        wake = self._wake
+        while True:
+            wake.wait()
+            wake.clear()
+            while self._active:
+                frames = sys._current_frames()
+                for thread_id, profile in list(self._active.items()):
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        profile.add_sample(frame)
+                del frames
+                time.sleep(self.interval)
+
+    def _write(self):
+        q = self._queue
+        while True:
+            record = q.get()
+            if record is None:
+                break
+            try:
+                self.save(record)
+                self.written += 1
+            except (IOError, OSError, TypeError, ValueError) as e:
+                self.errors += 1
+                print(f'Error writing profile: {e}')
+
+    def close(self, timeout=5.0):
+        if self._pid != os.getpid():
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._writer.join(timeout)
+        self._pid = None
+
+    # files
+
+    def save(self, record):
+        os.makedirs(self.directory, exist_ok=True)
+        data = gzip.compress(json.dumps(record, separators=(',', ':'), default=str).encode())
+        path = os.path.join(self.directory, record['id'] + '.json.gz')
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        self.prune()
+
+    def prune(self):
+        names = sorted(self.list())
+        for name in names[:max(0, len(names) - self.max_files)]:
+            try:
+                os.remove(os.path.join(self.directory, name + '.json.gz'))
+            except FileNotFoundError:
+                pass
+
+    def list(self):
+        """Ids of the stored profiles, newest first."""
+        if not self.directory or not os.path.isdir(self.directory):
+            return []
+        return sorted((name[:-len('.json.gz')] for name in os.listdir(self.directory)
+                       if name.endswith('.json.gz')), reverse=True)
+
+    def filename(self, profile_id):
+        if profile_id not in self.list():
+            return None
+        return profile_id + '.json.gz'
+
+
+request_profiler = RequestProfiler()
+
+
+@click.command('profile-header')
+@click.argument('path')
+@click.option('--ttl', type=int, default=300, help='Seconds the header stays valid.')
+@with_appcontext
+def profile_header_command(path, ttl):
+    """Print an X-Profile header that profiles requests to PATH."""
+    if not current_app.config.get('PROFILE_SECRET'):
+        raise click.UsageError('PROFILE_SECRET is not set')
+    click.echo(f'{HEADER}: {request_profiler.header(path, ttl)}')
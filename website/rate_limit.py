@@ -0,0 +1,272 @@
+# rate_limit.py
+import contextlib
+import fcntl
+import functools
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from authlib.oauth2 import OAuth2Error
+from flask import request, session
+from .metrics import metrics
+from .client_cache import client_registry
+from .oauth2 import authorization
+
+# key hash, tokens left, last update
+SLOT = struct.Struct('<Qdd')
+LOCK_STRIPES = 64
+
+
+class RateLimitExceeded(OAuth2Error):
+    # RFC 6749 has no rate limit error; this is its "try again later" one
+    error = 'temporarily_unavailable'
+    description = 'Rate limit exceeded, retry later.'
+    status_code = 429
+
+    def __init__(self, retry_after=1, **kwargs):
+        super(RateLimitExceeded, self).__init__(**kwargs)
+        self.retry_after = retry_after
+
+    def get_headers(self):
+        headers = super(RateLimitExceeded, self).get_headers()
+        headers.append(('Retry-After', str(self.retry_after)))
+        return headers
+
+
+class TokenBuckets(object):
+    """Token buckets in a fixed table of ``slots`` slots.
+
+    With a ``path`` the table is a memory-mapped file (on ``/dev/shm``) that
+    every worker of the node maps, and a slot is guarded by an ``fcntl``
+    lock on its bytes; without one it is private to the process. Keys are
+    hashed to a slot; a key that lands on a slot held by another key takes
+    it over with a full bucket, so a table much larger than the number of
+    active keys only ever errs on the side of letting requests through.
+    """
+
+    def __init__(self, path=None, slots=65536):
+        self.path = path
+        self.slots = slots
+        self._map = None
+        self._fd = None
+        self._pid = None
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._open_lock = threading.Lock()
+
+    def _open(self):
+        # mappings and fcntl locks are per process: open again after a fork
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._open_lock:
+            if self._pid == pid:
+                return
+            size = self.slots * SLOT.size
+            if self.path:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                if os.fstat(fd).st_size < size:
+                    os.ftruncate(fd, size)
+                self._map = mmap.mmap(fd, size)
+                self._fd = fd
+            else:
+                self._map = mmap.mmap(-1, size)
+                self._fd = None
+            self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+            self._pid = pid
+
+    def take(self, key, capacity, period, now=None):
+        """Take one token from ``key``'s bucket, which holds ``capacity``
+        tokens and refills completely in ``period`` seconds.
+
+        Returns 0 when allowed, otherwise the seconds until a token is back.
+        """
+        return self.take_all([(key, capacity, period)], now)[0]
+
+    def peek(self, key, capacity, period, now=None):
+        """The wait ``take`` would return, without taking a token."""
+        return self.take_all([(key, capacity, period)], now, charge=False)[0]
+
+    def take_all(self, buckets, now=None, charge=True):
+        """Take one token from each of ``buckets``, ``(key, capacity,
+        period)`` tuples, or from none of them if any is empty.
+
+        Returns the wait of each bucket as ``take`` does. The slots are
+        locked together, in slot order, so concurrent requests don't see a
+        bucket debited by a request that another bucket then rejects.
+        """
+        self._open()
+        now = now or time.time()
+        entries = []
+        for key, capacity, period in buckets:
+            digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+            entries.append((digest, digest % self.slots, capacity, capacity / period))
+        slots = sorted({slot for _, slot, _, _ in entries})
+        with contextlib.ExitStack() as stack:
+            for stripe in sorted({slot % LOCK_STRIPES for slot in slots}):
+                stack.enter_context(self._locks[stripe])
+            for slot in slots:
+                self._lock_slot(stack, slot * SLOT.size)
+            state = {slot: SLOT.unpack_from(self._map, slot * SLOT.size) for slot in slots}
+            refilled = []
+            for digest, slot, capacity, rate in entries:
+                owner, tokens, updated = state[slot]
+                if owner != digest:
+                    tokens, updated = capacity, now
+                tokens = min(capacity, tokens + (now - updated) * rate)
+                refilled.append(tokens)
+                state[slot] = (digest, tokens, now)
+            allowed = charge and all(tokens >= 1 for tokens in refilled)
+            for (digest, slot, _, _), tokens in zip(entries, refilled):
+                state[slot] = (digest, tokens - 1 if allowed else tokens, now)
+            for slot, values in state.items():
+                SLOT.pack_into(self._map, slot * SLOT.size, *values)
+        return [0 if tokens >= 1 else (1 - tokens) / rate
+                for (_, _, _, rate), tokens in zip(entries, refilled)]
+
+    def _lock_slot(self, stack, offset):
+        if self._fd is not None:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, SLOT.size, offset)
+            stack.callback(fcntl.lockf, self._fd, fcntl.LOCK_UN, SLOT.size, offset)
+
+
+class RateLimiter(object):
+    """Per-IP, per-client and per-user limits on the token and authorize
+    endpoints.
+
+    ``RATE_LIMITS`` maps ``ip``, ``client`` and ``user`` to ``(requests,
+    seconds)`` token buckets; a client's ``rate_limit`` metadata overrides
+    the ``client`` limit. Buckets are checked before the endpoint does any
+    token work, and all of them or none are charged. A request charges its
+    client's bucket only if it carries the client's secret; one that just
+    names a known client (``/oauth/authorize``, a public client) is charged
+    to that client's bucket for its IP, so nobody can drain another
+    client's bucket.
+
+    The same goes for users: the ``user`` bucket is the logged-in user's.
+    A sign-in by ``username`` is charged to the user bucket of its client
+    and IP, and to the user's own bucket once the password checked out
+    (``user_signed_in``). Wrong passwords are counted per username and IP
+    in the ``password_failures`` bucket; while it is empty that IP gets no
+    more passwords of the username checked (``check_password_failures``),
+    and the user signing in from elsewhere isn't affected.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.limits = {}
+        self.buckets = TokenBuckets()
+        self.allowed = 0
+        self.limited = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.enabled = config.get('RATE_LIMIT_ENABLED', False)
+        self.limits = dict(config.get('RATE_LIMITS') or {})
+        slots = config.get('RATE_LIMIT_SLOTS', 65536)
+        path = None
+        if config.get('RATE_LIMIT_STORE', 'shm') == 'shm':
+            path = config.get('RATE_LIMIT_SHM_PATH')
+            if not path:
+                # workers of one gunicorn master share its pid as their parent
+                directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+                path = os.path.join(directory, f'oauth2-ratelimit-{os.getppid()}.bin')
+        self.buckets = TokenBuckets(path, slots)
+
+    def request_keys(self):
+        """``(kind, key, limit)`` for the buckets this request counts against."""
+        req = request._get_current_object()
+        ip = req.remote_addr or ''
+        keys = []
+        limit = self.limits.get('ip')
+        if limit:
+            keys.append(('ip', 'ip:' + ip, limit))
+        auth = req.authorization
+        if auth and auth.type == 'basic':
+            client_id, secret = auth.username, auth.password
+        else:
+            client_id, secret = req.values.get('client_id'), req.form.get('client_secret')
+        # unknown client_ids are cached as such by the registry
+        client = client_registry.query_client(client_id) if client_id else None
+        if client is not None:
+            limit = client.client_metadata.get('rate_limit') or self.limits.get('client')
+            if limit:
+                key = 'client:' + client_id
+                if not (secret and client.client_secret and client.check_client_secret(secret)):
+                    key += '@' + ip
+                keys.append(('client', key, limit))
+        limit = self.limits.get('user')
+        if limit and session.get('id'):
+            keys.append(('user', f'user:{session["id"]}', limit))
+        elif limit and req.form.get('username'):
+            # a username is only someone's once the password checks out;
+            # charging it here would let anyone lock its owner out
+            keys.append(('user', f'user:?{client_id or ""}@{ip}', limit))
+        return keys
+
+    def check(self):
+        """Raise ``RateLimitExceeded`` if any of the request's buckets is empty."""
+        keys = self.request_keys()
+        waits = self.buckets.take_all([(key, capacity, period)
+                                       for _, key, (capacity, period) in keys])
+        if any(waits):
+            self._limited(*max(zip([kind for kind, _, _ in keys], waits), key=lambda kw: kw[1]))
+        self.allowed += 1
+
+    def user_signed_in(self, user_id):
+        """Charge a user whose password just checked out to their bucket."""
+        limit = self.limits.get('user')
+        if self.enabled and limit:
+            wait = self.buckets.take(f'user:{user_id}', *limit)
+            if wait:
+                self._limited('user', wait)
+
+    def check_password_failures(self, username):
+        """Raise ``RateLimitExceeded`` while the request's IP has no wrong
+        passwords for ``username`` left."""
+        limit = self.limits.get('password_failures')
+        if self.enabled and limit:
+            wait = self.buckets.peek(self._failures_key(username), *limit)
+            if wait:
+                self._limited('password_failures', wait)
+
+    def password_failed(self, username):
+        limit = self.limits.get('password_failures')
+        if self.enabled and limit:
+            self.buckets.take(self._failures_key(username), *limit)
+
+    def _failures_key(self, username):
+        return f'password_failures:{username}@{request.remote_addr or ""}'
+
+    def _limited(self, kind, wait):
+        self.limited += 1
+        metrics.rate_limited(kind)
+        raise RateLimitExceeded(retry_after=max(1, int(wait + 0.999)))
+
+    def limit(self, fn):
+        """Decorate a view; throttled requests get a 429 with ``Retry-After``."""
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if self.enabled:
+                try:
+                    self.check()
+                except RateLimitExceeded as error:
+                    return authorization.handle_error_response(request, error)
+            return fn(*args, **kwargs)
+        return wrapper
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'limits': self.limits,
+            'shared': self.buckets.path,
+            'allowed': self.allowed,
+            'limited': self.limited,
+        }
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,245 @@
+# request_log.py
+import atexit
+import contextlib
+import fcntl
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+
+def rotate(path, backup_count):
+    """Rename ``path`` to ``path.1``, shifting older copies up to
+    ``path.<backup_count>``; the caller holds the file's lock."""
+    for i in range(backup_count - 1, 0, -1):
+        src = f'{path}.{i}'
+        if os.path.exists(src):
+            os.replace(src, f'{path}.{i + 1}')
+    if backup_count > 0:
+        os.replace(path, f'{path}.1')
+    else:
+        os.remove(path)
+
+
+class RequestLogger(object):
+    """Background JSON-lines writer for request/response records.
+
+    Request threads only serialize a record and ``put_nowait`` it on a
+    bounded queue. A single writer thread drains the queue in batches,
+    appends them to ``<REQUEST_LOG_DIR>/app.log`` with one write per batch
+    and rotates the file by size or age. When the queue is full the record
+    is dropped and counted instead of blocking the request.
+
+    Every worker appends to the same file. A batch is written, and the file
+    rotated, under an ``flock`` on ``app.log.lock``. A worker whose file
+    was rotated by another one reopens it before writing, so batches land
+    in order in a single file.
+    """
+
+    def __init__(self, app=None):
+        self.directory = None
+        self.filename = 'app.log'
+        self.queue_size = 10000
+        self.batch_size = 500
+        self.flush_interval = 1.0
+        self.max_bytes = 10 * 1024 * 1024
+        self.rotate_seconds = 24 * 3600
+        self.backup_count = 5
+        self.max_body = 2048
+        self.sample_rate = 1.0
+        self.sample_rates = {}
+
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.errors = 0
+
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._file = None
+        self._lock_file = None
+        self._opened_at = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.directory = config.get(
+            'REQUEST_LOG_DIR', os.environ.get('RAILWAY_VOLUME_MOUNT_PATH'))
+        self.filename = config.get('REQUEST_LOG_FILENAME', self.filename)
+        self.queue_size = config.get('REQUEST_LOG_QUEUE_SIZE', self.queue_size)
+        self.batch_size = config.get('REQUEST_LOG_BATCH_SIZE', self.batch_size)
+        self.flush_interval = config.get(
+            'REQUEST_LOG_FLUSH_INTERVAL', self.flush_interval)
+        self.max_bytes = config.get('REQUEST_LOG_MAX_BYTES', self.max_bytes)
+        self.rotate_seconds = config.get(
+            'REQUEST_LOG_ROTATE_SECONDS', self.rotate_seconds)
+        self.backup_count = config.get(
+            'REQUEST_LOG_BACKUP_COUNT', self.backup_count)
+        self.max_body = config.get('REQUEST_LOG_MAX_BODY', self.max_body)
+        self.sample_rate = config.get('REQUEST_LOG_SAMPLE_RATE', self.sample_rate)
+        self.sample_rates = dict(config.get('REQUEST_LOG_SAMPLE_RATES') or {})
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, self.filename)
+
+    def should_sample(self, path):
+        rate = self.sample_rates.get(path, self.sample_rate)
+        if rate >= 1:
+            return True
+        return rate > 0 and random.random() < rate
+
+    def truncate(self, text):
+        if text and len(text) > self.max_body:
+            return text[:self.max_body] + '...[%d bytes]' % len(text)
+        return text
+
+    def log(self, record):
+        """Queue ``record`` (a JSON-serializable dict) without blocking."""
+        if not self.enabled:
+            return False
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    def stats(self):
+        return {
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+            'written': self.written,
+            'errors': self.errors,
+            'pending': self._queue.qsize() if self._queue else 0,
+        }
+
+    def _ensure_started(self):
+        # the writer thread does not survive a fork, so gunicorn workers
+        # forked from a preloaded master start their own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._file = None
+            self._lock_file = None
+            self._thread = threading.Thread(
+                target=self._run, name='request-log-writer', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+            atexit.register(self.close)
+
+    def close(self, timeout=5.0):
+        """Flush everything that is queued and stop the writer thread."""
+        if self._pid != os.getpid() or self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+        self._pid = None
+
+    def _run(self):
+        q = self._queue
+        stop = False
+        while not stop:
+            batch = []
+            try:
+                item = q.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            if item is None:
+                stop = True
+            else:
+                batch.append(item)
+            while not stop and len(batch) < self.batch_size:
+                try:
+                    item = q.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                else:
+                    batch.append(item)
+            if batch:
+                self._write(batch)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _write(self, batch):
+        lines = []
+        for record in batch:
+            try:
+                lines.append(json.dumps(
+                    record, separators=(',', ':'), default=str))
+            except (TypeError, ValueError):
+                self.errors += 1
+        data = '\n'.join(lines) + '\n'
+        try:
+            with self._locked():
+                f = self._open()
+                f.write(data)
+                f.flush()
+                self.written += len(lines)
+                if f.tell() >= self.max_bytes or \
+                        time.time() - self._opened_at >= self.rotate_seconds:
+                    self._rotate()
+        except (IOError, OSError) as e:
+            self.errors += 1
+            print(f'Error writing request log: {e}')
+            self._file = None
+
+    @contextlib.contextmanager
+    def _locked(self):
+        if self._lock_file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._lock_file = open(self.path + '.lock', 'a')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _open(self):
+        if self._file is not None and self._replaced():
+            # another worker rotated it
+            self._file.close()
+            self._file = None
+        if self._file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._file = open(self.path, 'a')
+            self._opened_at = time.time()
+        return self._file
+
+    def _replaced(self):
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        rotate(self.path, self.backup_count)
+
+
+request_logger = RequestLogger()
@@ -0,0 +1,277 @@
+# revocations.py
+"""Revocation feed for resource servers.
+
+Every revoked access token is appended to ``oauth2_token_revocation`` in
+the transaction that revokes it. Resource servers that cache validations
+poll the feed instead of the token table:
+
+- ``GET /oauth/revocations/bloom`` is a Bloom filter of the hashes of all
+  revoked, unexpired access tokens, rebuilt at most every
+  ``REVOCATION_SNAPSHOT_INTERVAL`` seconds and served with an ETag. A token
+  that isn't in the filter isn't revoked; a token that is may be a false
+  positive and is checked against the database (or introspection).
+- ``GET /oauth/revocations?cursor=N`` lists the revocations logged after
+  cursor ``N``, starting from the cursor the snapshot was built at, so a
+  resource server keeps its filter current between snapshots.
+
+Tokens are identified by the SHA-256 hex digest of the access token
+string, or of the ``jti`` of JWT access tokens.
+
+The workers of this server follow the feed the same way: cache_sync polls
+it into a filter per worker, and ``suspects`` tells the bearer token
+validation which cached tokens and JWTs to check in the database again.
+"""
+import hashlib
+import math
+import struct
+import threading
+import time
+from sqlalchemy import func, insert
+from .models import db, TokenRevocation
+from .metrics import metrics
+from .cache_sync import cache_sync, LogReader
+
+# expires_in=0 tokens never expire
+NEVER = 2 ** 31 - 1
+
+
+def token_hash(access_token):
+    return hashlib.sha256(access_token.encode()).hexdigest()
+
+
+def key_hash(key):
+    """The feed's hash of a token stored as ``key`` (token_storage.key);
+    a hashed key already is the digest."""
+    return key.hex() if isinstance(key, bytes) else token_hash(key)
+
+
+class BloomFilter(object):
+    """Bloom filter of token hashes.
+
+    Serialized as ``HEADER`` (magic ``RVBF``, version, number of hash
+    functions, number of bits, number of tokens, feed cursor; little
+    endian) followed by the bit array. The positions of a token are
+    ``(h1 + i * h2 + (i ** 3 - i) // 6) % bits`` for ``i`` in
+    ``range(hashes)``, where ``h1``
+    and ``h2`` are the first two little-endian 64-bit words of the raw
+    SHA-256 digest of the token.
+    """
+    HEADER = struct.Struct('<4sBBxxQQQ')
+    MAGIC = b'RVBF'
+    VERSION = 1
+
+    def __init__(self, bits, hashes, data=None, count=0, cursor=0):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray(data) if data is not None else bytearray((bits + 7) // 8)
+        self.count = count
+        self.cursor = cursor
+
+    @classmethod
+    def for_capacity(cls, items, false_positive_rate, cursor=0):
+        """An empty filter sized for ``items`` tokens at the given rate."""
+        items = max(items, 1)
+        bits = math.ceil(-items * math.log(false_positive_rate) / math.log(2) ** 2)
+        bits = max(64, (bits + 7) // 8 * 8)
+        hashes = max(1, round(bits / items * math.log(2)))
+        return cls(bits, hashes, cursor=cursor)
+
+    def _positions(self, digest):
+        # enhanced double hashing: the cubic term keeps the positions apart
+        # when h2 shares a factor with the number of bits
+        h1, h2 = struct.unpack_from('<QQ', digest)
+        return [(h1 + i * h2 + (i ** 3 - i) // 6) % self.bits for i in range(self.hashes)]
+
+    def add_hash(self, hex_digest):
+        for position in self._positions(bytes.fromhex(hex_digest)):
+            self.data[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def might_contain(self, access_token):
+        return self._contains(hashlib.sha256(access_token.encode()).digest())
+
+    def might_contain_hash(self, hex_digest):
+        return self._contains(bytes.fromhex(hex_digest))
+
+    def _contains(self, digest):
+        return all(self.data[p >> 3] & (1 << (p & 7)) for p in self._positions(digest))
+
+    @property
+    def false_positive_rate(self):
+        """Expected rate for the tokens it holds."""
+        if not self.count:
+            return 0.0
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) ** self.hashes
+
+    def to_bytes(self):
+        return self.HEADER.pack(self.MAGIC, self.VERSION, self.hashes,
+                                self.bits, self.count, self.cursor) + bytes(self.data)
+
+    @classmethod
+    def from_bytes(cls, payload):
+        magic, version, hashes, bits, count, cursor = cls.HEADER.unpack_from(payload)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError('not a revocation snapshot')
+        return cls(bits, hashes, payload[cls.HEADER.size:], count, cursor)
+
+
+class Snapshot(object):
+    __slots__ = ('payload', 'etag', 'cursor', 'tokens', 'built_at')
+
+    def __init__(self, bloom, built_at):
+        self.payload = bloom.to_bytes()
+        self.etag = hashlib.blake2b(self.payload, digest_size=12).hexdigest()
+        self.cursor = bloom.cursor
+        self.tokens = bloom.count
+        self.built_at = built_at
+
+
+class RevocationFeed(object):
+    """Records revocations and serves the feed and its snapshots.
+
+    Snapshots are built by the request that finds the current one older
+    than ``REVOCATION_SNAPSHOT_INTERVAL``; each worker keeps its own, and
+    its own filter for ``suspects``, which ``poll`` keeps current.
+    """
+
+    def __init__(self, app=None):
+        self.interval = 60
+        self.false_positive_rate = 0.001
+        self.page_size = 1000
+        self.filter_max_age = 3600
+        # revocations the worker's filter takes before it is rebuilt
+        self.filter_spare = 10000
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._filter = None
+        self._filter_built_at = 0
+        self._filter_capacity = 0
+        self._reader = LogReader(TokenRevocation)
+        # hashes that matched the filter but aren't revoked, and a counter
+        # bumped whenever a revocation arrives, so one read from the
+        # database before it isn't taken as clearing a token after it
+        self._cleared = set()
+        self.generation = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.interval = config.get('REVOCATION_SNAPSHOT_INTERVAL', self.interval)
+        self.false_positive_rate = config.get('REVOCATION_BLOOM_FP_RATE', self.false_positive_rate)
+        self.page_size = config.get('REVOCATION_FEED_PAGE_SIZE', self.page_size)
+        self.filter_max_age = config.get('REVOCATION_FILTER_MAX_AGE', self.filter_max_age)
+        self._snapshot = None
+        self._filter = None
+
+    def record(self, tokens, now=None):
+        """Log the revocation of the access tokens of ``tokens`` (rows, or
+        ``(access_token, issued_at, expires_in)`` tuples) in the current
+        transaction; the caller commits."""
+        now = now or int(time.time())
+        rows = []
+        for token in tokens:
+            if isinstance(token, tuple):
+                access_token, issued_at, expires_in = token
+                hex_digest = token_hash(access_token)
+            else:
+                issued_at, expires_in = token.issued_at, token.expires_in
+                # rows stored hashed only have the digest
+                if token.access_token_digest is not None:
+                    hex_digest = token.access_token_digest.hex()
+                else:
+                    hex_digest = token_hash(token.access_token)
+            rows.append({
+                'token_hash': hex_digest,
+                'revoked_at': now,
+                'expires_at': issued_at + expires_in if expires_in else NEVER,
+            })
+        if rows:
+            db.session.execute(insert(TokenRevocation), rows)
+
+    def changes(self, cursor=0, limit=None):
+        """Revocations logged after ``cursor`` whose tokens haven't expired,
+        and the cursor to ask from next."""
+        limit = min(limit or self.page_size, self.page_size)
+        rows = TokenRevocation.query.filter(TokenRevocation.id > cursor) \
+            .order_by(TokenRevocation.id).limit(limit).all()
+        now = time.time()
+        changes = [{
+            'cursor': row.id,
+            'token_hash': row.token_hash,
+            'revoked_at': row.revoked_at,
+            'expires_at': row.expires_at,
+        } for row in rows if row.expires_at > now]
+        next_cursor = rows[-1].id if rows else cursor
+        return changes, next_cursor, len(rows) == limit
+
+    def build(self, now=None, spare=0):
+        """A Bloom filter of every revoked, unexpired access token, with
+        room for ``spare`` more."""
+        now = int(now or time.time())
+        cursor = db.session.query(func.max(TokenRevocation.id)).scalar() or 0
+        hashes = [h for (h,) in db.session.query(TokenRevocation.token_hash).filter(
+            TokenRevocation.id <= cursor, TokenRevocation.expires_at > now).distinct()]
+        bloom = BloomFilter.for_capacity(len(hashes) + spare, self.false_positive_rate, cursor)
+        for hex_digest in hashes:
+            bloom.add_hash(hex_digest)
+        return bloom
+
+    def snapshot(self):
+        now = time.time()
+        current = self._snapshot
+        if current is not None and now - current.built_at < self.interval:
+            return current
+        with self._lock:
+            current = self._snapshot
+            if current is None or now - current.built_at >= self.interval:
+                bloom = self.build(now)
+                metrics.revocation_snapshot(len(bloom.data), bloom.count, bloom.false_positive_rate)
+                current = self._snapshot = Snapshot(bloom, now)
+        return current
+
+    def poll(self):
+        """Fold the revocations logged since the last poll into this
+        worker's filter. It is rebuilt once it is ``filter_max_age`` old,
+        dropping the tokens that expired, or holds ``filter_spare`` more
+        tokens than it was built with."""
+        now = time.time()
+        bloom = self._filter
+        if bloom is None or now - self._filter_built_at >= self.filter_max_age \
+                or bloom.count > self._filter_capacity:
+            bloom = self.build(now, self.filter_spare)
+            self._reader.start(bloom.cursor)
+            self._filter_built_at = now
+            self._filter_capacity = bloom.count + self.filter_spare
+            self._cleared = set()
+            self.generation += 1
+        changes = self._reader.read(TokenRevocation.token_hash, TokenRevocation.expires_at)
+        for _, hex_digest, expires_at in changes:
+            if expires_at > now:
+                bloom.add_hash(hex_digest)
+            self._cleared.discard(hex_digest)
+        if changes:
+            self.generation += 1
+        self._filter = bloom
+
+    def suspects(self, hex_digest):
+        """Whether the token with this hash may have been revoked, so a
+        cached validation or a JWT has to be checked in the database.
+        Always true until the worker's first poll, never when cache_sync
+        is off."""
+        if not cache_sync.enabled:
+            return False
+        bloom = self._filter
+        if bloom is None:
+            return True
+        return hex_digest not in self._cleared and bloom.might_contain_hash(hex_digest)
+
+    def clear(self, hex_digest, generation):
+        """Mark a suspect found not revoked by a read started at
+        ``generation``, so it isn't checked on every request."""
+        if generation == self.generation and len(self._cleared) < self.filter_spare:
+            self._cleared.add(hex_digest)
+
+
+revocation_feed = RevocationFeed()
+cache_sync.add_poller(revocation_feed.poll)
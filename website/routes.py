@@ -1,15 +1,32 @@
 # routes.py
-import json
 import os
 import time
+import requests
 from flask import Blueprint, request, session, url_for, flash, send_from_directory, after_this_request, current_app
-from flask import render_template, redirect, jsonify
+from flask import render_template, redirect, jsonify, g
 from werkzeug.security import gen_salt
 from authlib.integrations.flask_oauth2 import current_token
 from authlib.oauth2 import OAuth2Error
 from .models import db, User, OAuth2Client
-from .oauth2 import authorization, require_oauth
-from werkzeug.security import generate_password_hash, check_password_hash
+from .oauth2 import authorization, require_oauth, resolve_bearer_token
+from .token_cache import token_cache
+from .consent import consent_store
+from .revocations import revocation_feed
+from .request_log import request_logger
+from .jwt_tokens import jwt_access_tokens
+from .google_tokens import google_id_tokens, google_oauth_client
+from .passwords import PasswordHasherBusy
+from .metrics import metrics
+from .token_events import token_events
+from .db_routing import read_replica
+from .startup import readiness
+from .rate_limit import rate_limiter
+from .profiling import request_profiler
+from .upstream import CircuitOpen
+from .admin import (
+    admin_required, stream_progress, revoke_tokens, parse_client_specs,
+    provision_clients, rotate_client_secrets,
+)
 from datetime import datetime, timezone
 from functools import wraps
 
@@ -17,31 +34,31 @@ bp = Blueprint('home', __name__)
 
 
 def log_to_file(message):
-    file_path = os.path.join(os.environ['RAILWAY_VOLUME_MOUNT_PATH'], 'app.log')
-    try:
-        with open(file_path, 'a') as log_file:
-            log_file.write(message + "\n")
-    except IOError as e:
-        print(f'Error writing to file: {e}')
+    request_logger.log({'ts': time.time(), 'message': message})
 
 
 def detailed_logging(endpoint_func):
     @wraps(endpoint_func)
     def wrapper(*args, **kwargs):
-        log_message = f'Incoming request to {request.path}\n'
-        log_message += f'Method: {request.method}\n'
-        log_message += f'Headers: {json.dumps(dict(request.headers), indent=2)}\n'
-        log_message += f'Body: {request.get_data(as_text=True)}\n'
-
-        log_to_file(log_message)
+        if not request_logger.enabled or not request_logger.should_sample(request.path):
+            return endpoint_func(*args, **kwargs)
+
+        started = time.time()
+        record = {
+            'ts': started,
+            'path': request.path,
+            'method': request.method,
+            'headers': dict(request.headers),
+            'body': request_logger.truncate(request.get_data(as_text=True)),
+        }
 
         @after_this_request
         def log_response(response):
-            log_message = f'Outgoing response from {request.path}\n'
-            log_message += f'Status: {response.status}\n'
-            log_message += f'Headers: {json.dumps(dict(response.headers), indent=2)}\n'
+            record['status'] = response.status_code
+            record['response_headers'] = dict(response.headers)
             # Response body logging is not included here to avoid complexity and potential issues with binary data.
-            log_to_file(log_message)
+            record['duration_ms'] = round((time.time() - started) * 1000, 3)
+            request_logger.log(record)
             return response
 
         return endpoint_func(*args, **kwargs)
@@ -50,21 +67,19 @@ def detailed_logging(endpoint_func):
 
 
 def current_user():
-    if 'id' in session:
-        uid = session['id']
-        return User.query.get(uid)
-    return None
+    """The logged-in user, loaded at most once per request."""
+    if 'id' not in session:
+        return None
+    uid = session['id']
+    cached = g.get('current_user')
+    if cached is None or cached[0] != uid:
+        cached = g.current_user = (uid, load_user(uid))
+    return cached[1]
 
 
-def save_token_to_file(access_token):
-    # Use Railway's environment variable for the volume mount path
-    file_path = os.path.join(os.environ['RAILWAY_VOLUME_MOUNT_PATH'], 'access_token.txt')
-    try:
-        with open(file_path, 'w') as file:
-            file.write(access_token)
-        print(f'Access token saved to {file_path}')
-    except IOError as e:
-        print(f'Error writing to file: {e}')
+@read_replica
+def load_user(uid):
+    return User.query.get(uid)
 
 
 def split_by_crlf(s):
@@ -117,8 +132,9 @@ def file(filename):
 @bp.route('/new_home', methods=['GET', 'POST'])
 def new_home():
     # Check if user is already logged in
-    if current_user():
-        return render_template('new_home.html', user=current_user())
+    user = current_user()
+    if user:
+        return render_template('new_home.html', user=user, consents=consent_store.list(user.id))
 
     if request.method == 'POST':
         username = request.form['username']
@@ -132,8 +148,8 @@ def new_home():
                 return redirect(url_for('home.new_home'))
 
             # Create new user with hashed password
-            hashed_password = generate_password_hash(password)
-            new_user = User(username=username, password_hash=hashed_password)
+            new_user = User(username=username)
+            new_user.set_password(password)
             db.session.add(new_user)
             db.session.commit()
             flash('Registration successful. Please log in.')
@@ -143,7 +159,9 @@ def new_home():
             user = User.query.filter_by(username=username).first()
 
             # Verify password and log in user
-            if user and check_password_hash(user.password_hash, password):
+            if user and user.check_password(password):
+                # commits a rehashed password, if any
+                db.session.commit()
                 session['id'] = user.id
                 # Now let the user give consent
                 # return redirect(url_for('home.new_home'))
@@ -158,6 +176,15 @@ def new_home():
     return render_template('new_home.html')
 
 
+@bp.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(e):
+    response = jsonify(error='temporarily_unavailable',
+                       error_description='Too many logins in progress, try again shortly.')
+    response.status_code = 503
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
 @bp.route('/logout')
 def logout():
     del session['id']
@@ -193,6 +220,13 @@ def create_client():
         "scope": form["scope"],
         "token_endpoint_auth_method": form["token_endpoint_auth_method"]
     }
+    if form.get("rate_limit"):
+        # requests per minute on /oauth/token and /oauth/authorize
+        client_metadata["rate_limit"] = [int(form["rate_limit"]), 60]
+    if form.get("reuse_tokens"):
+        # client_credentials requests get the current token back while
+        # enough of its lifetime is left
+        client_metadata["reuse_tokens"] = True
     client.set_client_metadata(client_metadata)
 
     if form['token_endpoint_auth_method'] == 'none':
@@ -207,6 +241,7 @@ def create_client():
 
 
 @bp.route('/oauth/authorize', methods=['GET', 'POST'])
+@rate_limiter.limit
 @detailed_logging
 def authorize():
     # This state mismatch happens only when we go to google
@@ -237,6 +272,11 @@ def authorize():
             print("OAuth2Error encountered: %s", error.description)
             # Consider how to handle the error; returning detailed errors to the browser is for debugging only
             return jsonify({'error': str(error)}), 400
+        # a user who already approved these scopes for this client isn't
+        # asked again, unless the client asks for the page with prompt=consent
+        if request.args.get('prompt') != 'consent' and consent_store.covers(
+                user.id, grant.client.client_id, grant.request.payload.scope):
+            return authorization.create_authorization_response(grant_user=user, grant=grant)
         return render_template('authorize.html', user=user, grant=grant)
 
     # POST request handling remains unchanged
@@ -244,12 +284,29 @@ def authorize():
         username = request.form.get('username')
         user = User.query.filter_by(username=username).first()
 
+    try:
+        grant = authorization.get_consent_grant(end_user=user)
+    except OAuth2Error as error:
+        return authorization.handle_error_response(request, error)
+
     if request.form['confirm']:
         grant_user = user
+        consent_store.remember(user.id, grant.client.client_id, grant.request.payload.scope)
     else:
         grant_user = None
 
-    return authorization.create_authorization_response(grant_user=grant_user)
+    return authorization.create_authorization_response(grant_user=grant_user, grant=grant)
+
+
+@bp.route('/consents/revoke', methods=['POST'])
+def revoke_consents():
+    """Forget the logged-in user's consent to ``client_id``, or to every
+    client without one."""
+    user = current_user()
+    if not user:
+        return redirect(url_for('home.new_home'))
+    consent_store.revoke(user.id, request.form.get('client_id') or None)
+    return redirect(url_for('home.new_home'))
 
 
 # Shudh: working function with custom oauth commented to add a new function
@@ -267,6 +324,7 @@ def authorize():
 #     return response
 
 @bp.route('/oauth/token', methods=['POST'])
+@rate_limiter.limit
 @detailed_logging
 def issue_token():
     if 'oauth_flow' in session and session['oauth_flow'] == 'google':
@@ -274,7 +332,7 @@ def issue_token():
         auth_code = request.form.get('code')
         redirect_uri = request.form.get('redirect_uri')
 
-        google = current_app.config['GOOGLE_OAUTH_CLIENT']
+        google = google_oauth_client()
         try:
             # Exchange the authorization code for an access token
             token = google.fetch_token(
@@ -286,40 +344,55 @@ def issue_token():
             print(f"Google access token: {token}")
             session.pop('oauth_flow', None)  # Clear the OAuth flow from the session
             return jsonify({'success': True, 'token': token}), 200
+        except requests.RequestException as e:
+            return google_unavailable(e)
         except Exception as e:
             print(f"Error exchanging token: {e}")
             return jsonify({'error': 'Failed to exchange token'}), 400
     else:
-        # Existing custom OAuth flow
-        response = authorization.create_token_response()
-        response_data = response.get_data(as_text=True)
-        json_data = json.loads(response_data)
-        access_token = json_data.get('access_token', None)
-        if access_token is not None:
-            save_token_to_file(access_token)
-        return response
+        # Existing custom OAuth flow; issued tokens are published from
+        # save_token (see token_events.py)
+        return authorization.create_token_response()
 
 
 # start: google oauth
+def google_unavailable(error):
+    # Google timed out, failed, or its circuit is open; upstream.py has
+    # reported it already
+    response = jsonify(error='temporarily_unavailable',
+                       error_description='Google sign-in is unavailable, try again later')
+    response.status_code = 503
+    if isinstance(error, CircuitOpen):
+        response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
 @bp.route('/google/login')
 def google_login():
     # Store the flow type in the session to identify it later in the OAuth process
     session['oauth_flow'] = 'google'
-    google = current_app.config['GOOGLE_OAUTH_CLIENT']
+    google = google_oauth_client()
     # Retrieve the state intended for the custom GPT (OpenAI) from the session
     gpt_state = session.get('gpt_state')
     # redirect_uri = os.environ.get('OPENAI_REDIRECT_URI')
     redirect_uri = url_for('home.google_authorize', _external=True)
     # return google.authorize_redirect(redirect_uri, state=gpt_state)
-    return google.authorize_redirect(redirect_uri)
+    try:
+        return google.authorize_redirect(redirect_uri)
+    except requests.RequestException as e:
+        return google_unavailable(e)
 
 
 @bp.route('/google/authorize')
 def google_authorize():
-    google = current_app.config['GOOGLE_OAUTH_CLIENT']
-    redirect_uri = url_for('home.google_authorize', _external=True)
-    token = google.authorize_access_token(redirect_uri=redirect_uri)
-    user_info = google.parse_id_token(token)
+    google = google_oauth_client()
+    try:
+        # the redirect_uri comes back with the state saved by google_login
+        token = google.authorize_access_token()
+        # authorize_access_token has checked the ID token and its nonce
+        user_info = token.get('userinfo') or google.userinfo(token=token)
+    except requests.RequestException as e:
+        return google_unavailable(e)
 
     # Check if user exists, if not, create a new one
     user = User.query.filter_by(username=user_info['email']).first()
@@ -348,6 +421,162 @@ def revoke_token():
     return authorization.create_endpoint_response('revocation')
 
 
+@bp.route('/oauth/introspect', methods=['POST'])
+def introspect_token():
+    return authorization.create_endpoint_response('introspection')
+
+
+@bp.route('/oauth/introspect/batch', methods=['POST'])
+def introspect_tokens():
+    return authorization.create_endpoint_response('introspection_batch')
+
+
+@bp.route('/oauth/revocations')
+def revocation_changes():
+    # ?cursor= is the last cursor seen, or the snapshot's
+    try:
+        cursor = int(request.args.get('cursor', 0))
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'invalid_request'}), 400
+    changes, cursor, more = revocation_feed.changes(cursor, limit)
+    return jsonify(revocations=changes, cursor=cursor, more=more)
+
+
+@bp.route('/oauth/revocations/bloom')
+def revocation_snapshot():
+    snapshot = revocation_feed.snapshot()
+    response = current_app.response_class(snapshot.payload, mimetype='application/octet-stream')
+    response.set_etag(snapshot.etag)
+    response.headers['X-Revocation-Cursor'] = str(snapshot.cursor)
+    response.headers['Cache-Control'] = f'public, max-age={revocation_feed.interval}'
+    return response.make_conditional(request)
+
+
+def admin_params():
+    return request.get_json(silent=True) or request.form.to_dict()
+
+
+@bp.route('/admin/tokens/revoke', methods=['POST'])
+@admin_required
+def admin_revoke_tokens(admin):
+    # {"user_id": 1}, {"client_id": "..."} or {"client_id": "...", "scope": "..."}
+    params = admin_params()
+    try:
+        user_id = int(params['user_id']) if params.get('user_id') not in (None, '') else None
+    except (TypeError, ValueError):
+        return jsonify(error='invalid_request', error_description='user_id must be an integer'), 400
+    client_id = params.get('client_id') or None
+    scope = params.get('scope') or None
+    if (user_id is None and client_id is None) or (scope and client_id is None):
+        return jsonify(error='invalid_request',
+                       error_description='give user_id, client_id, or client_id and scope'), 400
+    return stream_progress(revoke_tokens(user_id, client_id, scope))
+
+
+@bp.route('/admin/clients', methods=['POST'])
+@admin_required
+def admin_provision_clients(admin):
+    # {"clients": [{"client_name": ..., ...}, ...]}, owned by the admin
+    # client's user unless "user_id" is given
+    params = request.get_json(silent=True) or {}
+    try:
+        specs = parse_client_specs(params.get('clients'),
+                                   current_app.config.get('ADMIN_MAX_CLIENTS', 10000))
+    except ValueError as e:
+        return jsonify(error='invalid_request', error_description=str(e)), 400
+    return stream_progress(provision_clients(specs, params.get('user_id') or admin.user_id))
+
+
+@bp.route('/admin/clients/rotate', methods=['POST'])
+@admin_required
+def admin_rotate_client_secrets(admin):
+    # {"client_ids": [...]}
+    client_ids = (request.get_json(silent=True) or {}).get('client_ids')
+    limit = current_app.config.get('ADMIN_MAX_CLIENTS', 10000)
+    if not isinstance(client_ids, list) or not client_ids or len(client_ids) > limit \
+            or not all(isinstance(c, str) for c in client_ids):
+        return jsonify(error='invalid_request',
+                       error_description=f'client_ids must list 1 to {limit} client ids'), 400
+    return stream_progress(rotate_client_secrets(client_ids))
+
+
+@bp.route('/profiles')
+@admin_required
+def list_profiles(admin):
+    # newest first; each one is gzipped JSON, see website/profiling.py
+    limit = request.args.get('limit', 100, type=int)
+    return jsonify(profiles=request_profiler.list()[:limit])
+
+
+@bp.route('/profiles/<profile_id>')
+@admin_required
+def download_profile(admin, profile_id):
+    filename = request_profiler.filename(profile_id)
+    if filename is None:
+        return jsonify({'error': 'not_found'}), 404
+    return send_from_directory(request_profiler.directory, filename,
+                               mimetype='application/gzip', as_attachment=True)
+
+
+@bp.route('/.well-known/jwks.json')
+def jwks():
+    if not jwt_access_tokens.enabled:
+        return jsonify({'error': 'not_found'}), 404
+    response = jsonify(jwt_access_tokens.keys.public_jwks())
+    # rotated keys stay listed, so resource servers can cache this briefly
+    response.headers['Cache-Control'] = 'public, max-age=300'
+    return response
+
+
+@bp.route('/metrics')
+def prometheus_metrics():
+    if not metrics.enabled:
+        return jsonify({'error': 'not_found'}), 404
+    scrape_token = current_app.config.get('METRICS_TOKEN')
+    if scrape_token and request.headers.get('Authorization') != f'Bearer {scrape_token}':
+        return jsonify({'error': 'unauthorized'}), 401
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@bp.route('/healthz')
+def healthz():
+    # liveness: the worker is up; doesn't touch the database
+    return jsonify({'status': 'ok'})
+
+
+@bp.route('/readyz')
+def readyz():
+    # readiness: the first call of each worker warms its connection pools
+    ready, details = readiness.check(current_app)
+    return jsonify(status='ready' if ready else 'unavailable', **details), 200 if ready else 503
+
+
+@bp.route('/api/token_events')
+@admin_required
+def recent_token_events(admin):
+    # token_issued events kept by this worker's memory sink; they name who
+    # got tokens for what, so only ADMIN_CLIENTS see them
+    if token_events.memory is None:
+        return jsonify({'error': 'not_found'}), 404
+    limit = request.args.get('limit', 100, type=int)
+    events = [{k: v for k, v in e.items() if k != 'access_token'}
+              for e in token_events.memory.recent(limit)]
+    return jsonify({'events': events, 'stats': token_events.stats()})
+
+
+@bp.route('/api/rate_limits')
+def rate_limit_stats():
+    # counters of this worker's rate limiter
+    return jsonify(rate_limiter.stats())
+
+
+@bp.route('/api/token_cache')
+def token_cache_stats():
+    # hit/miss counters of this worker's bearer token cache
+    return jsonify(token_cache.stats())
+
+
 @bp.route('/api/me')
 @require_oauth('profile')
 def api_me():
@@ -361,8 +590,9 @@ from werkzeug.exceptions import Unauthorized
 from .models import db, OAuth2Token, User
 
 
-def validate_bearer_token():
-    authorization = request.headers.get("Authorization", None)
+def bearer_token_value(authorization):
+    """Token string of an ``Authorization`` header value; these rules are
+    shared with the async resource server (asgi.py)."""
     if not authorization:
         raise Unauthorized(description="Authorization header is missing.")
 
@@ -370,15 +600,31 @@ def validate_bearer_token():
     if not authorization.startswith(prefix):
         raise Unauthorized(description="Invalid authorization header format.")
 
-    token_value = authorization[len(prefix):]
-    token = OAuth2Token.query.filter_by(access_token=token_value).first()
+    return authorization[len(prefix):]
+
 
-    # Instead of checking revoked, check if the token is expired
-    if not token or token.expires_in + token.issued_at < datetime.now(timezone.utc).timestamp():
+def is_token_expired(token):
+    # revocation is checked separately, see CachedToken.is_revoked
+    return token.expires_in + token.issued_at < datetime.now(timezone.utc).timestamp()
+
+
+def validate_bearer_token():
+    token_value = bearer_token_value(request.headers.get("Authorization", None))
+    token = resolve_bearer_token(token_value)
+
+    if not token:
+        metrics.token_validated('unknown')
+        raise Unauthorized(description="Invalid or expired token.")
+    if is_token_expired(token):
+        metrics.token_validated('expired')
+        raise Unauthorized(description="Invalid or expired token.")
+    if token.is_revoked():
+        metrics.token_validated('revoked')
         raise Unauthorized(description="Invalid or expired token.")
+    metrics.token_validated('valid')
 
-    # Fetch the user associated with the token
-    user = User.query.get(token.user_id)
+    # The user associated with the token is resolved (and cached) with it
+    user = token.user
     if not user:
         raise Unauthorized(description="User not found.")
 
@@ -387,27 +633,31 @@ def validate_bearer_token():
 
 
 def validate_bearer_token_1():
-    google = current_app.config['GOOGLE_OAUTH_CLIENT']
-    authorization = request.headers.get("Authorization", None)
-    if not authorization:
-        raise Unauthorized(description="Authorization header is missing.")
-
-    prefix = "Bearer "
-    if not authorization.startswith(prefix):
-        raise Unauthorized(description="Invalid authorization header format.")
-
-    token_value = authorization[len(prefix):]
-    token = OAuth2Token.query.filter_by(access_token=token_value).first()
+    token_value = bearer_token_value(request.headers.get("Authorization", None))
+    # tokens that recently failed both checks are rejected without any work
+    if google_id_tokens.is_rejected(token_value):
+        metrics.token_validated('unknown')
+        raise Unauthorized(description="Invalid or expired token.")
+    token = resolve_bearer_token(token_value)
 
     if token:
-        if token.expires_in + token.issued_at < datetime.now(timezone.utc).timestamp():
+        if is_token_expired(token):
+            metrics.token_validated('expired')
+            raise Unauthorized(description="Invalid or expired token.")
+        if token.is_revoked():
+            metrics.token_validated('revoked')
             raise Unauthorized(description="Invalid or expired token.")
-        user = User.query.get(token.user_id)
+        metrics.token_validated('valid')
+        user = token.user
     else:
-        user_info = google.parse_id_token(token_value)
+        # Google ID tokens are verified locally against Google's cached JWKS
+        user_info = google_id_tokens.verify(token_value)
         if not user_info:
+            google_id_tokens.reject(token_value)
+            metrics.token_validated('unknown')
             raise Unauthorized(description="Invalid or expired token.")
-        user = User.query.filter_by(username=user_info['email']).first()
+        metrics.token_validated('google_fallback')
+        user = google_id_tokens.find_user(user_info['email'])
 
     if not user:
         raise Unauthorized(description="User not found.")
@@ -0,0 +1,256 @@
+# settings.py
+
+# Bearer token validation cache (website/token_cache.py). Entries never
+# outlive the token itself; a TTL or size of 0 disables the cache.
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 60
+
+# Request/response log (website/request_log.py), written as JSON lines by a
+# background thread. REQUEST_LOG_DIR defaults to RAILWAY_VOLUME_MOUNT_PATH;
+# logging is off when neither is set.
+REQUEST_LOG_QUEUE_SIZE = 10000
+REQUEST_LOG_BATCH_SIZE = 500
+REQUEST_LOG_FLUSH_INTERVAL = 1.0
+REQUEST_LOG_MAX_BYTES = 10 * 1024 * 1024
+REQUEST_LOG_ROTATE_SECONDS = 24 * 3600
+REQUEST_LOG_BACKUP_COUNT = 5
+REQUEST_LOG_MAX_BODY = 2048
+REQUEST_LOG_SAMPLE_RATE = 1.0
+# per-path overrides, e.g. {'/api/pets': 0.1}
+REQUEST_LOG_SAMPLE_RATES = {}
+
+# Self-contained JWT access tokens (RFC 9068, website/jwt_tokens.py).
+# Keys live in JWT_KEYS_FILE (default: jwt_keys.json on the volume) and
+# are rotated with `flask jwt-rotate-key`; JWT_ISSUER/JWT_AUDIENCE default
+# to the request host. Revoked JWTs are refused once the worker has polled
+# the revocation feed (CACHE_SYNC_INTERVAL below).
+JWT_ACCESS_TOKENS = False
+JWT_ISSUER = None
+JWT_AUDIENCE = None
+JWT_ALG = 'RS256'
+JWT_KEYS_FILE = None
+JWT_MAX_KEYS = 3
+JWT_KEYS_RELOAD_INTERVAL = 30
+JWT_ACCESS_TOKEN_EXPIRES_IN = 3600
+
+# Local verification of Google ID tokens on the resource endpoints
+# (website/google_tokens.py). GOOGLE_CLIENT_ID defaults to the environment
+# variable; GOOGLE_JWKS pins a static key set instead of fetching one.
+GOOGLE_JWKS_URI = 'https://www.googleapis.com/oauth2/v3/certs'
+GOOGLE_JWKS = None
+GOOGLE_JWKS_TIMEOUT = 5
+GOOGLE_JWKS_MIN_REFRESH_INTERVAL = 60
+GOOGLE_USER_CACHE_SIZE = 10000
+GOOGLE_USER_CACHE_TTL = 60
+GOOGLE_NEGATIVE_CACHE_SIZE = 10000
+GOOGLE_NEGATIVE_CACHE_TTL = 300
+
+# "Sign in with Google" (website/google_client.py) and outbound HTTP to
+# Google (website/upstream.py). Requests share a keep-alive pool of
+# GOOGLE_HTTP_POOL_SIZE connections per host and worker, which should cover
+# the requests a worker serves at once (see gunicorn.conf.py). A host that
+# fails GOOGLE_BREAKER_FAILURES times in a row gets no requests for
+# GOOGLE_BREAKER_RESET seconds; sign-ins answer 503 meanwhile. The
+# discovery document is reloaded every GOOGLE_METADATA_TTL seconds. Point
+# the URLs at a local IdP to test the flow; GOOGLE_CLIENT_SECRET defaults
+# to the environment variable.
+GOOGLE_DISCOVERY_URL = 'https://accounts.google.com/.well-known/openid-configuration'
+GOOGLE_AUTHORIZE_URL = 'https://accounts.google.com/o/oauth2/auth'
+GOOGLE_ACCESS_TOKEN_URL = 'https://accounts.google.com/o/oauth2/token'
+GOOGLE_API_BASE_URL = 'https://www.googleapis.com/oauth2/v1/'
+GOOGLE_METADATA_TTL = 3600
+GOOGLE_HTTP_CONNECT_TIMEOUT = 3.05
+GOOGLE_HTTP_READ_TIMEOUT = 10
+GOOGLE_HTTP_POOL_SIZE = 10
+GOOGLE_BREAKER_FAILURES = 5
+GOOGLE_BREAKER_RESET = 30
+
+# Parsed OAuth2Client cache used by query_client (website/client_cache.py).
+# Unknown client_ids are cached too; a client created in another worker is
+# found there after CLIENT_NEGATIVE_CACHE_TTL seconds at most.
+CLIENT_CACHE_SIZE = 1000
+CLIENT_CACHE_TTL = 300
+CLIENT_NEGATIVE_CACHE_SIZE = 10000
+CLIENT_NEGATIVE_CACHE_TTL = 10
+
+# Expired/revoked token and authorization code cleanup (website/sweeper.py).
+# Run `flask sweep-tokens`, or set SWEEPER_INTERVAL to sweep in-process.
+SWEEPER_TOKEN_RETENTION = 24 * 3600
+SWEEPER_CODE_RETENTION = 3600
+SWEEPER_BATCH_SIZE = 1000
+SWEEPER_MAX_BATCHES = None
+SWEEPER_BATCH_PAUSE = 0.05
+SWEEPER_INTERVAL = 0
+
+# Password hashing pool (website/passwords.py). Logins that can't get a slot
+# within the timeout get a 503. scrypt hashes don't fit password_hash (128).
+PASSWORD_HASH_METHOD = 'pbkdf2:sha256:600000'
+PASSWORD_SALT_LENGTH = 16
+PASSWORD_HASH_WORKERS = 2
+PASSWORD_HASH_MAX_PENDING = 8
+PASSWORD_HASH_QUEUE_TIMEOUT = 1.0
+
+# Token introspection (/oauth/introspect, /oauth/introspect/batch). Listed
+# clients may introspect any token, others only their own.
+INTROSPECTION_CLIENTS = []
+INTROSPECTION_BATCH_SIZE = 100
+INTROSPECTION_CACHE_MAX_AGE = 60
+
+# Bulk admin API (website/admin.py): /admin/tokens/revoke, /admin/clients
+# and /admin/clients/rotate answer the listed clients, authenticated with
+# HTTP Basic, for at most ADMIN_MAX_CLIENTS clients per request. The
+# revoke-tokens, provision-clients and rotate-client-secrets commands do
+# the same from the shell.
+ADMIN_CLIENTS = []
+ADMIN_MAX_CLIENTS = 10000
+
+# Per-request profiling (website/profiling.py), off by default: requests
+# to PROFILE_PATHS are sampled at PROFILE_SAMPLE_RATE, and requests with an
+# X-Profile header signed with PROFILE_SECRET (`flask profile-header PATH`)
+# are always profiled. Profiles (folded stacks sampled every
+# PROFILE_INTERVAL seconds, plus the SQL timeline without parameter values)
+# go to PROFILE_DIR, by default profiles/ on RAILWAY_VOLUME_MOUNT_PATH,
+# which keeps the newest PROFILE_MAX_FILES; ADMIN_CLIENTS get them from
+# /profiles.
+PROFILE_SAMPLE_RATE = 0
+PROFILE_PATHS = ['/oauth/authorize', '/oauth/token']
+PROFILE_SECRET = None
+PROFILE_DIR = None
+PROFILE_INTERVAL = 0.002
+PROFILE_MAX_FILES = 500
+PROFILE_MAX_STATEMENTS = 1000
+
+# Prometheus metrics at /metrics (website/metrics.py). Workers share their
+# counters through snapshot files in METRICS_DIR, by default a directory in
+# the temp dir named after the gunicorn master's pid; snapshots of exited
+# workers are folded into its retired.json. Set METRICS_TOKEN to require
+# "Authorization: Bearer <token>" on scrapes.
+METRICS_ENABLED = True
+METRICS_DIR = None
+METRICS_FLUSH_INTERVAL = 5
+METRICS_TOKEN = None
+
+# token_issued events (website/token_events.py), delivered off the request
+# thread. Sinks: file, sql (oauth2_token_event table), memory
+# (/api/token_events, for ADMIN_CLIENTS) and access_token_file (the old
+# access_token.txt). The file rotates at TOKEN_EVENTS_MAX_BYTES and keeps
+# TOKEN_EVENTS_BACKUP_COUNT old copies.
+TOKEN_EVENT_SINKS = ['file', 'memory']
+TOKEN_EVENTS_FILE = None
+TOKEN_EVENTS_MAX_BYTES = 10 * 1024 * 1024
+TOKEN_EVENTS_BACKUP_COUNT = 5
+TOKEN_EVENTS_QUEUE_SIZE = 10000
+TOKEN_EVENTS_BUFFER_SIZE = 1000
+TOKEN_EVENTS_INCLUDE_TOKEN = False
+
+# Connection pool (website/db_routing.py); None keeps SQLAlchemy's default.
+SQLALCHEMY_POOL_SIZE = None
+SQLALCHEMY_MAX_OVERFLOW = None
+SQLALCHEMY_POOL_TIMEOUT = None
+SQLALCHEMY_POOL_RECYCLE = 1800
+SQLALCHEMY_POOL_PRE_PING = True
+
+# Read replicas for token/client/user lookups, also read from the
+# comma-separated DATABASE_REPLICA_URLS. Lookups that miss on a replica, or
+# that hit a replica that fails, are retried on the primary.
+SQLALCHEMY_REPLICA_URIS = []
+SQLALCHEMY_REPLICA_RETRY_INTERVAL = 30
+SQLALCHEMY_REPLICA_STICKY_SECONDS = 10
+
+# Where authorization codes live between /oauth/authorize and /oauth/token
+# (website/code_store.py): sql (oauth2_code table), memory (this process
+# only), shm (SQLite on /dev/shm, shared by the workers of one node) or
+# redis (AUTHORIZATION_CODE_REDIS_URL, default REDIS_URL; needs the redis
+# package). Codes are redeemed with one atomic get-and-delete.
+AUTHORIZATION_CODE_STORE = 'sql'
+AUTHORIZATION_CODE_TTL = 300
+AUTHORIZATION_CODE_SHM_PATH = None
+AUTHORIZATION_CODE_REDIS_URL = None
+
+# Boot (website/app.py, website/startup.py). With FAST_START, create_app
+# doesn't create tables or set OAUTHLIB_INSECURE_TRANSPORT; run
+# `flask db-upgrade` (website/migrations.py) once per deploy instead, and
+# /readyz reports 503 until the schema is current. STARTUP_REPORT prints
+# the time spent per boot phase; `flask startup-report` shows it too.
+# /readyz opens READYZ_WARM_CONNECTIONS (default: the pool size) primary
+# connections on its first call in each worker.
+FAST_START = False
+STARTUP_REPORT = False
+READYZ_WARM_CONNECTIONS = None
+
+# Async resource server for /api/me, /api/data and /api/pets
+# (website/asgi.py, `uvicorn asgi:app`). ASYNC_DATABASE_URI defaults to
+# SQLALCHEMY_DATABASE_URI with the aiosqlite or asyncpg driver.
+ASYNC_DATABASE_URI = None
+
+# Rate limits on /oauth/token and /oauth/authorize (website/rate_limit.py):
+# token buckets of (requests, seconds) per IP, per client and per user,
+# all charged or none. A request without the client's secret is charged to
+# the client's bucket for its IP only, and a password grant to the user
+# bucket of its client and IP until the password checks out; wrong
+# passwords are counted per username and IP in password_failures, and that
+# IP gets no more checked while it is empty. A client's "rate_limit" metadata
+# overrides the client limit. RATE_LIMIT_STORE 'shm' shares the
+# buckets between the workers of a node through a file on /dev/shm;
+# 'memory' keeps them per process. Throttled requests get a 429 with
+# Retry-After and error temporarily_unavailable.
+RATE_LIMIT_ENABLED = False
+RATE_LIMITS = {
+    'ip': (300, 60),
+    'client': (600, 60),
+    'user': (30, 60),
+    'password_failures': (10, 60),
+}
+RATE_LIMIT_STORE = 'shm'
+RATE_LIMIT_SHM_PATH = None
+RATE_LIMIT_SLOTS = 65536
+
+# Clients with "reuse_tokens" metadata get their newest unrevoked
+# client_credentials token for the same scope back, instead of a new row,
+# while more than this share of its lifetime is left. Not for JWT access
+# tokens, which aren't stored.
+CLIENT_CREDENTIALS_REUSE_MIN_REMAINING = 0.5
+
+# Refresh token rotation (website/oauth2.py). A refresh token presented
+# again after it was rotated revokes every token of its family, unless the
+# rotation is less than REFRESH_TOKEN_REUSE_GRACE seconds old: a client
+# that sent one refresh twice (a retry, two tabs) gets invalid_grant for
+# the second and keeps the tokens of the first. Refresh tokens revoked
+# through /oauth/revoke or the admin API are only rejected.
+REFRESH_TOKEN_REUSE_GRACE = 10
+
+# Remembered consent (website/consent.py): approving a client on the
+# authorization page is remembered for CONSENT_TTL seconds, and later
+# authorizations for the same or fewer scopes skip the page (0 turns it
+# off; prompt=consent always shows it). Users revoke consents from
+# /new_home. Lookups are cached per process for CONSENT_CACHE_TTL seconds;
+# revocations reach the other workers through CACHE_SYNC_INTERVAL.
+CONSENT_TTL = 30 * 86400
+CONSENT_CACHE_SIZE = 10000
+CONSENT_CACHE_TTL = 60
+
+# Revocation feed for resource servers (website/revocations.py):
+# /oauth/revocations/bloom is a Bloom filter of revoked, unexpired access
+# tokens, rebuilt at most every REVOCATION_SNAPSHOT_INTERVAL seconds and
+# sized for REVOCATION_BLOOM_FP_RATE false positives; /oauth/revocations
+# lists the revocations after a cursor, REVOCATION_FEED_PAGE_SIZE at most.
+REVOCATION_SNAPSHOT_INTERVAL = 60
+REVOCATION_BLOOM_FP_RATE = 0.001
+REVOCATION_FEED_PAGE_SIZE = 1000
+
+# Cross-worker cache invalidation (website/cache_sync.py): every worker
+# polls the revocation feed and oauth2_cache_invalidation each
+# CACHE_SYNC_INTERVAL seconds, so revoked tokens and consents and rotated
+# client secrets are honoured by all workers within about that long (0
+# turns it off and leaves the cache TTLs). The worker's own revocation
+# filter is rebuilt every REVOCATION_FILTER_MAX_AGE seconds to drop
+# expired tokens.
+CACHE_SYNC_INTERVAL = 1
+REVOCATION_FILTER_MAX_AGE = 3600
+
+# How token secrets are stored (website/token_storage.py): 'plain', or
+# 'hashed' for only the SHA-256 digests of access and refresh tokens and
+# authorization codes. Switch over through 'dual', which writes both, and
+# `flask hash-tokens` for the older rows. client_credentials token reuse
+# is off in 'hashed' mode.
+TOKEN_STORAGE = 'plain'
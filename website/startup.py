@@ -0,0 +1,109 @@
+# startup.py
+import contextlib
+import os
+import threading
+import time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import text
+from .models import db
+from .migrations import pending_migrations
+
+
+class StartupTimer(object):
+    """Seconds spent in each phase of ``create_app``."""
+
+    def __init__(self):
+        self.phases = []
+
+    def add(self, name, seconds):
+        self.phases.append((name, seconds))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    @property
+    def total(self):
+        return sum(seconds for _, seconds in self.phases)
+
+    def report(self):
+        parts = ' '.join(f'{name}={seconds * 1000:.1f}ms' for name, seconds in self.phases)
+        return f'startup {self.total * 1000:.1f}ms: {parts}'
+
+
+def warm_pool(engine, connections):
+    """Open ``connections`` pooled connections at once and ping each, so
+    the first requests don't pay for connecting."""
+    opened = []
+    try:
+        for _ in range(connections):
+            conn = engine.connect()
+            opened.append(conn)
+            conn.execute(text('SELECT 1'))
+    finally:
+        for conn in opened:
+            conn.close()
+
+
+class Readiness(object):
+    """What ``/readyz`` answers for this worker.
+
+    The first check of each process warms the pools: ``READYZ_WARM_CONNECTIONS``
+    connections to the primary (default: the pool size) and one to each
+    replica. With ``FAST_START`` it also requires the schema to be up to
+    date, since nothing creates it at boot. Later checks only ping the
+    primary.
+    """
+
+    def __init__(self):
+        self._warmed_pid = None
+        self._lock = threading.Lock()
+
+    def check(self, app):
+        try:
+            if self._warmed_pid != os.getpid():
+                with self._lock:
+                    if self._warmed_pid != os.getpid():
+                        pending = self.warm(app)
+                        if pending:
+                            return False, {'pending_migrations': pending}
+                        self._warmed_pid = os.getpid()
+            else:
+                with db.engine.connect() as conn:
+                    conn.execute(text('SELECT 1'))
+        except Exception as e:
+            return False, {'error': f'{type(e).__name__}: {e}'}
+        return True, {}
+
+    def warm(self, app):
+        engine = db.engine
+        connections = app.config.get('READYZ_WARM_CONNECTIONS')
+        if connections is None:
+            size = getattr(engine.pool, 'size', None)
+            connections = size() if callable(size) else 1
+        warm_pool(engine, max(connections, 1))
+        for key, replica in db.engines.items():
+            if key is not None:
+                warm_pool(replica, 1)
+        if app.config.get('FAST_START'):
+            return [version for version, _, _ in pending_migrations(engine)]
+        return []
+
+
+readiness = Readiness()
+
+
+@click.command('startup-report')
+@with_appcontext
+def startup_report_command():
+    """Show how long this process took to import and create the app."""
+    timer = current_app.extensions['startup']
+    click.echo(f'{"total":<14}{timer.total * 1000:8.1f} ms')
+    for name, seconds in timer.phases:
+        click.echo(f'{name:<14}{seconds * 1000:8.1f} ms')
@@ -0,0 +1,190 @@
+# sweeper.py
+import os
+import random
+import threading
+import time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import and_, or_
+from .models import db, OAuth2Token, OAuth2AuthorizationCode, TokenRevocation, CacheInvalidation
+
+
+def expired_token_filter(cutoff):
+    # a token with a refresh token is usable until refresh_token_expires_at,
+    # see OAuth2Token.is_refresh_token_active; expires_in=0 never expires
+    return and_(
+        OAuth2Token.refresh_token_expires_at < cutoff,
+        OAuth2Token.expires_in > 0,
+    )
+
+
+def expired_access_token_filter(cutoff):
+    # tokens without a refresh token are done when the access token expires
+    return and_(
+        OAuth2Token.refresh_token_expires_at.is_(None),
+        OAuth2Token.expires_in > 0,
+        OAuth2Token.issued_at + OAuth2Token.expires_in < cutoff,
+    )
+
+
+def revoked_token_filter(cutoff):
+    access_revoked = and_(
+        OAuth2Token.access_token_revoked_at > 0,
+        OAuth2Token.access_token_revoked_at < cutoff,
+    )
+    refresh_revoked = or_(
+        and_(OAuth2Token.refresh_token.is_(None), OAuth2Token.refresh_token_digest.is_(None)),
+        and_(
+            OAuth2Token.refresh_token_revoked_at > 0,
+            OAuth2Token.refresh_token_revoked_at < cutoff,
+        ),
+    )
+    return and_(access_revoked, refresh_revoked)
+
+
+def stale_code_filter(cutoff, code_ttl=300):
+    # codes are redeemable for AUTHORIZATION_CODE_TTL seconds, see code_store.py
+    return OAuth2AuthorizationCode.auth_time + code_ttl < cutoff
+
+
+def delete_in_batches(model, criterion, batch_size=1000, max_batches=None, pause=0,
+                      order_by=None):
+    """Delete rows of ``model`` matching ``criterion`` ``batch_size`` at a time.
+
+    Each batch selects primary keys, in ``order_by`` order (the primary
+    key's by default; pass the indexed column of a range criterion so the
+    index serves both), and deletes them in its own short transaction, so
+    no lock is held across batches. Returns a list of ``(rows, seconds)``
+    per batch.
+    """
+    order_by = model.id if order_by is None else order_by
+    batches = []
+    while max_batches is None or len(batches) < max_batches:
+        started = time.perf_counter()
+        ids = [row[0] for row in db.session.query(model.id)
+               .filter(criterion).order_by(order_by).limit(batch_size)]
+        if not ids:
+            db.session.rollback()
+            break
+        deleted = db.session.query(model).filter(model.id.in_(ids)) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+        batches.append((deleted, time.perf_counter() - started))
+        if len(ids) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return batches
+
+
+def sweep(token_retention=86400, code_retention=3600, batch_size=1000,
+          max_batches=None, pause=0, now=None, code_ttl=300):
+    """Delete tokens and codes that stopped being usable before the
+    retention window, and return the per-batch report for each kind."""
+    now = time.time() if now is None else now
+    token_cutoff = int(now - token_retention)
+    code_cutoff = int(now - code_retention)
+    kwargs = dict(batch_size=batch_size, max_batches=max_batches, pause=pause)
+    return {
+        'expired_tokens': delete_in_batches(
+            OAuth2Token, expired_token_filter(token_cutoff),
+            order_by=OAuth2Token.refresh_token_expires_at, **kwargs),
+        'expired_access_tokens': delete_in_batches(
+            OAuth2Token, expired_access_token_filter(token_cutoff),
+            order_by=OAuth2Token.refresh_token_expires_at, **kwargs),
+        'revoked_tokens': delete_in_batches(
+            OAuth2Token, revoked_token_filter(token_cutoff), **kwargs),
+        'stale_codes': delete_in_batches(
+            OAuth2AuthorizationCode, stale_code_filter(code_cutoff, code_ttl), **kwargs),
+        # resource servers only need revocations of unexpired tokens
+        'revocations': delete_in_batches(
+            TokenRevocation, TokenRevocation.expires_at < token_cutoff, **kwargs),
+        # workers poll the log seconds behind, see cache_sync.py
+        'cache_invalidations': delete_in_batches(
+            CacheInvalidation, CacheInvalidation.created_at < token_cutoff,
+            order_by=CacheInvalidation.created_at, **kwargs),
+    }
+
+
+def sweep_from_config(app):
+    config = app.config
+    return sweep(
+        token_retention=config['SWEEPER_TOKEN_RETENTION'],
+        code_retention=config['SWEEPER_CODE_RETENTION'],
+        batch_size=config['SWEEPER_BATCH_SIZE'],
+        max_batches=config.get('SWEEPER_MAX_BATCHES'),
+        pause=config.get('SWEEPER_BATCH_PAUSE', 0),
+        code_ttl=config.get('AUTHORIZATION_CODE_TTL', 300),
+    )
+
+
+def format_report(report):
+    lines = []
+    for kind, batches in report.items():
+        rows = sum(n for n, _ in batches)
+        seconds = sum(t for _, t in batches)
+        slowest = max((t for _, t in batches), default=0)
+        lines.append(f'{kind}: {rows} rows in {len(batches)} batches, '
+                     f'{seconds * 1000:.1f} ms total, slowest batch {slowest * 1000:.1f} ms')
+    return '\n'.join(lines)
+
+
+@click.command('sweep-tokens')
+@click.option('--token-retention', type=int, help='Seconds to keep unusable tokens.')
+@click.option('--code-retention', type=int, help='Seconds to keep expired codes.')
+@click.option('--batch-size', type=int, help='Rows deleted per transaction.')
+@click.option('--max-batches', type=int, help='Stop after this many batches per kind.')
+@with_appcontext
+def sweep_command(token_retention, code_retention, batch_size, max_batches):
+    """Delete expired/revoked tokens, stale authorization codes and old
+    revocation and cache invalidation log entries."""
+    config = current_app.config
+    report = sweep(
+        token_retention=config['SWEEPER_TOKEN_RETENTION'] if token_retention is None else token_retention,
+        code_retention=config['SWEEPER_CODE_RETENTION'] if code_retention is None else code_retention,
+        batch_size=batch_size or config['SWEEPER_BATCH_SIZE'],
+        max_batches=max_batches or config.get('SWEEPER_MAX_BATCHES'),
+        pause=config.get('SWEEPER_BATCH_PAUSE', 0),
+        code_ttl=config.get('AUTHORIZATION_CODE_TTL', 300),
+    )
+    click.echo(format_report(report))
+
+
+def init_sweeper(app):
+    """Run ``sweep`` every ``SWEEPER_INTERVAL`` seconds in a daemon thread.
+
+    The thread is started by the first request each process serves, so
+    gunicorn workers forked from a preloaded app get their own. Every
+    worker sweeps; deletes are idempotent, and a random start offset keeps
+    them from sweeping at the same moment.
+    """
+    interval = app.config.get('SWEEPER_INTERVAL')
+    if not interval:
+        return
+    started = {}
+    lock = threading.Lock()
+
+    def run():
+        time.sleep(random.uniform(0, interval))
+        while True:
+            with app.app_context():
+                try:
+                    print(format_report(sweep_from_config(app)))
+                except Exception as e:
+                    db.session.rollback()
+                    print(f'Error sweeping tokens: {e}')
+                finally:
+                    db.session.remove()
+            time.sleep(interval)
+
+    @app.before_request
+    def start_sweeper():
+        pid = os.getpid()
+        if pid in started:
+            return
+        with lock:
+            if pid not in started:
+                started[pid] = threading.Thread(
+                    target=run, name='token-sweeper', daemon=True)
+                started[pid].start()
@@ -0,0 +1,188 @@
+# token_cache.py
+import threading
+import time
+from collections import OrderedDict
+
+
+class CachedUser(object):
+    """Detached copy of the ``User`` columns the resource endpoints read."""
+    __slots__ = ('id', 'username')
+
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+    def __str__(self):
+        return self.username
+
+    def get_user_id(self):
+        return self.id
+
+
+class CachedToken(object):
+    """Detached copy of an ``OAuth2Token`` row plus its resolved user.
+
+    It implements the parts of ``TokenMixin`` used by the bearer token
+    validator, so it can be returned from ``authenticate_token`` and show
+    up as ``current_token`` without keeping a session-bound instance alive
+    between requests.
+    """
+    __slots__ = (
+        'id', 'client_id', 'user_id', 'user', 'scope', 'revoked',
+        'issued_at', 'expires_in',
+    )
+
+    def __init__(self, token, user=None):
+        self.id = token.id
+        self.client_id = token.client_id
+        self.user_id = token.user_id
+        self.scope = token.scope
+        self.revoked = bool(token.is_revoked())
+        self.issued_at = token.issued_at
+        self.expires_in = token.expires_in
+        self.user = CachedUser(user.id, user.username) if user else None
+
+    @classmethod
+    def from_claims(cls, claims):
+        """Build a token from verified JWT access token claims."""
+        token = cls.__new__(cls)
+        token.id = None
+        token.client_id = claims['client_id']
+        token.scope = claims.get('scope', '')
+        token.revoked = False
+        token.issued_at = claims['iat']
+        token.expires_in = claims['exp'] - claims['iat']
+        if 'preferred_username' in claims:
+            token.user_id = int(claims['sub'])
+            token.user = CachedUser(token.user_id, claims['preferred_username'])
+        else:
+            token.user_id = None
+            token.user = None
+        return token
+
+    def check_client(self, client):
+        return self.client_id == client.get_client_id()
+
+    def get_client_id(self):
+        return self.client_id
+
+    def get_scope(self):
+        return self.scope
+
+    def get_expires_in(self):
+        return self.expires_in
+
+    def get_expires_at(self):
+        return self.issued_at + self.expires_in
+
+    def is_expired(self):
+        if not self.expires_in:
+            return False
+        return self.get_expires_at() < time.time()
+
+    def is_revoked(self):
+        return self.revoked
+
+
+class TokenCache(object):
+    """Bounded LRU cache of resolved bearer tokens with per-entry TTL.
+
+    Entries live for at most ``TOKEN_CACHE_TTL`` seconds and never beyond
+    the token's own expiry. The cache is per process: revocations are seen
+    immediately by the worker that handled them, and by the others through
+    the revocation feed they poll (cache_sync.py), or once the entry's TTL
+    runs out when polling is off.
+    """
+
+    def __init__(self, app=None, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # bumped by every invalidation; see set()
+        self.generation = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.maxsize = app.config.get('TOKEN_CACHE_SIZE', self.maxsize)
+        self.ttl = app.config.get('TOKEN_CACHE_TTL', self.ttl)
+        self.clear()
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            value, expires_at = item
+            if expires_at <= now:
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None, generation=None):
+        """Cache ``value``; pass the ``generation`` read before loading it
+        to skip values an invalidation may have made stale meanwhile."""
+        if not self.enabled:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[key] = (value, time.time() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def set_token(self, key, token, user=None):
+        """Cache ``token``/``user`` under ``key`` until the token expires."""
+        entry = CachedToken(token, user)
+        self.set(key, entry, entry.get_expires_at() - time.time())
+        return entry
+
+    def invalidate(self, key):
+        if not key:
+            return
+        with self._lock:
+            self.generation += 1
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            size = len(self._data)
+        lookups = self.hits + self.misses
+        return {
+            'size': size,
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+token_cache = TokenCache()
@@ -0,0 +1,250 @@
+# token_events.py
+import atexit
+import collections
+import fcntl
+import json
+import os
+import queue
+import threading
+import time
+from .request_log import rotate
+
+
+class FileSink(object):
+    """Append events as JSON lines to ``TOKEN_EVENTS_FILE``.
+
+    Rotated like the request log: once it reaches ``max_bytes`` it becomes
+    ``.1`` and at most ``backup_count`` old files are kept. Workers append
+    and rotate under an ``flock`` on the file's ``.lock``.
+    """
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+    def emit(self, events):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        data = ''.join(json.dumps(e, separators=(',', ':')) + '\n' for e in events)
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with open(self.path, 'a') as f:
+                f.write(data)
+                size = f.tell()
+            if size >= self.max_bytes:
+                rotate(self.path, self.backup_count)
+
+
+class AccessTokenFileSink(object):
+    """Keep the last issued access token in ``access_token.txt``.
+
+    This is what the token endpoint used to do inline. It is the only sink
+    that sees the raw token, so it is off unless listed in
+    ``TOKEN_EVENT_SINKS``.
+    """
+    wants_token = True
+
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, events):
+        tokens = [e['access_token'] for e in events if e.get('access_token')]
+        if not tokens:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(tokens[-1])
+        os.replace(tmp, self.path)
+
+
+class SQLSink(object):
+    """Insert events into the ``oauth2_token_event`` audit table."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def emit(self, events):
+        from .models import db, TokenEvent
+        columns = TokenEvent.__table__.columns.keys()
+        rows = [{k: v for k, v in e.items() if k in columns} for e in events]
+        with self.app.app_context():
+            try:
+                db.session.execute(TokenEvent.__table__.insert(), rows)
+                db.session.commit()
+            finally:
+                db.session.remove()
+
+
+class MemorySink(object):
+    """Most recent events of this process, served to ``ADMIN_CLIENTS`` at
+    ``/api/token_events``."""
+
+    def __init__(self, size=1000):
+        self.events = collections.deque(maxlen=size)
+
+    def emit(self, events):
+        self.events.extend(events)
+
+    def recent(self, limit=None):
+        events = list(self.events)
+        return events[-limit:] if limit else events
+
+
+class TokenEvents(object):
+    """Publish a ``token_issued`` event for every token that is saved.
+
+    ``save_token`` only builds a small dict and ``put_nowait``s it; a
+    background thread hands the events to the sinks in batches, so the
+    token endpoint never waits on disk or an extra insert. When the queue
+    is full the event is dropped and counted. Events carry no token values
+    unless ``TOKEN_EVENTS_INCLUDE_TOKEN`` is set; sinks with ``wants_token``
+    get the access token regardless.
+    """
+
+    def __init__(self, app=None):
+        self.sinks = []
+        self.memory = None
+        self.include_token = False
+        self.queue_size = 10000
+        self.batch_size = 200
+        self.published = 0
+        self.dropped = 0
+        self.errors = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.include_token = config.get('TOKEN_EVENTS_INCLUDE_TOKEN', False)
+        self.queue_size = config.get('TOKEN_EVENTS_QUEUE_SIZE', self.queue_size)
+        directory = os.environ.get('RAILWAY_VOLUME_MOUNT_PATH') or app.instance_path
+        self.sinks = []
+        self.memory = None
+        for name in config.get('TOKEN_EVENT_SINKS') or ():
+            if name == 'file':
+                self.add_sink(FileSink(
+                    config.get('TOKEN_EVENTS_FILE') or os.path.join(directory, 'token_events.log'),
+                    config.get('TOKEN_EVENTS_MAX_BYTES', 10 * 1024 * 1024),
+                    config.get('TOKEN_EVENTS_BACKUP_COUNT', 5)))
+            elif name == 'sql':
+                self.add_sink(SQLSink(app))
+            elif name == 'memory':
+                self.memory = MemorySink(config.get('TOKEN_EVENTS_BUFFER_SIZE', 1000))
+                self.add_sink(self.memory)
+            elif name == 'access_token_file':
+                self.add_sink(AccessTokenFileSink(os.path.join(directory, 'access_token.txt')))
+            else:
+                raise ValueError(f'Unknown token event sink: {name}')
+
+    def add_sink(self, sink):
+        """Register any object with an ``emit(events)`` method."""
+        self.sinks.append(sink)
+
+    def token_issued(self, token, request):
+        """Build the event for ``token``; publish it once the token is saved.
+
+        Call this before the token is committed: reading ``request.user``
+        after the commit would reload the expired instance from the DB.
+        """
+        if not self.sinks:
+            return None
+        user = request.user
+        now = int(time.time())
+        event = {
+            'event': 'token_issued',
+            'created_at': now,
+            'client_id': request.client.client_id,
+            'user_id': user.get_user_id() if user else None,
+            'grant_type': request.payload.grant_type or 'implicit',
+            'scope': token.get('scope', ''),
+            'token_type': token.get('token_type'),
+            'expires_in': token.get('expires_in'),
+            'expires_at': now + token['expires_in'] if token.get('expires_in') else None,
+            'refresh_token_issued': 'refresh_token' in token,
+        }
+        if self.include_token or any(getattr(s, 'wants_token', False) for s in self.sinks):
+            event['access_token'] = token.get('access_token')
+        return event
+
+    def publish(self, event):
+        if event is None:
+            return False
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.published += 1
+        return True
+
+    def stats(self):
+        return {
+            'sinks': [type(s).__name__ for s in self.sinks],
+            'published': self.published,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'pending': self._queue.qsize() if self._queue else 0,
+        }
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._thread = threading.Thread(
+                target=self._run, name='token-events', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+            atexit.register(self.close)
+
+    def close(self, timeout=5.0):
+        """Deliver everything that is queued and stop the thread."""
+        if self._pid != os.getpid() or self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+        self._pid = None
+
+    def _run(self):
+        q = self._queue
+        stop = False
+        while not stop:
+            item = q.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = q.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._deliver(batch)
+
+    def _deliver(self, batch):
+        public = batch
+        if not self.include_token:
+            public = [{k: v for k, v in e.items() if k != 'access_token'} for e in batch]
+        for sink in self.sinks:
+            try:
+                sink.emit(batch if getattr(sink, 'wants_token', False) else public)
+            except Exception as e:
+                self.errors += 1
+                print(f'Error in token event sink {type(sink).__name__}: {e}')
+
+
+token_events = TokenEvents()
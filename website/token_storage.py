@@ -0,0 +1,174 @@
+# token_storage.py
+"""How token secrets are kept in the database.
+
+With ``TOKEN_STORAGE = 'plain'`` (the default) access and refresh tokens
+are stored as issued. With ``'hashed'`` only their SHA-256 digests are:
+32-byte ``access_token_digest`` and ``refresh_token_digest`` columns, with
+``access_token`` and ``refresh_token`` left empty, so a copy of the table
+holds no usable credentials and the lookup indexes are fixed width.
+Authorization codes are then keyed by the hex digest of the code in every
+code store.
+
+``'dual'`` looks tokens up as ``'plain'`` does but writes the digests as
+well, so an existing deployment switches over without downtime::
+
+    $ flask db-upgrade
+    # deploy with TOKEN_STORAGE = 'dual'
+    $ flask hash-tokens                    # digests for the older rows
+    # deploy with TOKEN_STORAGE = 'hashed'
+    $ flask hash-tokens --erase-plaintext  # then drop the plaintext
+"""
+import hashlib
+import time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import and_, bindparam, or_, update
+from .models import db, OAuth2Token
+
+
+def digest(secret):
+    return hashlib.sha256(secret.encode()).digest()
+
+
+class TokenStorage(object):
+
+    def __init__(self, app=None):
+        self.mode = 'plain'
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        mode = app.config.get('TOKEN_STORAGE', 'plain')
+        if mode not in ('plain', 'dual', 'hashed'):
+            raise ValueError(f'Unknown TOKEN_STORAGE: {mode}')
+        self.mode = mode
+
+    @property
+    def hashed(self):
+        return self.mode == 'hashed'
+
+    def key(self, secret):
+        """What a secret is stored as: its digest, or itself. The token
+        cache and read-your-writes tracking use the same key, so it can be
+        derived from a row as well as from a request."""
+        return digest(secret) if self.hashed else secret
+
+    def row_key(self, token):
+        return token.access_token_digest if self.hashed else token.access_token
+
+    @property
+    def access_token_column(self):
+        return OAuth2Token.access_token_digest if self.hashed else OAuth2Token.access_token
+
+    @property
+    def refresh_token_column(self):
+        return OAuth2Token.refresh_token_digest if self.hashed else OAuth2Token.refresh_token
+
+    def refresh_token_is(self, refresh_token):
+        return self.refresh_token_column == self.key(refresh_token)
+
+    def match(self, token, key):
+        """``'access_token'`` or ``'refresh_token'``, whichever of
+        ``token``'s secrets is stored as ``key``, else ``None``."""
+        if self.row_key(token) == key:
+            return 'access_token'
+        refresh = token.refresh_token_digest if self.hashed else token.refresh_token
+        if refresh is not None and refresh == key:
+            return 'refresh_token'
+        return None
+
+    def columns(self, token):
+        """The token columns to insert for an issued ``token`` dict."""
+        if self.mode == 'plain':
+            return token
+        stored = dict(token, access_token_digest=digest(token['access_token']))
+        if token.get('refresh_token'):
+            stored['refresh_token_digest'] = digest(token['refresh_token'])
+        if self.hashed:
+            stored['access_token'] = None
+            stored['refresh_token'] = None
+        return stored
+
+    def code_key(self, code):
+        # codes live minutes, in stores keyed by strings
+        return hashlib.sha256(code.encode()).hexdigest() if self.hashed else code
+
+
+token_storage = TokenStorage()
+
+
+def hash_batches(batch_size=1000, erase_plaintext=False, pause=0):
+    """Fill in the digests of rows stored before they were written, or with
+    ``erase_plaintext`` clear the plaintext of rows that have them, one
+    batch per transaction. Returns ``(rows, seconds)`` per batch."""
+    if erase_plaintext:
+        pending = and_(OAuth2Token.access_token.isnot(None),
+                       OAuth2Token.access_token_digest.isnot(None))
+    else:
+        pending = and_(OAuth2Token.access_token.isnot(None),
+                       OAuth2Token.access_token_digest.is_(None))
+    table = OAuth2Token.__table__
+    statement = update(table).where(table.c.id == bindparam('row_id'))
+    batches = []
+    while True:
+        started = time.perf_counter()
+        rows = db.session.query(
+            OAuth2Token.id, OAuth2Token.access_token, OAuth2Token.refresh_token,
+        ).filter(pending).order_by(OAuth2Token.id).limit(batch_size).all()
+        if not rows:
+            db.session.rollback()
+            break
+        if erase_plaintext:
+            values = [{'row_id': id, 'access_token': None, 'refresh_token': None}
+                      for id, _, _ in rows]
+        else:
+            values = [{
+                'row_id': id,
+                'access_token_digest': digest(access_token),
+                'refresh_token_digest': digest(refresh_token) if refresh_token else None,
+            } for id, access_token, refresh_token in rows]
+        db.session.execute(statement, values)
+        db.session.commit()
+        batches.append((len(rows), time.perf_counter() - started))
+        if len(rows) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return batches
+
+
+def unhashed_tokens():
+    return OAuth2Token.query.filter(
+        OAuth2Token.access_token.isnot(None),
+        or_(OAuth2Token.access_token_digest.is_(None),
+            and_(OAuth2Token.refresh_token.isnot(None),
+                 OAuth2Token.refresh_token_digest.is_(None))),
+    ).count()
+
+
+@click.command('hash-tokens')
+@click.option('--batch-size', type=int, default=1000, help='Rows updated per transaction.')
+@click.option('--erase-plaintext', is_flag=True,
+              help="Clear the plaintext of hashed rows; needs TOKEN_STORAGE = 'hashed'.")
+@with_appcontext
+def hash_tokens_command(batch_size, erase_plaintext):
+    """Backfill token digests in batches, online.
+
+    Run it once every worker writes digests (TOKEN_STORAGE = 'dual'), and
+    before switching to 'hashed'; with --erase-plaintext, after the switch.
+    """
+    if current_app.config.get('TOKEN_STORAGE', 'plain') == 'plain':
+        raise click.UsageError("TOKEN_STORAGE = 'plain' doesn't write digests, "
+                               "new tokens would be missed")
+    if erase_plaintext:
+        if current_app.config.get('TOKEN_STORAGE') != 'hashed':
+            raise click.UsageError("--erase-plaintext needs TOKEN_STORAGE = 'hashed'")
+        remaining = unhashed_tokens()
+        if remaining:
+            raise click.UsageError(f'{remaining} tokens have no digest yet, run hash-tokens first')
+    batches = hash_batches(batch_size, erase_plaintext)
+    rows = sum(n for n, _ in batches)
+    seconds = sum(t for _, t in batches)
+    action = 'erased plaintext of' if erase_plaintext else 'hashed'
+    click.echo(f'{action} {rows} tokens in {len(batches)} batches, {seconds * 1000:.1f} ms')
@@ -0,0 +1,201 @@
+# upstream.py
+"""Outbound HTTP to Google.
+
+The "Sign in with Google" client (discovery, token, userinfo and JWKS
+requests) and the ID token verifier's JWKS refreshes send through one
+``requests`` adapter per worker, so connections to Google are kept alive
+between requests instead of opened per call, and every request has a
+``(connect, read)`` timeout unless it brings its own.
+
+Each host gets a circuit breaker: after ``GOOGLE_BREAKER_FAILURES``
+consecutive requests that raised or got a 5xx answer, requests to it
+raise :class:`CircuitOpen` at once for ``GOOGLE_BREAKER_RESET`` seconds,
+instead of holding a worker for a full timeout each. Then a single trial
+request is let through, and its outcome closes or re-opens the circuit.
+Failed requests are reported here, once, rather than by their callers.
+"""
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from authlib.integrations.requests_client import OAuth2Session
+from .metrics import metrics
+
+
+class CircuitOpen(requests.ConnectionError):
+    """A request that wasn't sent because its host keeps failing."""
+
+    def __init__(self, host, retry_after):
+        super().__init__(f'{host} is failing, requests to it are suspended')
+        self.host = host
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, failures=5, reset_timeout=30):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self._trial or time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            # half-open: this request is the trial
+            self._trial = True
+            return True
+
+    def retry_after(self):
+        if self.opened_at is None:
+            return 0
+        return max(1, int(self.opened_at + self.reset_timeout - time.monotonic()) + 1)
+
+    def success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        """Count a failed request; True if that opened the circuit."""
+        with self._lock:
+            self.consecutive_failures += 1
+            opened = self._trial or self.consecutive_failures >= self.failures
+            if opened:
+                self.opened_at = time.monotonic()
+            self._trial = False
+            return opened
+
+
+class Upstream(object):
+
+    def __init__(self, app=None):
+        self.timeout = (3.05, 10)
+        self.pool_size = 10
+        self.breaker_failures = 5
+        self.breaker_reset = 30
+        self.breakers = {}
+        self._adapter = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.timeout = (config.get('GOOGLE_HTTP_CONNECT_TIMEOUT', self.timeout[0]),
+                        config.get('GOOGLE_HTTP_READ_TIMEOUT', self.timeout[1]))
+        self.pool_size = config.get('GOOGLE_HTTP_POOL_SIZE', self.pool_size)
+        self.breaker_failures = config.get('GOOGLE_BREAKER_FAILURES', self.breaker_failures)
+        self.breaker_reset = config.get('GOOGLE_BREAKER_RESET', self.breaker_reset)
+        self.breakers = {}
+        self._pid = None
+
+    @property
+    def adapter(self):
+        # one pool per worker: connections opened before a fork would be
+        # shared with the parent
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size,
+                                                max_retries=0)
+                    self._pid = os.getpid()
+        return self._adapter
+
+    def breaker(self, host):
+        breaker = self.breakers.get(host)
+        if breaker is None:
+            with self._lock:
+                breaker = self.breakers.setdefault(
+                    host, CircuitBreaker(self.breaker_failures, self.breaker_reset))
+        return breaker
+
+    def send(self, send, request, **kwargs):
+        """``send(request, **kwargs)`` behind the host's circuit breaker."""
+        host = urlsplit(request.url).netloc
+        breaker = self.breaker(host)
+        if not breaker.allow():
+            metrics.upstream_request(host, 'rejected')
+            raise CircuitOpen(host, breaker.retry_after())
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        started = time.perf_counter()
+        outcome = 'error'
+        error = None
+        try:
+            response = send(request, **kwargs)
+        except requests.Timeout as e:
+            outcome = 'timeout'
+            error = e
+            raise
+        except Exception as e:
+            error = e
+            raise
+        else:
+            if response.status_code >= 500:
+                error = f'{response.status_code} {response.reason}'
+            else:
+                outcome = 'ok'
+            return response
+        finally:
+            # only an answer below 500 counts as success
+            metrics.upstream_request(host, outcome, time.perf_counter() - started)
+            if outcome == 'ok':
+                breaker.success()
+            else:
+                # without the query, which may carry codes or secrets
+                print(f"Error requesting {request.url.split('?')[0]}: {error}")
+                if breaker.failure():
+                    print(f'Error: suspending requests to {host} for {breaker.reset_timeout}s')
+
+    def stats(self):
+        return {host: {'state': b.state, 'consecutive_failures': b.consecutive_failures}
+                for host, b in list(self.breakers.items())}
+
+    def get(self, url, **kwargs):
+        with PooledSession() as session:
+            return session.get(url, **kwargs)
+
+
+upstream = Upstream()
+
+
+class PooledSessionMixin(object):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        adapter = upstream.adapter
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def send(self, request, **kwargs):
+        return upstream.send(super().send, request, **kwargs)
+
+    def close(self):
+        # the adapter, and its connections, are shared
+        pass
+
+
+class PooledSession(PooledSessionMixin, requests.Session):
+    pass
+
+
+class PooledOAuth2Session(PooledSessionMixin, OAuth2Session):
+    pass